@@ -0,0 +1,6 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmarks for the backend. These are not part of the python package, and are not run as part of the tests.
+Run a benchmark from the backend directory, e.g.: `python -m benchmarks.bench_validation`
+"""
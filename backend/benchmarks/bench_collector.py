@@ -0,0 +1,203 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Load test of the collector endpoint: parsing, enrichment, validation, hydration, serialization and writing
+to the outputs. Reports the throughput in events/s, the p50 and p99 latency of the requests, and how the
+CPU time of the process is spent per stage, as measured by the metrics in objectiv_backend.common.metrics.
+
+Requests are sent either in-process with the Flask test client (`--client flask`), or over http to a
+threaded WSGI server in the same process (`--client wsgi`), from `--concurrency` client threads.
+
+Outputs (`--sink`):
+    * null: no outputs, the events are processed and serialized, but not written anywhere
+    * files: the file system output, with ndjson segments in a temporary directory
+    * postgres: the Postgres database configured with the usual POSTGRES_* environment variables. In sync
+        mode the events are added to the data table, so use a different --seed for each run, or the events
+        are skipped as duplicates.
+
+The request bodies are generated up front from a fixed seed, so runs with the same arguments send the same
+events. Example: `python -m benchmarks.bench_collector --mode sync async --client flask wsgi`
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.app import create_app
+from objectiv_backend.common import config
+from objectiv_backend.common.config import FileSystemOutputConfig, OutputConfig, get_collector_config, \
+    get_config_output_snowplow, get_config_postgres
+from objectiv_backend.common.metrics import DB_WRITE_SECONDS, STAGE_SECONDS
+from objectiv_backend.common.rolling_file import close_rolling_file_writers
+
+
+def make_request_bodies(request_count: int, events_per_request: int, seed: int) -> List[bytes]:
+    """ Create the bodies of the requests, as a tracker would send them. """
+    events = make_event_batch(request_count * events_per_request, seed=seed)
+    transport_time = round(time.time() * 1000)
+    return [
+        json.dumps({
+            'events': events[i:i + events_per_request],
+            'transport_time': transport_time
+        }).encode('utf-8')
+        for i in range(0, len(events), events_per_request)
+    ]
+
+
+def configure_collector(mode: str, sink: str, directory: str):
+    """ Set the mode and outputs in the cached collector configuration. """
+    snowplow = get_config_output_snowplow()._replace(aws_enabled=False, gcp_enabled=False)
+    output = OutputConfig(postgres=None, aws=None, file_system=None, snowplow=snowplow)
+    if sink == 'files':
+        output = output._replace(file_system=FileSystemOutputConfig(path=directory, file_format='ndjson'))
+    elif sink == 'postgres':
+        pg_config = get_config_postgres()
+        if pg_config is None:
+            raise Exception('Postgres output requires OUTPUT_ENABLE_PG=true and the POSTGRES_* settings')
+        output = output._replace(postgres=pg_config)
+    config._CACHED_COLLECTOR_CONFIG = get_collector_config()._replace(async_mode=(mode == 'async'), output=output)
+
+
+def run_flask_client(app, bodies: List[bytes]) -> List[float]:
+    """ Send the requests one by one with the Flask test client. Returns the latency per request. """
+    client = app.test_client()
+    latencies = []
+    for body in bodies:
+        start = time.perf_counter()
+        response = client.post('/', data=body)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200 and response.json['error_count'] == 0, response.data
+    return latencies
+
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def run_wsgi_client(app, bodies: List[bytes], concurrency: int) -> List[float]:
+    """
+    Send the requests over http to a threaded WSGI server, from concurrency threads with a keep-alive
+    connection each. Returns the latency per request.
+    """
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_KeepAliveRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    latencies: List[float] = []
+    errors: List[str] = []
+
+    def send(thread_bodies: List[bytes]):
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        for body in thread_bodies:
+            start = time.perf_counter()
+            connection.request('POST', '/', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200 or json.loads(data)['error_count'] != 0:
+                errors.append(data.decode('utf-8'))
+        connection.close()
+
+    threads = [threading.Thread(target=send, args=(bodies[i::concurrency],)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    server.server_close()
+    if errors:
+        raise Exception(f'{len(errors)} requests failed, first response: {errors[0]}')
+    return latencies
+
+
+def print_results(title: str, event_count: int, elapsed: float, latencies: List[float], cpu: float,
+                  stages: Dict[str, float], sequential: bool):
+    """
+    Print the throughput, latency and the time per stage. The stage times are wall clock times. With sequential
+    requests that is close to the CPU time, and the remaining CPU time is reported as 'other'. With concurrent
+    requests the stage times of the threads overlap, so the share of each stage in the total stage time is
+    reported instead.
+    """
+    print(f'{title}: {event_count / elapsed:>8.0f} events/s, '
+          f'p50 {percentile(latencies, 0.5) * 1000:.2f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms, '
+          f'cpu {cpu:.2f} s for {elapsed:.2f} s')
+    stages = {stage: seconds for stage, seconds in stages.items() if seconds > 0}
+    if sequential:
+        stages['other'] = cpu - sum(stages.values())
+        total, unit = cpu, 'cpu'
+    else:
+        total, unit = sum(stages.values()), 'stage time'
+    for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+        print(f'    {stage:<16} {seconds * 1_000_000 / event_count:>7.1f} us/event  '
+              f'{100 * seconds / total:>5.1f}% of {unit}')
+
+
+def get_stage_seconds() -> Dict[str, float]:
+    """ Total time spent per stage and per database table so far, from the metrics. """
+    result = {labels[0]: seconds for labels, seconds in STAGE_SECONDS.get_sums().items()}
+    result.update({f'db:{labels[0]}': seconds for labels, seconds in DB_WRITE_SECONDS.get_sums().items()})
+    return result
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(app, client: str, bodies: List[bytes], concurrency: int) -> Tuple[float, List[float], float, Dict[str, float]]:
+    """ Send all requests. Returns the elapsed time, the latencies, the CPU time, and the time per stage. """
+    stages_before = get_stage_seconds()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+    # The collector prints information about every request, keep that out of the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if client == 'flask':
+            latencies = run_flask_client(app, bodies)
+        else:
+            latencies = run_wsgi_client(app, bodies, concurrency)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_before
+    stages = {stage: seconds - stages_before.get(stage, 0) for stage, seconds in get_stage_seconds().items()}
+    return elapsed, latencies, cpu, stages
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Load test the collector endpoint')
+    parser.add_argument('--requests', type=int, default=2000, help='number of requests per run')
+    parser.add_argument('--events-per-request', type=int, default=10)
+    parser.add_argument('--mode', choices=['sync', 'async'], nargs='+', default=['sync'])
+    parser.add_argument('--client', choices=['flask', 'wsgi'], nargs='+', default=['flask'])
+    parser.add_argument('--sink', choices=['null', 'files', 'postgres'], default='null')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of client threads, for the wsgi client')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating the events')
+    args = parser.parse_args(argv[1:])
+
+    app = create_app()
+    bodies = make_request_bodies(args.requests, args.events_per_request, args.seed)
+    event_count = args.requests * args.events_per_request
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in args.mode:
+            configure_collector(mode=mode, sink=args.sink, directory=directory)
+            # warm up, e.g. connection pools
+            run(app, 'flask', bodies[:10], concurrency=1)
+            for client in args.client:
+                elapsed, latencies, cpu, stages = run(app, client, bodies, args.concurrency)
+                print_results(title=f'{mode} {client} {args.sink}', event_count=event_count, elapsed=elapsed,
+                              latencies=latencies, cpu=cpu, stages=stages,
+                              sequential=(client == 'flask' or args.concurrency == 1))
+        # complete the segments before the directory is removed
+        close_rolling_file_writers()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmark finding contexts in events, as done by the collector's enrichment.
+Compares scanning all contexts of the event for every lookup, the way get_contexts() did it before, to
+looking up the contexts in a ContextIndex that is created once per event.
+"""
+import argparse
+import sys
+import time
+from typing import List, cast
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.event_utils import ContextIndex, add_global_context_to_event
+from objectiv_backend.common.types import ContextData, ContextType, EventData, EventDataList
+from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
+from objectiv_backend.schema.schema import CookieIdContext
+
+# The lookups per event: two by the collector's enrichment, and three as the Snowplow output used to do them
+LOOKUPS = ('HttpContext', 'PathContext', 'HttpContext', 'CookieIdContext', 'PathContext')
+
+
+def get_contexts_linear(event: EventData, context_type: ContextType) -> List[ContextData]:
+    """ get_contexts() as it was, before it avoided concatenating the context lists. """
+    contexts = event.get('global_contexts', []) + event.get('location_stack', [])
+    result = []
+    for context in contexts:
+        _contexts_types = cast(List[ContextType], context.get('_types', []))
+        if context.get('_type') == context_type or context_type in _contexts_types:
+            result.append(context)
+    return result
+
+
+def lookup_linear(events: EventDataList):
+    for event in events:
+        for context_type in LOOKUPS:
+            assert get_contexts_linear(event, context_type)[0]
+
+
+def lookup_index(events: EventDataList):
+    for event in events:
+        index = ContextIndex(event)
+        for context_type in LOOKUPS:
+            assert index.get_optional_context(context_type)
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark finding contexts in events')
+    parser.add_argument('--events', type=int, default=10_000, help='number of events per run')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs; the best run is reported')
+    args = parser.parse_args(argv[1:])
+
+    event_schema = get_collector_config().event_schema
+    events = make_event_batch(args.events)
+    for event in events:
+        add_global_context_to_event(event, CookieIdContext(id=event['id'], cookie_id=event['id']))
+        hydrate_types_into_event(event_schema=event_schema, event=event)
+    for name, function in ('linear', lookup_linear), ('index', lookup_index):
+        best = float('inf')
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            function(events)
+            best = min(best, time.perf_counter() - start)
+        print(f'{name:>8}: {args.events / best:>10.0f} events/s')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
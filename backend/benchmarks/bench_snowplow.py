@@ -0,0 +1,72 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmark preparing events for the Snowplow pipeline: encoding collector payloads with the generated thrift
+code and a TBinaryProtocol (the way payload_to_thrift() did it before) versus payload_to_thrift(), and
+preparing good and bad events per event versus per batch.
+"""
+import argparse
+import sys
+import time
+from typing import Callable, List
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
+from objectiv_backend.schema.validate_events import EventError
+from objectiv_backend.snowplow.schema.ttypes import CollectorPayload  # type: ignore
+from objectiv_backend.snowplow.snowplow_helper import objectiv_event_to_snowplow_payload, payload_to_thrift, \
+    prepare_event_for_snowplow_pipeline, prepare_events_for_snowplow_pipeline
+
+
+def payload_to_thrift_generated(payload: CollectorPayload) -> bytes:
+    """ payload_to_thrift() as it was, with the generated thrift code. """
+    transport = TTransport.TMemoryBuffer()
+    payload.write(oprot=TBinaryProtocol.TBinaryProtocol(trans=transport))
+    return transport.getvalue()
+
+
+def best_time(function: Callable[[], object], runs: int) -> float:
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark preparing events for the Snowplow pipeline')
+    parser.add_argument('--events', type=int, default=10_000, help='number of events per run')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs; the best run is reported')
+    args = parser.parse_args(argv[1:])
+
+    collector_config = get_collector_config()
+    config = collector_config.output.snowplow
+    events = [hydrate_types_into_event(event_schema=collector_config.event_schema, event=event)
+              for event in make_event_batch(args.events)]
+    event_errors: List[EventError] = []
+    payloads = [objectiv_event_to_snowplow_payload(event=event, config=config) for event in events]
+
+    benchmarks = {
+        'thrift generated': lambda: [payload_to_thrift_generated(payload) for payload in payloads],
+        'thrift': lambda: [payload_to_thrift(payload) for payload in payloads],
+        'good per event': lambda: [prepare_event_for_snowplow_pipeline(event=event, good=True, config=config)
+                                   for event in events],
+        'good per batch': lambda: prepare_events_for_snowplow_pipeline(events=events, good=True, config=config),
+        'bad per event': lambda: [prepare_event_for_snowplow_pipeline(event=event, good=False, config=config,
+                                                                      event_errors=event_errors)
+                                  for event in events],
+        'bad per batch': lambda: prepare_events_for_snowplow_pipeline(events=events, good=False, config=config,
+                                                                      event_errors=event_errors),
+    }
+    for name, function in benchmarks.items():
+        best = best_time(function, args.runs)
+        print(f'{name:>16}: {args.events / best:>10.0f} events/s, {best * 1_000_000 / args.events:>6.1f} us/event')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
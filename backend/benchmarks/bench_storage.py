@@ -0,0 +1,80 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmark writing batches of events to the data table and to a queue, with multi-row insert statements
+versus COPY. For the data table the COPY path goes through a staging table, to be able to skip duplicates.
+
+Requires a Postgres database, configured with the usual POSTGRES_* environment variables. All inserts are
+rolled back, so the benchmark doesn't leave any data behind.
+"""
+import argparse
+import sys
+import time
+from typing import List
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.common.event_utils import add_global_context_to_event
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.schema.schema import CookieIdContext
+from objectiv_backend.workers import pg_queues, pg_storage
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+
+
+def get_events(event_count: int) -> EventDataList:
+    events = make_event_batch(event_count, seed=int(time.time()))
+    for i, event in enumerate(events):
+        cookie_id = f'00000000-0000-4000-8000-{i % 100:012d}'
+        add_global_context_to_event(event, CookieIdContext(id=cookie_id, cookie_id=cookie_id))
+    return events
+
+
+def insert_into_data(connection, events: EventDataList):
+    pg_storage.insert_events_into_data(connection, events)
+
+
+def put_on_queue(connection, events: EventDataList):
+    PostgresQueues(connection).put_events(ProcessingStage.FINALIZE, events)
+
+
+def time_insert(function, connection, events: EventDataList, batch_size: int, use_copy: bool) -> float:
+    """
+    Call function with batches of the events, in a single transaction that is rolled back.
+    Returns the seconds it took.
+    """
+    # Force the path that we want to measure, regardless of batch_size
+    copy_min_row_count = 0 if use_copy else len(events) + 1
+    pg_storage.COPY_MIN_ROW_COUNT = copy_min_row_count
+    pg_queues.COPY_MIN_ROW_COUNT = copy_min_row_count
+    start = time.perf_counter()
+    try:
+        for offset in range(0, len(events), batch_size):
+            function(connection, events[offset:offset + batch_size])
+        return time.perf_counter() - start
+    finally:
+        connection.rollback()
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark inserting events into the data table and queues')
+    parser.add_argument('--events', type=int, default=50_000, help='number of events per run')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[200, 1000, 10_000])
+    args = parser.parse_args(argv[1:])
+
+    pg_config = get_config_postgres()
+    assert pg_config is not None
+    connection = get_db_connection(pg_config)
+    events = get_events(args.events)
+    for function in (insert_into_data, put_on_queue):
+        for batch_size in args.batch_size:
+            insert_seconds = time_insert(function, connection, events, batch_size, use_copy=False)
+            copy_seconds = time_insert(function, connection, events, batch_size, use_copy=True)
+            print(f'{function.__name__:<16} batch size {batch_size:>6}: '
+                  f'insert {len(events) / insert_seconds:>8.0f} events/s, '
+                  f'copy {len(events) / copy_seconds:>8.0f} events/s')
+    connection.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,54 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmark the per-event schema validation, as done by the collector in process_events_entry().
+Compares the validation with precompiled validators to validating with jsonschema.validate(), which checks
+the schema and creates a new validator for every event and context.
+"""
+import argparse
+import sys
+import time
+from typing import List
+
+import jsonschema
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.schema.event_schemas import EventSchema
+from objectiv_backend.schema.validate_events import validate_event_adheres_to_schema
+
+
+def validate_uncompiled(event_schema: EventSchema, events: EventDataList):
+    """ Validate events and their contexts the way it was done before validators were precompiled. """
+    for event in events:
+        jsonschema.validate(instance=event, schema=event_schema.get_event_schema(event['_type']))
+        for context in event['global_contexts'] + event['location_stack']:
+            jsonschema.validate(instance=context, schema=event_schema.get_context_schema(context['_type']))
+
+
+def validate_compiled(event_schema: EventSchema, events: EventDataList):
+    for event in events:
+        errors = validate_event_adheres_to_schema(event_schema=event_schema, event=event)
+        assert not errors
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark event validation')
+    parser.add_argument('--events', type=int, default=2000, help='number of events per run')
+    parser.add_argument('--runs', type=int, default=3, help='number of runs; the best run is reported')
+    args = parser.parse_args(argv[1:])
+
+    event_schema = get_collector_config().event_schema
+    events = make_event_batch(args.events)
+    for name, function in ('uncompiled', validate_uncompiled), ('compiled', validate_compiled):
+        best = float('inf')
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            function(event_schema, events)
+            best = min(best, time.perf_counter() - start)
+        print(f'{name:>12}: {args.events / best:>10.0f} events/s')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
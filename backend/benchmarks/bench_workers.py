@@ -0,0 +1,76 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Benchmark the throughput of the async workers with different levels of concurrency.
+
+For each concurrency level, the entry queue is filled with events, after which the workers process the
+queues until they are empty. Requires a Postgres database, configured with the usual POSTGRES_*
+environment variables, with empty queues. The processed events are added to the data table.
+"""
+import argparse
+import sys
+import time
+from typing import List
+
+from benchmarks.events import make_event_batch
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.db import get_connection_pool
+from objectiv_backend.common.event_utils import add_global_context_to_event
+from objectiv_backend.schema.schema import CookieIdContext
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+from objectiv_backend.workers.util import run_concurrently, worker_run, AdaptiveBatchSize
+from objectiv_backend.workers.worker_entry import main_entry
+from objectiv_backend.workers.worker_finalize import main_finalize
+
+
+def drain_queues(max_batch: int, metrics_port: int = None) -> int:
+    """
+    Process events from both queues, until both are empty. Returns the summed number of events processed from
+    both queues. metrics_port is passed by run_concurrently(), and ignored.
+    """
+    entry_batch_size = AdaptiveBatchSize(max_size=max_batch)
+    finalize_batch_size = AdaptiveBatchSize(max_size=max_batch)
+    total = 0
+    while True:
+        event_count = worker_run(function=main_entry, batch_size=entry_batch_size)
+        event_count += worker_run(function=main_finalize, batch_size=finalize_batch_size)
+        total += event_count
+        if event_count == 0:
+            return total
+
+
+def fill_entry_queue(event_count: int):
+    events = make_event_batch(event_count, seed=int(time.time()))
+    for i, event in enumerate(events):
+        cookie_id = f'00000000-0000-4000-8000-{i % 100:012d}'
+        add_global_context_to_event(event, CookieIdContext(id=cookie_id, cookie_id=cookie_id))
+    pg_config = get_config_postgres()
+    assert pg_config is not None
+    with get_connection_pool(pg_config).connection() as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select (select count(*) from queue_entry) + (select count(*) from queue_finalize)')
+                if cursor.fetchone()[0]:
+                    raise Exception('Queues are not empty. Run this benchmark on a database with empty queues.')
+            PostgresQueues(connection=connection).put_events(queue=ProcessingStage.ENTRY, events=events)
+    get_connection_pool(pg_config).close()
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark async worker throughput')
+    parser.add_argument('--events', type=int, default=20_000, help='number of events per run')
+    parser.add_argument('--max-batch', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args(argv[1:])
+
+    for concurrency in args.concurrency:
+        fill_entry_queue(args.events)
+        start = time.perf_counter()
+        run_concurrently(drain_queues, concurrency=concurrency, max_batch=args.max_batch)
+        elapsed = time.perf_counter() - start
+        # the workers print per batch, so we print the results to stderr to be able to separate them
+        print(f'concurrency {concurrency}: {args.events / elapsed:>8.0f} events/s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
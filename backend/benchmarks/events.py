@@ -0,0 +1,96 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Generate realistic batches of events, as a tracker would send them, for use in benchmarks.
+"""
+import random
+import time
+import uuid
+from typing import List, Optional
+
+from objectiv_backend.common.types import EventData, EventDataList, ContextData
+
+# Location stacks as a typical web application would have them. The last context of each stack is the
+# element that the user interacted with.
+_LOCATION_STACKS: List[List[ContextData]] = [
+    [
+        {'_type': 'RootLocationContext', 'id': 'home'},
+        {'_type': 'NavigationContext', 'id': 'navigation'},
+        {'_type': 'LinkContext', 'id': 'docs', 'href': 'https://www.objectiv.io/docs'},
+    ],
+    [
+        {'_type': 'RootLocationContext', 'id': 'home'},
+        {'_type': 'ContentContext', 'id': 'main'},
+        {'_type': 'OverlayContext', 'id': 'modal'},
+        {'_type': 'PressableContext', 'id': 'close-modal'},
+    ],
+    [
+        {'_type': 'RootLocationContext', 'id': 'blog'},
+        {'_type': 'ContentContext', 'id': 'post'},
+        {'_type': 'ExpandableContext', 'id': 'comments'},
+        {'_type': 'PressableContext', 'id': 'show-more'},
+    ],
+]
+
+_INPUT_LOCATION_STACK: List[ContextData] = [
+    {'_type': 'RootLocationContext', 'id': 'signup'},
+    {'_type': 'ContentContext', 'id': 'form'},
+    {'_type': 'InputContext', 'id': 'email'},
+]
+
+_MEDIA_LOCATION_STACK: List[ContextData] = [
+    {'_type': 'RootLocationContext', 'id': 'home'},
+    {'_type': 'ContentContext', 'id': 'hero'},
+    {'_type': 'MediaPlayerContext', 'id': 'intro-video'},
+]
+
+_PATHS = [
+    'https://www.objectiv.io/',
+    'https://www.objectiv.io/docs/tracking',
+    'https://www.objectiv.io/blog/post?utm_source=newsletter&utm_medium=email&utm_campaign=launch',
+]
+
+
+def make_event(event_type: str, event_time: int, rnd: random.Random) -> EventData:
+    """ Create a single event of the given type, with realistic location stack and global contexts. """
+    if event_type == 'InputChangeEvent':
+        location_stack = _INPUT_LOCATION_STACK
+    elif event_type == 'MediaStartEvent':
+        location_stack = _MEDIA_LOCATION_STACK
+    elif event_type == 'ApplicationLoadedEvent':
+        location_stack = []
+    else:
+        location_stack = rnd.choice(_LOCATION_STACKS)
+    return {
+        '_type': event_type,
+        'id': str(uuid.UUID(int=rnd.getrandbits(128), version=4)),
+        'time': event_time,
+        'location_stack': [dict(context) for context in location_stack],
+        'global_contexts': [
+            {'_type': 'ApplicationContext', 'id': 'objectiv-website'},
+            {'_type': 'PathContext', 'id': rnd.choice(_PATHS)},
+            {
+                '_type': 'HttpContext',
+                'id': 'http_context',
+                'referrer': 'https://www.google.com/',
+                'user_agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:98.0) Gecko/20100101 Firefox/98.0',
+                'remote_address': '192.0.2.1'
+            }
+        ]
+    }
+
+
+def make_event_batch(count: int, current_millis: Optional[int] = None, seed: int = 0) -> EventDataList:
+    """
+    Create a list of events with a realistic mix of event types. All events are valid according to the
+    base schema, and have a time shortly before current_millis.
+    """
+    rnd = random.Random(seed)
+    if current_millis is None:
+        current_millis = round(time.time() * 1000)
+    event_types = ['PressEvent'] * 5 + ['VisibleEvent'] * 3 + ['InputChangeEvent', 'MediaStartEvent',
+                                                                 'ApplicationLoadedEvent']
+    return [
+        make_event(rnd.choice(event_types), current_millis - count + i, rnd)
+        for i in range(count)
+    ]
@@ -7,6 +7,13 @@
 # By default option 1 happens. Only if ASYNC_MODE=true and ASYNC_WORK_TYPE=worker does option two happen
 #
 
+# Compile the schema once, such that all processes load it from the artifact at startup, instead of each
+# compiling the schema files. Unless an artifact was specified.
+if [[ -z "$SCHEMA_ARTIFACT" ]]; then
+  export SCHEMA_ARTIFACT=/tmp/event_schema.json
+  objectiv-compile-schema --output "$SCHEMA_ARTIFACT" || exit 1
+fi;
+
 if [[ "$ASYNC_MODE" == "true" && "$ASYNC_WORKER_TYPE" == "worker" ]]; then
   echo "starting worker"
   objectiv-workers all --loop
@@ -1,28 +1,34 @@
 from flask import Flask
 from flask_cors import CORS
 
-from objectiv_backend.common.config import init_collector_config
+from objectiv_backend.common.config import init_collector_config, COLLECTOR_METRICS_ENDPOINT
 
 
 def create_app() -> Flask:
     from objectiv_backend.end_points import collector
+    from objectiv_backend.end_points import metrics
     from objectiv_backend.end_points import schema
 
     # load config - this will raise an error if there are configuration problems, and will cache the
     # result for later calls.
     init_collector_config()
+    # precompute the responses of the schema endpoints, they only depend on the config.
+    schema.init_schema_responses()
 
     flask_app = Flask(__name__, static_folder=None)  # type: ignore
     flask_app.add_url_rule(rule='/schema', view_func=schema.schema, methods=['GET'])
     flask_app.add_url_rule(rule='/jsonschema', view_func=schema.json_schema, methods=['GET'])
+    if COLLECTOR_METRICS_ENDPOINT:
+        flask_app.add_url_rule(rule='/metrics', view_func=metrics.metrics, methods=['GET'])
     flask_app.add_url_rule(rule='/', view_func=collector.collect, methods=['POST'])
+    flask_app.add_url_rule(rule='/bulk', view_func=collector.collect_bulk, methods=['POST'])
     init_cors(flask_app)
     return flask_app
 
 
 def init_cors(app: Flask):
     """ Initialize the flask CORS plugin. """
-    # We only have a single endpoint that ingests tracker data; the other endpoints only return data. We
+    # We only have two endpoints that ingest tracker data; the other endpoints only return data. We
     # are not afraid of any CSRF attacks, nor of people reusing our request-responses in other pages, and
     # we don't want to be strict in the origin of request. As such we don't have need for CORS protections,
     # and we can tell the browser to disable it altogether for this origin, coming from all origins.
@@ -0,0 +1,282 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+ASGI entry point of the collector. Run it with an ASGI server, e.g.:
+    uvicorn objectiv_backend.asgi:app
+
+The tracker endpoint (POST /) is handled by the event loop. The events are parsed, enriched and validated
+with the same code as the Flask app, in a thread of a bounded pool, after which all configured sinks are
+written to concurrently, each in a thread of that pool. At most ASGI_MAX_CONCURRENT_WRITES requests write at
+the same time, further requests wait until there is room. Requests are only answered after their events are
+written, so a slow sink slows down the clients, instead of letting work pile up in the collector. If writing
+to Postgres fails, the request fails with a 500 response, so that the tracker retries it.
+
+All other requests are passed on to the Flask app, in a thread.
+"""
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import flask
+from flask import Flask, Response
+from werkzeug.exceptions import InternalServerError
+from werkzeug.wrappers import Response as BaseResponse
+
+import objectiv_backend.app
+from objectiv_backend.common.config import get_collector_config, ASGI_MAX_CONCURRENT_WRITES, \
+    ASGI_WRITER_THREADS
+from objectiv_backend.common.metrics import SINK_ERRORS
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.end_points import collector
+from objectiv_backend.schema.validate_events import EventError
+from objectiv_backend.workers.worker_entry import process_events_entry
+
+# Sinks that must succeed before the events are acknowledged. The events are lost if they fail, while the
+# other sinks are best-effort.
+_REQUIRED_SINKS = ('postgres', )
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+
+class CollectorApp:
+    """
+    ASGI application, see the module documentation.
+    """
+
+    def __init__(self, flask_app: Flask,
+                 max_concurrent_writes: int = ASGI_MAX_CONCURRENT_WRITES,
+                 writer_threads: int = ASGI_WRITER_THREADS):
+        """
+        :param flask_app: Flask app of the collector, see objectiv_backend.app.create_app()
+        :param max_concurrent_writes: maximum number of requests that write to the sinks at the same time
+        :param writer_threads: number of threads that write to the sinks
+        """
+        self.flask_app = flask_app
+        self.max_concurrent_writes = max_concurrent_writes
+        self.executor = ThreadPoolExecutor(max_workers=writer_threads, thread_name_prefix='collector-writer')
+        # Created on first use, as it has to be created on the event loop that is running the app
+        self._write_semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] != 'http':
+            raise ValueError(f'Unsupported scope type: {scope["type"]}')
+        elif scope['method'] == 'POST' and scope['path'] == '/':
+            await self._collect(scope, receive, send)
+        else:
+            await self._call_flask_app(scope, receive, send)
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _collect(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Asynchronous version of collector.collect()
+        """
+        current_millis = round(time.time() * 1000)
+        # Read one byte more than allowed, so _get_event_data() can tell that the data is too big
+        body = await _read_body(receive, max_size=collector.DATA_MAX_SIZE_BYTES + 1)
+        environ = _get_environ(scope, io.BytesIO(body))
+        # Parsing and validating the events is CPU-bound, so it's done in the executor, to not block the
+        # other requests on the event loop.
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(self.executor, self._prepare, environ, current_millis)
+        if isinstance(prepared, Response):
+            await _send_response(send, prepared, environ)
+            return
+
+        writers, event_count, error_count, event_errors = prepared
+        if not await self._write(writers):
+            await _send_response(send, InternalServerError().get_response(environ), environ)
+            return
+
+        with self.flask_app.request_context(environ):
+            response = collector._get_collector_response(
+                error_count=error_count, event_count=event_count, event_errors=event_errors)
+            await _send_response(send, self.flask_app.process_response(response), environ)
+
+    def _prepare(self, environ: Dict[str, Any], current_millis: int) \
+            -> Union[Response, Tuple[List[Callable[[], None]], int, int, List[EventError]]]:
+        """
+        Parse, enrich and validate the events of the request, and get the writers for them. Runs in the executor.
+        :return: the response, if the data cannot be parsed. Otherwise a tuple: the writers, the number of
+            events, the number of events that are not ok, and the errors of those events.
+        """
+        with self.flask_app.request_context(environ):
+            try:
+                event_data = collector._get_event_data(flask.request)
+                events: EventDataList = event_data['events']
+                transport_time: int = event_data['transport_time']
+            except ValueError as exc:
+                print(f'Data problem: {exc}')  # todo: real error logging
+                response = collector._get_collector_response(
+                    error_count=1, event_count=-1, data_error=exc.__str__())
+                return self.flask_app.process_response(response)
+
+            # Same steps as collector._process_events(), but we write to the sinks concurrently
+            collector.add_enriched_contexts(events)
+            collector.set_time_in_events(events, current_millis, transport_time)
+            if not get_collector_config().async_mode:
+                ok_events, nok_events, event_errors = process_events_entry(
+                    events=events, current_millis=current_millis)
+                print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
+                writers = collector.get_sync_writers(
+                    ok_events=ok_events, nok_events=nok_events, event_errors=event_errors)
+                return writers, len(events), len(nok_events), event_errors
+            return collector.get_async_writers(events=events), len(events), 0, []
+
+    async def _write(self, writers: List[Callable[[], None]]) -> bool:
+        """
+        Call the writers concurrently in the executor, and wait till they are all done. Failures of the
+        best-effort sinks (files, S3, Snowplow) are counted and logged.
+        :return: False if writing to one of the _REQUIRED_SINKS failed. The client should then retry, as with a
+            failed request to the Flask app.
+        """
+        if self._write_semaphore is None:
+            self._write_semaphore = asyncio.Semaphore(self.max_concurrent_writes)
+        loop = asyncio.get_running_loop()
+        async with self._write_semaphore:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self.executor, writer) for writer in writers),
+                return_exceptions=True)
+        success = True
+        for writer, result in zip(writers, results):
+            if isinstance(result, Exception):
+                # writers are partials of functions like _write_sync_events_to_postgres
+                sink = getattr(writer, 'func', writer).__name__.rsplit('_', 1)[-1]
+                SINK_ERRORS.inc(labels=(sink,))
+                print(f'Error writing events: {result!r}')
+                if sink in _REQUIRED_SINKS:
+                    success = False
+        return success
+
+    async def _call_flask_app(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """ Let the Flask app handle the request, in a thread. """
+        loop = asyncio.get_running_loop()
+        environ = _get_environ(scope, _ReceiveStream(receive, loop))
+
+        def call_flask_app() -> Tuple[str, List[Tuple[str, str]], bytes]:
+            started: List[Any] = []
+
+            def start_response(status, headers, exc_info=None):
+                started[:] = [status, headers]
+
+            result = self.flask_app(environ, start_response)
+            try:
+                body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            return started[0], started[1], body
+
+        status, headers, body = await loop.run_in_executor(None, call_flask_app)
+        await _send(send, int(status.split(' ', 1)[0]), headers, body)
+
+
+class _ReceiveStream(io.RawIOBase):
+    """
+    Readable stream of the request body, for use as wsgi.input in a thread that's not running the event loop.
+    """
+
+    def __init__(self, receive: Receive, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more_body = True
+
+    def readable(self) -> bool:
+        return True
+
+    async def _next_message(self) -> Message:
+        return await self._receive()
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._next_message(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise IOError('Client disconnected')
+            self._buffer = message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+async def _read_body(receive: Receive, max_size: int) -> bytes:
+    """ Read the request body, but not more than max_size bytes. """
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body and size < max_size:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        chunks.append(chunk)
+        size += len(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)[:max_size]
+
+
+def _get_environ(scope: Scope, body: io.IOBase) -> Dict[str, Any]:
+    """ Create a WSGI environment for the given ASGI http scope. """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The body stream ends at the end of the request, also if there is no Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _send_response(send: Send, response: BaseResponse, environ: Dict[str, Any]) -> None:
+    headers = response.get_wsgi_headers(environ).to_wsgi_list()
+    await _send(send, response.status_code, headers, response.get_data())
+
+
+async def _send(send: Send, status: int, headers: List[Tuple[str, str]], body: bytes) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app = CollectorApp(objectiv_backend.app.app)
@@ -3,21 +3,38 @@ Copyright 2021 Objectiv B.V.
 """
 
 import os
-from typing import NamedTuple, Optional
+from typing import Any, NamedTuple, Optional
 
 # All settings that are controlled through environment variables are listed at the top here, for a
 # complete overview.
 # These settings should not be accessed by the constants here, but through the functions defined
 # below (e.g. get_config_output())
-from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema, \
+    compile_json_schema_validator
+from objectiv_backend.schema.schema_artifact import load_event_schema_artifact
 from objectiv_backend.common.types import EventListSchema
 
 LOAD_BASE_SCHEMA = os.environ.get('LOAD_BASE_SCHEMA', 'true') == 'true'
 SCHEMA_EXTENSION_DIRECTORY = os.environ.get('SCHEMA_EXTENSION_DIRECTORY')
+# Optional path of a compiled schema, created with objectiv-compile-schema. If it matches the schema files,
+# the schema is loaded from it, which is much faster than compiling it from the schema files.
+SCHEMA_ARTIFACT = os.environ.get('SCHEMA_ARTIFACT')
 
 # when set to true, the collector will return detailed validation errors per event
 SCHEMA_VALIDATION_ERROR_REPORTING = os.environ.get('SCHEMA_VALIDATION_ERROR_REPORTING', 'false') == 'true'
 
+# Time in seconds that clients and proxies may cache the responses of the /schema and /jsonschema endpoints,
+# without revalidating them.
+SCHEMA_CACHE_MAX_AGE = int(os.environ.get('SCHEMA_CACHE_MAX_AGE', '300'))
+
+# Whether the collector serves its metrics on /metrics. Off by default, as the collector is publicly
+# reachable; the metrics of the workers are served on a separate port (--metrics-port) instead.
+COLLECTOR_METRICS_ENDPOINT = os.environ.get('COLLECTOR_METRICS_ENDPOINT', 'false') == 'true'
+
+# json library used to serialize and parse events: 'orjson', 'json' (standard library), or 'auto' to use
+# orjson if it is installed and the standard library otherwise.
+JSON_SERIALIZER = os.environ.get('JSON_SERIALIZER', 'auto')
+
 # Number of ms before an event is considered too old. set to 0 to disable
 MAX_DELAYED_EVENTS_MILLIS = 1000 * 3600
 
@@ -32,6 +49,21 @@ _PG_PORT = os.environ.get('POSTGRES_PORT', '5432')
 _PG_DATABASE_NAME = os.environ.get('POSTGRES_DB', 'objectiv')
 _PG_USER = os.environ.get('POSTGRES_USER', 'objectiv')
 _PG_PASSWORD = os.environ.get('POSTGRES_PASSWORD', '')
+# Every process (i.e. each gunicorn worker, or each async worker) keeps its own pool of connections.
+_PG_POOL_MIN_SIZE = os.environ.get('POSTGRES_POOL_MIN_SIZE', '1')
+_PG_POOL_MAX_SIZE = os.environ.get('POSTGRES_POOL_MAX_SIZE', '10')
+# Whether the data table is partitioned by day. Must match the layout that db_init created.
+_PG_PARTITION_DATA = os.environ.get('POSTGRES_PARTITION_DATA', 'false') == 'true'
+# Whether the data table has the typed layout: value as jsonb, plus typed columns. Must match the layout that
+# db_init created.
+_PG_TYPED_DATA = os.environ.get('POSTGRES_TYPED_DATA', 'false') == 'true'
+# Whether db_init creates a GIN index on the value column of the data table. Requires POSTGRES_TYPED_DATA.
+_PG_DATA_GIN_INDEX = os.environ.get('POSTGRES_DATA_GIN_INDEX', 'false') == 'true'
+# Whether db_init creates the queue tables unlogged.
+_PG_UNLOGGED_QUEUES = os.environ.get('POSTGRES_UNLOGGED_QUEUES', 'false') == 'true'
+# Group commit of the collector's writes, see PostgresConfig. Disabled by default.
+_PG_WRITE_BUFFER_MILLIS = os.environ.get('POSTGRES_WRITE_BUFFER_MILLIS', '0')
+_PG_WRITE_BUFFER_MAX_EVENTS = os.environ.get('POSTGRES_WRITE_BUFFER_MAX_EVENTS', '1000')
 
 # ### AWS S3 values, for writing data to S3.
 # default access keys to an empty string, otherwise the boto library will default ot user defaults.
@@ -41,10 +73,23 @@ _AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
 _AWS_REGION = os.environ.get('AWS_REGION', 'eu-west-1')
 _AWS_BUCKET = os.environ.get('AWS_BUCKET', '')
 _AWS_S3_PREFIX = os.environ.get('AWS_S3_PREFIX', '')
+# Optional endpoint, for S3 compatible storage other than AWS, e.g. MinIO or localstack
+_AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL', '')
+# 'json' uploads an object per request, 'ndjson' collects events in bigger objects. See AwsOutputConfig
+_AWS_S3_OUTPUT_FORMAT = os.environ.get('AWS_S3_OUTPUT_FORMAT', 'json')
+_AWS_S3_OBJECT_MAX_BYTES = os.environ.get('AWS_S3_OBJECT_MAX_BYTES', str(64 * 1024 * 1024))
+_AWS_S3_OBJECT_MAX_SECONDS = os.environ.get('AWS_S3_OBJECT_MAX_SECONDS', '300')
 
 # ### Setting for outputting data to the filesystem
 _OUTPUT_ENABLE_FILESYSTEM = os.environ.get('OUTPUT_ENABLE_FILESYSTEM', '') == 'true'
 _FILESYSTEM_OUTPUT_DIR = os.environ.get('FILESYSTEM_OUTPUT_DIR')
+# Format of the files: 'json' writes a file per request, 'ndjson' and 'parquet' append to rolling segments.
+# See FileSystemOutputConfig
+_FILESYSTEM_OUTPUT_FORMAT = os.environ.get('FILESYSTEM_OUTPUT_FORMAT', 'json')
+_FILESYSTEM_COMPRESSION = os.environ.get('FILESYSTEM_COMPRESSION', 'gzip')
+_FILESYSTEM_SEGMENT_MAX_BYTES = os.environ.get('FILESYSTEM_SEGMENT_MAX_BYTES', str(128 * 1024 * 1024))
+_FILESYSTEM_SEGMENT_MAX_SECONDS = os.environ.get('FILESYSTEM_SEGMENT_MAX_SECONDS', '300')
+_FILESYSTEM_FSYNC = os.environ.get('FILESYSTEM_FSYNC', 'rotate')
 
 # ### Snowplow settings
 _SP_SCHEMA_COLLECTOR_PAYLOAD = 'iglu:com.snowplowanalytics.snowplow/CollectorPayload/thrift/1-0-0'
@@ -71,8 +116,24 @@ _OBJ_COOKIE_SECURE = bool(os.environ.get('COOKIE_SECURE', False))
 
 # Maximum number of events that a worker will process in a single batch. Only relevant in async mode
 WORKER_BATCH_SIZE = 200
-# Time to sleep, if there is no work to do for the workers. Only relevant in async mode
+# When running in a loop, the workers decrease the batch size if the queues are nearly empty, but not below
+# this value. Only relevant in async mode
+WORKER_MIN_BATCH_SIZE = 10
+# Maximum time to wait for new events, if there is no work to do for the workers. Workers are woken up
+# earlier if events are put on their queue. Only relevant in async mode
 WORKER_SLEEP_SECONDS = 5
+# If the data table is partitioned, partitions are created up to this number of days in the future. Events
+# for days without a partition end up in the default partition.
+DATA_PARTITION_DAYS_AHEAD = 7
+# Maximum time between two consecutive events of a cookie that belong to the same session, see the sessions
+# table in create_tables.sql. After changing this, the sessions table must be rebuilt with
+# `objectiv-db-init --rebuild-sessions`.
+SESSION_GAP_SECONDS = int(os.environ.get('SESSION_GAP_SECONDS', '1800'))
+
+# Settings of the ASGI collector (objectiv_backend.asgi). Maximum number of requests that write events to the
+# outputs at the same time, further requests wait. And the number of threads that write to the outputs.
+ASGI_MAX_CONCURRENT_WRITES = int(os.environ.get('ASGI_MAX_CONCURRENT_WRITES', '64'))
+ASGI_WRITER_THREADS = int(os.environ.get('ASGI_WRITER_THREADS', '10'))
 
 
 class AwsOutputConfig(NamedTuple):
@@ -81,10 +142,27 @@ class AwsOutputConfig(NamedTuple):
     region: str
     bucket: str
     s3_prefix: str
+    endpoint_url: Optional[str] = None
+    # 'json': an object with a json list per request. 'ndjson': gzipped objects with a json object per line,
+    # per prefix and hour, completed once they are object_max_bytes big or object_max_seconds old. See
+    # BufferedS3Writer
+    file_format: str = 'json'
+    object_max_bytes: int = 64 * 1024 * 1024
+    object_max_seconds: float = 300
 
 
 class FileSystemOutputConfig(NamedTuple):
     path: str
+    # 'json': a file with a json list per request. 'ndjson' or 'parquet': rolling segments, with an event per
+    # line or row, see RollingFileWriter
+    file_format: str = 'json'
+    # compression of the segments: 'gzip', 'zstd' or 'none'
+    compression: str = 'gzip'
+    # a segment is completed once it is this big, or once it has been open this long
+    segment_max_bytes: int = 128 * 1024 * 1024
+    segment_max_seconds: float = 300
+    # when to fsync segments: 'none', 'rotate' (before a segment is completed) or 'always' (after every write)
+    fsync: str = 'rotate'
 
 
 class PostgresConfig(NamedTuple):
@@ -93,6 +171,24 @@ class PostgresConfig(NamedTuple):
     database_name: str
     user: str
     password: str
+    # minimum number of connections that the connection pool keeps open
+    pool_min_size: int = 1
+    # maximum number of connections that the connection pool opens. If all are in use, a request for a
+    # connection will block until one is available again.
+    pool_max_size: int = 10
+    # whether the data table is partitioned by day, see create_tables_partitioned.sql
+    partition_data: bool = False
+    # whether the data table has the typed layout, see create_tables_typed.sql
+    typed_data: bool = False
+    # whether the value column of the data table has a GIN index. Only used by db_init.
+    data_gin_index: bool = False
+    # whether the queue tables are unlogged: faster, but the queued events are lost if the database crashes.
+    # Only used by db_init.
+    unlogged_queues: bool = False
+    # If not 0, the collector combines the writes of concurrent requests into a single transaction. A write
+    # waits at most this many milliseconds, or until write_buffer_max_events events are waiting.
+    write_buffer_millis: int = 0
+    write_buffer_max_events: int = 1000
 
 
 class SnowplowConfig(NamedTuple):
@@ -142,21 +238,31 @@ class CollectorConfig(NamedTuple):
     output: OutputConfig
     event_schema: EventSchema
     event_list_schema: EventListSchema
+    # compiled json-schema validators for event_list_schema, and for its non-deep variant.
+    # See get_event_list_schema()
+    event_list_validator: Any
+    event_list_validator_fast: Any
 
 
 def get_config_output_aws() -> Optional[AwsOutputConfig]:
     if not _OUTPUT_ENABLE_AWS:
         return None
-    if _AWS_REGION and _AWS_ACCESS_KEY_ID and _AWS_SECRET_ACCESS_KEY and _AWS_BUCKET and _AWS_S3_PREFIX:
+    if not (_AWS_REGION and _AWS_ACCESS_KEY_ID and _AWS_SECRET_ACCESS_KEY and _AWS_BUCKET and _AWS_S3_PREFIX):
         raise ValueError(f'OUTPUT_ENABLE_AWS = true, but not all required values specified. '
                          f'Must specify AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_BUCKET, '
                          f'and AWS_S3_PREFIX')
+    if _AWS_S3_OUTPUT_FORMAT not in ('json', 'ndjson'):
+        raise ValueError(f'Invalid AWS_S3_OUTPUT_FORMAT: {_AWS_S3_OUTPUT_FORMAT}. Must be json or ndjson')
     return AwsOutputConfig(
         access_key_id=_AWS_ACCESS_KEY_ID,
         secret_access_key=_AWS_SECRET_ACCESS_KEY,
         region=_AWS_REGION,
         bucket=_AWS_BUCKET,
-        s3_prefix=_AWS_S3_PREFIX
+        s3_prefix=_AWS_S3_PREFIX,
+        endpoint_url=_AWS_S3_ENDPOINT_URL or None,
+        file_format=_AWS_S3_OUTPUT_FORMAT,
+        object_max_bytes=int(_AWS_S3_OBJECT_MAX_BYTES),
+        object_max_seconds=float(_AWS_S3_OBJECT_MAX_SECONDS)
     )
 
 
@@ -165,7 +271,21 @@ def get_config_output_file_system() -> Optional[FileSystemOutputConfig]:
         return None
     if not _FILESYSTEM_OUTPUT_DIR:
         raise ValueError('OUTPUT_ENABLE_FILESYSTEM = true, but FILESYSTEM_OUTPUT_DIR not specified.')
-    return FileSystemOutputConfig(path=_FILESYSTEM_OUTPUT_DIR)
+    if _FILESYSTEM_OUTPUT_FORMAT not in ('json', 'ndjson', 'parquet'):
+        raise ValueError(f'Invalid FILESYSTEM_OUTPUT_FORMAT: {_FILESYSTEM_OUTPUT_FORMAT}. '
+                         f'Must be json, ndjson or parquet')
+    if _FILESYSTEM_COMPRESSION not in ('gzip', 'zstd', 'none'):
+        raise ValueError(f'Invalid FILESYSTEM_COMPRESSION: {_FILESYSTEM_COMPRESSION}. Must be gzip, zstd or none')
+    if _FILESYSTEM_FSYNC not in ('none', 'rotate', 'always'):
+        raise ValueError(f'Invalid FILESYSTEM_FSYNC: {_FILESYSTEM_FSYNC}. Must be none, rotate or always')
+    return FileSystemOutputConfig(
+        path=_FILESYSTEM_OUTPUT_DIR,
+        file_format=_FILESYSTEM_OUTPUT_FORMAT,
+        compression=_FILESYSTEM_COMPRESSION,
+        segment_max_bytes=int(_FILESYSTEM_SEGMENT_MAX_BYTES),
+        segment_max_seconds=float(_FILESYSTEM_SEGMENT_MAX_SECONDS),
+        fsync=_FILESYSTEM_FSYNC
+    )
 
 
 def get_config_postgres() -> Optional[PostgresConfig]:
@@ -174,12 +294,25 @@ def get_config_postgres() -> Optional[PostgresConfig]:
     if not _PG_HOSTNAME or not _PG_PORT or not _PG_DATABASE_NAME or not _PG_USER:
         raise ValueError(f'OUTPUT_ENABLE_PG = true, but not all required values specified. '
                          f'Must specify PG_HOSTNAME, PG_PORT, PG_DATABASE_NAME, PG_USER, and PG_PASSWORD')
+    if not 0 <= int(_PG_POOL_MIN_SIZE) <= int(_PG_POOL_MAX_SIZE) or int(_PG_POOL_MAX_SIZE) < 1:
+        raise ValueError(f'Invalid connection pool size. Must have 0 <= POSTGRES_POOL_MIN_SIZE <= '
+                         f'POSTGRES_POOL_MAX_SIZE, and POSTGRES_POOL_MAX_SIZE >= 1')
+    if _PG_DATA_GIN_INDEX and not _PG_TYPED_DATA:
+        raise ValueError('POSTGRES_DATA_GIN_INDEX = true requires POSTGRES_TYPED_DATA = true')
     return PostgresConfig(
         hostname=_PG_HOSTNAME,
         port=int(_PG_PORT),
         database_name=_PG_DATABASE_NAME,
         user=_PG_USER,
-        password=_PG_PASSWORD
+        password=_PG_PASSWORD,
+        pool_min_size=int(_PG_POOL_MIN_SIZE),
+        pool_max_size=int(_PG_POOL_MAX_SIZE),
+        partition_data=_PG_PARTITION_DATA,
+        typed_data=_PG_TYPED_DATA,
+        data_gin_index=_PG_DATA_GIN_INDEX,
+        unlogged_queues=_PG_UNLOGGED_QUEUES,
+        write_buffer_millis=int(_PG_WRITE_BUFFER_MILLIS),
+        write_buffer_max_events=int(_PG_WRITE_BUFFER_MAX_EVENTS)
     )
 
 
@@ -244,11 +377,15 @@ def get_config_cookie() -> CookieConfig:
 
 
 def get_config_event_schema() -> EventSchema:
+    if SCHEMA_ARTIFACT:
+        event_schema = load_event_schema_artifact(SCHEMA_ARTIFACT, SCHEMA_EXTENSION_DIRECTORY)
+        if event_schema is not None:
+            return event_schema
     return get_event_schema(SCHEMA_EXTENSION_DIRECTORY)
 
 
-def get_config_event_list_schema() -> EventListSchema:
-    return get_event_list_schema()
+def get_config_event_list_schema(event_schema: EventSchema, deep: bool = True) -> EventListSchema:
+    return get_event_list_schema(event_schema=event_schema, deep=deep)
 
 
 def get_config_timestamp_validation() -> TimestampValidationConfig:
@@ -263,13 +400,18 @@ _CACHED_COLLECTOR_CONFIG: Optional[CollectorConfig] = None
 def init_collector_config():
     """ Load collector config into cache. """
     global _CACHED_COLLECTOR_CONFIG
+    event_schema = get_config_event_schema()
+    event_list_schema = get_config_event_list_schema(event_schema)
     _CACHED_COLLECTOR_CONFIG = CollectorConfig(
         async_mode=_ASYNC_MODE,
         cookie=get_config_cookie(),
         error_reporting=SCHEMA_VALIDATION_ERROR_REPORTING,
         output=get_config_output(),
-        event_schema=get_config_event_schema(),
-        event_list_schema=get_config_event_list_schema()
+        event_schema=event_schema,
+        event_list_schema=event_list_schema,
+        event_list_validator=compile_json_schema_validator(event_list_schema),
+        event_list_validator_fast=compile_json_schema_validator(
+            get_config_event_list_schema(event_schema, deep=False))
     )
 
 
@@ -1,11 +1,29 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple, Iterator
+
 import psycopg2
 from psycopg2 import extras
-from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, TRANSACTION_STATUS_IDLE
 
 from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.metrics import POOL_CONNECTIONS, POOL_CHECKOUTS, POOL_WAIT_SECONDS, POOL_CONNECTS, \
+    POOL_DISCARDS
+from objectiv_backend.common.serialization import json_loads
+
+# If a connection has been idle in the pool for longer than this, we check that it is still alive before
+# handing it out.
+POOL_HEALTH_CHECK_IDLE_SECONDS = 30
+
+# Batches of at least this many rows are loaded with copy_rows() instead of with multi-row insert
+# statements. For small batches the overhead of the extra statements that COPY needs is not worth it.
+COPY_MIN_ROW_COUNT = 500
 
 
 def get_db_connection(pg_config: PostgresConfig):
@@ -14,6 +32,7 @@ def get_db_connection(pg_config: PostgresConfig):
      * read committed isolation level
      * 5 second lock_timeout
      * uuids enabled.
+     * json values parsed with json_loads()
     """
     conn = psycopg2.connect(user=pg_config.user,
                             password=pg_config.password,
@@ -29,5 +48,230 @@ def get_db_connection(pg_config: PostgresConfig):
     # than 5 seconds, something is wrong.
     with conn.cursor() as cursor:
         cursor.execute("set lock_timeout='5s';")
+    conn.commit()
     extras.register_uuid()
+    extras.register_default_json(globally=True, loads=json_loads)
+    extras.register_default_jsonb(globally=True, loads=json_loads)
     return conn
+
+
+def copy_rows(cursor, table_name: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]):
+    """
+    Bulk load rows into a table with a single `COPY ... FROM STDIN` command. This is much faster than
+    inserting many rows with insert statements, but COPY has no equivalent of 'on conflict', so the caller
+    must make sure no constraints are violated, e.g. by copying into a staging table first.
+
+    The rows are sent in Postgres' text format. Values are converted with str(), None values are loaded as
+    null.
+    :param cursor: psycopg2 cursor
+    :param table_name: table to load the rows into
+    :param columns: columns to load, in the same order as the values in each row
+    :param rows: rows to load
+    """
+    # The text format is considerably cheaper to produce than csv: json values contain many double quotes,
+    # which csv would all need to escape.
+    data = ''.join('\t'.join([_copy_text_value(value) for value in row]) + '\n' for row in rows)
+    cursor.copy_expert(f'copy {table_name}({", ".join(columns)}) from stdin', io.StringIO(data))
+
+
+def _copy_text_value(value: Any) -> str:
+    """ Format a value for the text format of COPY, see https://www.postgresql.org/docs/13/sql-copy.html """
+    if value is None:
+        return '\\N'
+    text = str(value)
+    # Most values don't contain any special characters, checking is much cheaper than always replacing
+    if '\\' in text or '\t' in text or '\n' in text or '\r' in text:
+        text = text \
+            .replace('\\', '\\\\') \
+            .replace('\t', '\\t') \
+            .replace('\n', '\\n') \
+            .replace('\r', '\\r')
+    return text
+
+
+class PoolStats(NamedTuple):
+    # number of times a connection was handed out
+    checkouts: int
+    # total time spent waiting for a free connection, in seconds
+    wait_seconds: float
+    # number of connections that were opened, including the initial connections
+    connects: int
+    # number of connections that were discarded because they were broken
+    discards: int
+    # number of connections currently open, both idle and in use
+    size: int
+    # number of connections currently in use
+    in_use: int
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived connections, as delivered by get_db_connection().
+
+    Use connection() to borrow a connection. Connections are checked for liveness before they are handed out,
+    and broken connections are discarded and replaced by fresh ones, so a restart of the database doesn't
+    require a restart of the process.
+
+    The pool does not do any transaction management. A connection that is returned while a transaction is
+    still open is rolled back.
+    """
+
+    def __init__(self, pg_config: PostgresConfig):
+        """
+        Create a new pool, and open pg_config.pool_min_size connections.
+        :param pg_config: connection settings and pool sizes
+        """
+        self._pg_config = pg_config
+        self._max_size = pg_config.pool_max_size
+        self._slots = threading.BoundedSemaphore(self._max_size)
+        self._lock = threading.Lock()
+        # idle connections with the time they were returned to the pool. Used as a stack, such that the
+        # most recently used connections are reused first.
+        self._idle: List[Tuple[object, float]] = []
+        self._size = 0
+        self._checkouts = 0
+        self._wait_seconds = 0.0
+        self._connects = 0
+        self._discards = 0
+        for _ in range(pg_config.pool_min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        connection = get_db_connection(self._pg_config)
+        with self._lock:
+            self._size += 1
+            self._connects += 1
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._size -= 1
+            self._discards += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    @staticmethod
+    def _is_alive(connection) -> bool:
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('select 1')
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _pop_idle_or_connect(self):
+        """ Get a live idle connection, or if there is none open a new connection. """
+        while True:
+            with self._lock:
+                idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                return self._connect()
+            connection, returned_at = idle
+            if connection.closed or (time.monotonic() - returned_at > POOL_HEALTH_CHECK_IDLE_SECONDS
+                                     and not self._is_alive(connection)):
+                self._discard(connection)
+                continue
+            return connection
+
+    def checkout(self):
+        """
+        Get a connection from the pool. Blocks if all connections are in use.
+        The connection must be given back with checkin().
+        """
+        start = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - start
+        try:
+            connection = self._pop_idle_or_connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._checkouts += 1
+            self._wait_seconds += waited
+        return connection
+
+    def checkin(self, connection, broken: bool = False):
+        """
+        Give a connection, that was obtained with checkout(), back to the pool.
+        :param connection: the connection
+        :param broken: If True, the connection is closed instead of reused.
+        """
+        try:
+            if not broken and not connection.closed \
+                    and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            broken = True
+        if broken or connection.closed:
+            self._discard(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Context manager that borrows a connection from the pool, and gives it back on exit.
+        If the connection got lost while it was borrowed, it will be replaced by a new connection.
+        """
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def get_stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                checkouts=self._checkouts,
+                wait_seconds=self._wait_seconds,
+                connects=self._connects,
+                discards=self._discards,
+                size=self._size,
+                in_use=self._size - len(self._idle)
+            )
+
+
+# Pools are per process. We remember the pid of the process that created the pools, such that a forked
+# process (e.g. a gunicorn worker) doesn't share connections with its parent.
+_POOLS: Dict[PostgresConfig, ConnectionPool] = {}
+_POOLS_PID = os.getpid()
+_POOLS_LOCK = threading.Lock()
+
+
+def get_connection_pool(pg_config: PostgresConfig) -> ConnectionPool:
+    """ Get the connection pool for the given config for this process, create it if it doesn't exist yet. """
+    global _POOLS, _POOLS_PID
+    with _POOLS_LOCK:
+        if _POOLS_PID != os.getpid():
+            _POOLS = {}
+            _POOLS_PID = os.getpid()
+        if pg_config not in _POOLS:
+            _POOLS[pg_config] = ConnectionPool(pg_config)
+        return _POOLS[pg_config]
+
+
+def update_pool_metrics(pg_config: PostgresConfig):
+    """ Set the metrics of the connection pool for the given config to its current PoolStats. """
+    stats = get_connection_pool(pg_config).get_stats()
+    POOL_CONNECTIONS.set(stats.size - stats.in_use, labels=('idle',))
+    POOL_CONNECTIONS.set(stats.in_use, labels=('in_use',))
+    POOL_CHECKOUTS.set_total(stats.checkouts)
+    POOL_WAIT_SECONDS.set_total(stats.wait_seconds)
+    POOL_CONNECTS.set_total(stats.connects)
+    POOL_DISCARDS.set_total(stats.discards)
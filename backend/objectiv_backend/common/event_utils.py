@@ -1,37 +1,78 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-from typing import Optional, List, cast
+from typing import Optional, List, Dict, Iterator, cast
 
 from objectiv_backend.common.types import EventData, ContextData, ContextType
 from objectiv_backend.schema.schema import AbstractGlobalContext
 
 
+class ContextIndex:
+    """
+    Index of the contexts of a single event by type, such that finding the contexts of a type is a dict
+    lookup, instead of a scan over all contexts.
+
+    Create the index once per event, and use it for all lookups on that event. To keep the index up to date,
+    add contexts with add_global_context_to_event(event, context, index).
+    A context is indexed under its `_type`, and under all types in its `_types` if the event is hydrated.
+    """
+
+    def __init__(self, event: EventData):
+        self._global_contexts: Dict[ContextType, List[ContextData]] = {}
+        self._location_contexts: Dict[ContextType, List[ContextData]] = {}
+        for context in get_global_contexts(event):
+            self._add(self._global_contexts, context)
+        for context in get_location_stack(event):
+            self._add(self._location_contexts, context)
+
+    @staticmethod
+    def _add(index: Dict[ContextType, List[ContextData]], context: ContextData):
+        context_type = cast(ContextType, context.get('_type'))
+        index.setdefault(context_type, []).append(context)
+        for parent_type in cast(List[ContextType], context.get('_types', ())):
+            if parent_type != context_type:
+                index.setdefault(parent_type, []).append(context)
+
+    def add_global_context(self, context: ContextData):
+        """ Add a context that was appended to the event's global contexts to the index. """
+        self._add(self._global_contexts, context)
+
+    def get_optional_context(self, context_type: ContextType) -> Optional[ContextData]:
+        """ Get the first Context of the given type, or None if there is none. """
+        contexts = self._global_contexts.get(context_type) or self._location_contexts.get(context_type)
+        if not contexts:
+            return None
+        return contexts[0]
+
+    def get_contexts(self, context_type: ContextType) -> List[ContextData]:
+        """ Give all the Contexts of the given type, global contexts first. """
+        return self._global_contexts.get(context_type, []) + self._location_contexts.get(context_type, [])
+
+
 def get_optional_context(event: EventData, context_type: ContextType) -> Optional[ContextData]:
     """ Get the first Context of the given type, or None if there is none. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
-        return None
-    return result[0]
+    return next(_iter_contexts(event=event, context_type=context_type), None)
 
 
 def get_context(event: EventData, context_type: ContextType) -> ContextData:
     """ Get the first Context of the given type. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
+    result = get_optional_context(event=event, context_type=context_type)
+    if result is None:
         raise ValueError(f'context-type {context_type} not present in event. data: {event}')
-    return result[0]
+    return result
 
 
 def get_contexts(event: EventData, context_type: ContextType) -> List[ContextData]:
     """ Given all the Contexts of the given type."""
-    contexts = get_global_contexts(event) + get_location_stack(event)
-    result = []
-    for context in contexts:
-        _contexts_types = cast(List[ContextType], context.get("_types", []))
-        if context.get("_type") == context_type or context_type in _contexts_types:
-            result.append(context)
-    return result
+    return list(_iter_contexts(event=event, context_type=context_type))
+
+
+def _iter_contexts(event: EventData, context_type: ContextType) -> Iterator[ContextData]:
+    for contexts in get_global_contexts(event), get_location_stack(event):
+        for context in contexts:
+            _contexts_types = cast(List[ContextType], context.get("_types", ()))
+            if context.get("_type") == context_type or context_type in _contexts_types:
+                yield context
 
 
 def get_global_contexts(event: EventData) -> List[ContextData]:
@@ -44,8 +85,14 @@ def get_location_stack(event: EventData) -> List[ContextData]:
     return event.get("location_stack", [])
 
 
-def add_global_context_to_event(event: EventData, context: AbstractGlobalContext) -> EventData:
-    """ Add the global context to the event. Returns the modified event """
+def add_global_context_to_event(event: EventData,
+                                context: AbstractGlobalContext,
+                                index: ContextIndex = None) -> EventData:
+    """
+    Add the global context to the event. Returns the modified event
+    :param index: optional index of the event's contexts, that will be updated with the added context
+    """
     event['global_contexts'].append(context)
+    if index is not None:
+        index.add_global_context(context)
     return event
-
@@ -0,0 +1,250 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Metrics of the collector and the workers, in the Prometheus text format.
+
+Metrics are kept per process, and are not combined over processes: the metrics that a process serves are only
+complete if it's the only process, or if each process is scraped separately (e.g. the workers'
+--metrics-port). Updating a metric takes a lock and a dict lookup, so it's cheap enough to do on every
+request, but metrics should be updated once per batch of events rather than once per event.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Content-Type of the text format, as returned by generate_metrics()
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default buckets of histograms that measure time, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(label_names: Sequence[str], labels: Sequence[str]) -> str:
+    if not label_names:
+        return ''
+    values = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        """
+        Create a metric, and add it to the registry, such that it's included in generate_metrics().
+        :param name: name of the metric
+        :param documentation: description of the metric
+        :param label_names: names of the labels. Each update of the metric must give a value for each label.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _check_labels(self, labels: Labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {labels}')
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _ValueMetric(_Metric):
+    """ Metric with a single value per combination of labels. """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Labels, float] = {}
+
+    def _set(self, value: float, labels: Labels):
+        self._check_labels(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def get(self, labels: Labels = ()) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+                for labels, value in values]
+
+
+class Counter(_ValueMetric):
+    """ Value that only goes up, e.g. a number of events. """
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        with self._lock:
+            if labels not in self._values:
+                self._check_labels(labels)
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, value: float, labels: Labels = ()):
+        """ Set the value, for counters that are maintained elsewhere, e.g. in PoolStats. """
+        self._set(value, labels)
+
+
+class Gauge(_ValueMetric):
+    """ Value that can go up and down, e.g. the number of events on a queue. """
+    metric_type = 'gauge'
+
+    def set(self, value: float, labels: Labels = ()):
+        self._set(value, labels)
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, e.g. durations or sizes, counted in buckets. """
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = TIME_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, in increasing order. A bucket for +Inf is added.
+        """
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # per labels: count per bucket (not cumulative, the last one is +Inf), and the sum of all values
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                self._check_labels(labels)
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0
+            counts[index] += 1
+            self._sums[labels] += value
+
+    @contextmanager
+    def time(self, labels: Labels = ()) -> Iterator[None]:
+        """ Context manager that observes the time spent in its block, in seconds. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def get_count(self, labels: Labels = ()) -> int:
+        with self._lock:
+            return sum(self._counts.get(labels, []))
+
+    def get_sums(self) -> Dict[Labels, float]:
+        """ Get the sum of the observed values, per combination of labels. """
+        with self._lock:
+            return dict(self._sums)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, list(counts), self._sums[labels]) for labels, counts in self._counts.items())
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names + ('le',), labels + (_format_value(upper_bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            formatted_labels = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{formatted_labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{formatted_labels} {cumulative}')
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def generate_metrics() -> str:
+    """ Get all metrics in the Prometheus text format. """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def start_metrics_server(port: int,
+                         on_scrape: Optional[Callable[[], None]] = None,
+                         host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Serve the metrics on http://host:port/metrics, from a background thread. For processes that don't run
+    the collector, e.g. the workers.
+    :param port: port to listen on
+    :param on_scrape: optional function that is called before the metrics are generated, e.g. to update
+        gauges.
+    :param host: address to listen on
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            if on_scrape:
+                try:
+                    on_scrape()
+                except Exception as exc:
+                    print(f'Error updating metrics: {exc}')
+            data = generate_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+# Metrics of the collector and workers
+REQUEST_SIZE = Histogram(
+    'objectiv_collector_request_size_bytes', 'Size of the requests to the collector endpoint.',
+    buckets=(1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000))
+REQUEST_EVENTS = Histogram(
+    'objectiv_collector_request_events', 'Number of events per request to the collector endpoint.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+EVENTS = Counter(
+    'objectiv_events_total', 'Number of processed events, by result: ok, nok (invalid) or duplicate.',
+    ['result'])
+STAGE_SECONDS = Histogram(
+    'objectiv_stage_seconds',
+    'Time spent per batch of events in a processing stage: parse, enrichment, validation, hydration or '
+    'serialization.',
+    ['stage'])
+DB_WRITE_SECONDS = Histogram(
+    'objectiv_db_write_seconds', 'Time spent per batch of events writing to a database table.', ['table'])
+SINK_ERRORS = Counter('objectiv_sink_errors_total', 'Number of failed writes, by output.', ['sink'])
+WORKER_BATCH_SECONDS = Histogram(
+    'objectiv_worker_batch_seconds', 'Time spent per batch, by worker type: entry or finalize.', ['worker'])
+QUEUE_DEPTH = Gauge(
+    'objectiv_queue_depth', 'Estimated number of events on a queue, from the table statistics.', ['queue'])
+# Metrics of the process' connection pool, see PoolStats
+POOL_CONNECTIONS = Gauge(
+    'objectiv_db_pool_connections', 'Number of open connections in the pool, by state: idle or in_use.',
+    ['state'])
+POOL_CHECKOUTS = Counter('objectiv_db_pool_checkouts_total', 'Number of times a connection was handed out.')
+POOL_WAIT_SECONDS = Counter(
+    'objectiv_db_pool_wait_seconds_total', 'Total time spent waiting for a free connection.')
+POOL_CONNECTS = Counter('objectiv_db_pool_connects_total', 'Number of connections that were opened.')
+POOL_DISCARDS = Counter(
+    'objectiv_db_pool_discards_total', 'Number of connections that were discarded because they were broken.')
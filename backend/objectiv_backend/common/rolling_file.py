@@ -0,0 +1,287 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Rolling files: events are appended to a segment file, that is completed once it's big or old enough, after
+which a new segment is started. Downstream batch loaders can read a few large files, instead of a file per
+request.
+"""
+import atexit
+import gzip
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from objectiv_backend.common.types import EventDataList
+
+# Interval at which a background thread completes the segments that reached their maximum age
+ROTATION_CHECK_INTERVAL_SECONDS = 1.0
+# Number of events that a parquet segment buffers, before writing them as a row group
+PARQUET_ROW_GROUP_SIZE = 10_000
+
+_COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def _fsync_path(path: str):
+    """ fsync a file or directory. For a directory this makes renames and new files in it durable. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Segment:
+    """
+    A single segment file. While the segment is being written, it is a hidden file with an `.inprogress`
+    suffix. complete() renames it to its final name, such that readers only ever see complete files.
+    """
+
+    def __init__(self, directory: str, extension: str):
+        # The pid and a random part make the name unique, also if multiple processes write to the directory.
+        name = f'{time.strftime("%Y%m%dT%H%M%S", time.gmtime())}-{os.getpid()}-{uuid.uuid4().hex[:8]}{extension}'
+        self.path = os.path.join(directory, name)
+        self.temp_path = os.path.join(directory, f'.{name}.inprogress')
+        self.created = time.monotonic()
+        self.file = open(self.temp_path, 'xb')
+
+    def size(self) -> int:
+        """ Approximate size of the segment file, in bytes. """
+        return self.file.tell()
+
+    def write(self, events: EventDataList, event_jsons: Sequence[str]):
+        raise NotImplementedError()
+
+    def flush(self):
+        """ Write all buffered data to the operating system, such that fsync() makes it durable. """
+        raise NotImplementedError()
+
+    def finish(self):
+        """ Write all buffered data and the trailers of the file format, and close the file. """
+        raise NotImplementedError()
+
+
+class _NdjsonSegment(_Segment):
+    """ Segment with a json object per line, i.e. per event, optionally compressed. """
+
+    def __init__(self, directory: str, compression: str):
+        super().__init__(directory, f'.ndjson{_COMPRESSION_EXTENSIONS[compression]}')
+        self._zstd_flush_mode: Optional[int] = None
+        self._stream: Any = self.file
+        if compression == 'gzip':
+            # Empty filename, otherwise the gzip header would contain the temporary name
+            self._stream = gzip.GzipFile(filename='', fileobj=self.file, mode='wb', compresslevel=6)
+        elif compression == 'zstd':
+            import zstandard  # type: ignore
+            self._stream = zstandard.ZstdCompressor().stream_writer(self.file, closefd=False)
+            self._zstd_flush_mode = zstandard.FLUSH_BLOCK
+
+    def write(self, events: EventDataList, event_jsons: Sequence[str]):
+        self._stream.write(''.join(f'{event_json}\n' for event_json in event_jsons).encode('utf-8'))
+
+    def flush(self):
+        if self._zstd_flush_mode is not None:
+            self._stream.flush(self._zstd_flush_mode)
+        else:
+            self._stream.flush()
+        self.file.flush()
+
+    def finish(self):
+        if self._stream is not self.file:
+            # Writes the trailer, but doesn't close self.file
+            self._stream.close()
+        self.file.close()
+
+
+class _ParquetSegment(_Segment):
+    """
+    Parquet segment, with a row per event: the event id, the event time and the event json. The rows are
+    written in row groups of at most PARQUET_ROW_GROUP_SIZE events. Requires pyarrow.
+    """
+
+    def __init__(self, directory: str, compression: str):
+        import pyarrow  # type: ignore
+        import pyarrow.parquet  # type: ignore
+        super().__init__(directory, '.parquet')
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ('event_id', pyarrow.string()),
+            ('moment', pyarrow.timestamp('ms', tz='UTC')),
+            ('value', pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(self.file, self._schema, compression=compression)
+        self._event_ids: List[str] = []
+        self._moments: List[int] = []
+        self._values: List[str] = []
+        self._buffered_bytes = 0
+
+    def size(self) -> int:
+        return self.file.tell() + self._buffered_bytes
+
+    def write(self, events: EventDataList, event_jsons: Sequence[str]):
+        self._event_ids.extend(event['id'] for event in events)
+        self._moments.extend(event['time'] for event in events)
+        self._values.extend(event_jsons)
+        self._buffered_bytes += sum(len(event_json) for event_json in event_jsons)
+        if len(self._values) >= PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        if not self._values:
+            return
+        table = self._pyarrow.Table.from_arrays(
+            [self._pyarrow.array(self._event_ids, self._pyarrow.string()),
+             self._pyarrow.array(self._moments, self._pyarrow.timestamp('ms', tz='UTC')),
+             self._pyarrow.array(self._values, self._pyarrow.string())],
+            schema=self._schema)
+        self._writer.write_table(table)
+        self._event_ids, self._moments, self._values = [], [], []
+        self._buffered_bytes = 0
+
+    def flush(self):
+        self._write_row_group()
+        self.file.flush()
+
+    def finish(self):
+        self._write_row_group()
+        self._writer.close()
+        if not self.file.closed:
+            self.file.close()
+
+
+_SEGMENT_CLASSES = {'ndjson': _NdjsonSegment, 'parquet': _ParquetSegment}
+
+
+class RollingFileWriter:
+    """
+    Thread-safe writer that appends events to a segment file in a directory.
+
+    A segment is completed once it's max_bytes big, once it has been open for max_seconds, or when the
+    process exits. The next write starts a new segment. Completing a segment renames it from a hidden
+    `.<name>.inprogress` file to its final name `<timestamp>-<pid>-<random>.<format>[.<compression>]`. The
+    rename is atomic, so readers that ignore hidden files only see complete segments.
+
+    The fsync policy determines the durability of the data:
+        * 'none': leave it to the operating system to write the data to disk.
+        * 'rotate': fsync a segment and its directory when the segment is completed.
+        * 'always': additionally flush and fsync the segment after every write.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 file_format: str = 'ndjson',
+                 compression: str = 'gzip',
+                 max_bytes: int = 128 * 1024 * 1024,
+                 max_seconds: float = 300,
+                 fsync: str = 'rotate'):
+        """
+        :param directory: directory for the segments, will be created if it doesn't exist.
+        :param file_format: 'ndjson' or 'parquet'
+        :param compression: 'gzip', 'zstd' or 'none'. zstd for ndjson requires the zstandard package.
+        :param max_bytes: complete a segment once it's at least this big. This is the size after compression,
+            data that is buffered by the compressor is not counted.
+        :param max_seconds: complete a segment once it has been open this long
+        :param fsync: fsync policy: 'none', 'rotate' or 'always'
+        """
+        if file_format not in _SEGMENT_CLASSES:
+            raise ValueError(f'Unsupported file format: {file_format}')
+        if compression not in _COMPRESSION_EXTENSIONS:
+            raise ValueError(f'Unsupported compression: {compression}')
+        if fsync not in ('none', 'rotate', 'always'):
+            raise ValueError(f'Unsupported fsync policy: {fsync}')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.file_format = file_format
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._segment: Optional[_Segment] = None
+
+    def write(self, events: EventDataList, event_jsons: Sequence[str]):
+        """
+        Append events to the current segment.
+        :param events: the events
+        :param event_jsons: the events serialized with serialize_events()
+        """
+        with self._lock:
+            if self._segment is None:
+                self._segment = _SEGMENT_CLASSES[self.file_format](self.directory, self.compression)
+            self._segment.write(events, event_jsons)
+            if self.fsync == 'always':
+                self._segment.flush()
+                os.fsync(self._segment.file.fileno())
+            if self._segment.size() >= self.max_bytes:
+                self._complete_segment()
+
+    def rotate_if_due(self):
+        """ Complete the current segment if it has been open for max_seconds. """
+        with self._lock:
+            if self._segment and time.monotonic() - self._segment.created >= self.max_seconds:
+                self._complete_segment()
+
+    def rotate(self):
+        """ Complete the current segment, if there is one. """
+        with self._lock:
+            self._complete_segment()
+
+    def _complete_segment(self):
+        segment, self._segment = self._segment, None
+        if segment is None:
+            return
+        segment.finish()
+        if self.fsync != 'none':
+            _fsync_path(segment.temp_path)
+        os.rename(segment.temp_path, segment.path)
+        if self.fsync != 'none':
+            _fsync_path(self.directory)
+
+
+_WRITERS: Dict[str, RollingFileWriter] = {}
+_WRITERS_PID = 0
+_WRITERS_LOCK = threading.Lock()
+
+
+def get_rolling_file_writer(name: str, create: Callable[[], RollingFileWriter]) -> RollingFileWriter:
+    """
+    Get the rolling file writer with the given name for this process, call create to create it if it doesn't
+    exist yet.
+
+    The segments of the writers that are returned by this function are completed by a background thread once
+    they reach their maximum age, and when the process exits.
+    """
+    global _WRITERS, _WRITERS_PID
+    with _WRITERS_LOCK:
+        if _WRITERS_PID != os.getpid():
+            _WRITERS = {}
+            _WRITERS_PID = os.getpid()
+            threading.Thread(target=_rotate_writers_loop, name='rolling-file-rotation', daemon=True).start()
+            atexit.register(close_rolling_file_writers)
+        if name not in _WRITERS:
+            _WRITERS[name] = create()
+        return _WRITERS[name]
+
+
+def _rotate_writers_loop():
+    while True:
+        time.sleep(ROTATION_CHECK_INTERVAL_SECONDS)
+        with _WRITERS_LOCK:
+            writers = list(_WRITERS.values())
+        for writer in writers:
+            try:
+                writer.rotate_if_due()
+            except Exception as exc:
+                print(f'Error completing segment in {writer.directory}: {exc}')
+
+
+def close_rolling_file_writers():
+    """ Complete the current segments of all writers of this process. """
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values()) if _WRITERS_PID == os.getpid() else []
+    for writer in writers:
+        try:
+            writer.rotate()
+        except Exception as exc:
+            print(f'Error completing segment in {writer.directory}: {exc}')
@@ -0,0 +1,263 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Buffered output to S3: events are collected per prefix and hour in gzip-compressed, newline-delimited json
+objects, which are uploaded in parts while they grow, instead of uploading an object per request. The uploads
+are done by a background thread, writing only compresses the events into a buffer.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from objectiv_backend.common.metrics import SINK_ERRORS
+
+# Size of the parts of a multipart upload. S3 requires at least 5MB for all parts but the last one.
+S3_PART_SIZE_BYTES = 8 * 1024 * 1024
+# Interval at which a background thread completes the objects that reached their maximum age
+S3_FLUSH_CHECK_INTERVAL_SECONDS = 1.0
+
+
+class _S3Object:
+    """
+    A single S3 object that is being written. The gzip stream is uploaded in parts of S3_PART_SIZE_BYTES,
+    the multipart upload is only started once the first part is full. An object that stays smaller than a
+    part is uploaded with a single put_object() call.
+
+    write() and take_part() are called by the writing threads, holding the lock. The upload functions are
+    called by the upload thread of the BufferedS3Writer, in the order in which the parts were taken.
+    """
+
+    def __init__(self, client: Any, bucket: str, key: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.lock = threading.Lock()
+        self.closed = False
+        # Set by the upload thread if an upload failed, the remaining uploads of the object are skipped
+        self.failed = False
+        self.created = time.monotonic()
+        self.event_count = 0
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)  # gzip format
+        self._buffer = bytearray()
+        self._taken_bytes = 0
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, Any]] = []
+
+    def size(self) -> int:
+        """ Compressed size of the object so far. Data that is buffered by the compressor is not counted. """
+        return self._taken_bytes + len(self._buffer)
+
+    def write(self, data: bytes, event_count: int) -> bool:
+        """
+        Compress data into the buffer.
+        :return: True if the buffer holds a full part, that should be taken with take_part()
+        """
+        self._buffer += self._compressor.compress(data)
+        self.event_count += event_count
+        return len(self._buffer) >= S3_PART_SIZE_BYTES
+
+    def take_part(self, last: bool = False) -> bytes:
+        """ Take the data in the buffer, to be uploaded. With last, the compressor is flushed first. """
+        if last:
+            self._buffer += self._compressor.flush()
+        part = bytes(self._buffer)
+        self._taken_bytes += len(part)
+        self._buffer = bytearray()
+        return part
+
+    def upload_part(self, part: bytes):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType='application/x-ndjson', ContentEncoding='gzip')
+            self._upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                           PartNumber=part_number, Body=part)
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def upload_last_part(self, part: bytes):
+        """ Upload the remaining data, and complete the object. """
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=part,
+                                   ContentType='application/x-ndjson', ContentEncoding='gzip')
+            return
+        self.upload_part(part)
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        """ Abort the multipart upload, if one was started, such that S3 discards the uploaded parts. """
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+class BufferedS3Writer:
+    """
+    Thread-safe writer that collects events in an S3 object per prefix (e.g. OK, NOK) and hour.
+
+    Objects are named `<key_prefix>/<yyyy>/<mm>/<dd>/<hh>/<prefix>/<timestamp>-<pid>-<random>.ndjson.gz`, and
+    contain a json object per line. An object is completed once its compressed size is at least max_bytes,
+    once it has been open for max_seconds (see complete_due()), or when the process exits. Objects only become
+    visible in S3 when they are completed.
+
+    write() only compresses the events. Full parts and completed objects are uploaded by a background thread,
+    one upload at a time, so the parts of an object are uploaded in order.
+
+    If an upload fails, then the events of that object are lost. The error is printed and counted in the
+    SINK_ERRORS metric.
+    """
+
+    def __init__(self, client: Any, bucket: str, key_prefix: str, max_bytes: int, max_seconds: float):
+        """
+        :param client: boto3 S3 client
+        :param bucket: name of the S3 bucket
+        :param key_prefix: prefix of the object keys
+        :param max_bytes: complete an object once it's at least this big, after compression
+        :param max_seconds: complete an object once it has been open this long
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._objects: Dict[Tuple[str, str], _S3Object] = {}
+        self._uploads: 'queue.Queue[Callable[[], None]]' = queue.Queue()
+        threading.Thread(target=self._upload_loop, name='s3-upload', daemon=True).start()
+
+    def write(self, events: Sequence[Any], event_jsons: Sequence[str], prefix: str, moment: datetime):
+        """
+        Add events to the object for the prefix and the hour of moment.
+        :param events: the events
+        :param event_jsons: the events serialized with serialize_events()
+        :param prefix: prefix, included in the object key after the hour
+        :param moment: timestamp that the data arrived
+        """
+        data = ''.join(f'{event_json}\n' for event_json in event_jsons).encode('utf-8')
+        partition = (prefix, moment.strftime('%Y/%m/%d/%H'))
+        while True:
+            with self._lock:
+                s3_object = self._objects.get(partition)
+                if s3_object is None:
+                    s3_object = self._create_object(partition)
+                    self._objects[partition] = s3_object
+            with s3_object.lock:
+                if s3_object.closed:
+                    # Another thread completed the object, between getting it and locking it.
+                    continue
+                if s3_object.write(data, len(events)) and s3_object.size() < self.max_bytes:
+                    self._upload(partition, s3_object, s3_object.upload_part, s3_object.take_part())
+                if s3_object.size() >= self.max_bytes:
+                    self._complete(partition, s3_object)
+                return
+
+    def _create_object(self, partition: Tuple[str, str]) -> _S3Object:
+        prefix, hour = partition
+        timestamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        key = f'{self.key_prefix}/{hour}/{prefix}/{timestamp}-{os.getpid()}-{uuid.uuid4().hex[:8]}.ndjson.gz'
+        return _S3Object(client=self.client, bucket=self.bucket, key=key)
+
+    def complete_due(self):
+        """ Complete the objects that have been open for max_seconds, and wait till the uploads are done. """
+        now = time.monotonic()
+        with self._lock:
+            due = [item for item in self._objects.items() if now - item[1].created >= self.max_seconds]
+        self._complete_objects(due)
+        self._uploads.join()
+
+    def complete_all(self):
+        """ Complete all objects, and wait till the uploads are done. """
+        with self._lock:
+            objects = list(self._objects.items())
+        self._complete_objects(objects)
+        self._uploads.join()
+
+    def _complete_objects(self, objects: List[Tuple[Tuple[str, str], _S3Object]]):
+        for partition, s3_object in objects:
+            with s3_object.lock:
+                if not s3_object.closed:
+                    self._complete(partition, s3_object)
+
+    def _close(self, partition: Tuple[str, str], s3_object: _S3Object):
+        """ Remove the object, such that the next write for its partition creates a new one. """
+        s3_object.closed = True
+        with self._lock:
+            if self._objects.get(partition) is s3_object:
+                del self._objects[partition]
+
+    def _complete(self, partition: Tuple[str, str], s3_object: _S3Object):
+        """ Close the object, and queue the upload of its remaining data. The caller must hold s3_object.lock. """
+        self._close(partition, s3_object)
+        self._upload(partition, s3_object, s3_object.upload_last_part, s3_object.take_part(last=True))
+
+    def _upload(self, partition: Tuple[str, str], s3_object: _S3Object, upload: Callable[[bytes], None],
+                part: bytes):
+        """ Queue the upload of a part of the object, see _upload_loop(). """
+        def run():
+            if s3_object.failed:
+                return
+            try:
+                upload(part)
+            except Exception as exc:
+                self._discard(partition, s3_object, exc)
+        self._uploads.put(run)
+
+    def _upload_loop(self):
+        while True:
+            upload = self._uploads.get()
+            try:
+                upload()
+            finally:
+                self._uploads.task_done()
+
+    def _discard(self, partition: Tuple[str, str], s3_object: _S3Object, exc: Exception):
+        """ Handle a failed upload: drop the object, and skip its remaining uploads. """
+        with s3_object.lock:
+            s3_object.failed = True
+            self._close(partition, s3_object)
+        SINK_ERRORS.inc(labels=('s3',))
+        print(f'Error uploading to s3, lost {s3_object.event_count} events of {s3_object.key}: {exc}')
+        try:
+            s3_object.abort()
+        except Exception as abort_exc:
+            print(f'Error aborting upload of {s3_object.key}: {abort_exc}')
+
+
+_WRITER: Optional[BufferedS3Writer] = None
+_WRITER_PID = 0
+_WRITER_LOCK = threading.Lock()
+
+
+def get_s3_writer(create: Callable[[], BufferedS3Writer]) -> BufferedS3Writer:
+    """
+    Get the BufferedS3Writer of this process, call create to create it if it doesn't exist yet.
+
+    The objects of the returned writer are completed by a background thread once they reach their maximum
+    age, and when the process exits.
+    """
+    global _WRITER, _WRITER_PID
+    with _WRITER_LOCK:
+        if _WRITER is None or _WRITER_PID != os.getpid():
+            _WRITER = create()
+            _WRITER_PID = os.getpid()
+            threading.Thread(target=_complete_due_loop, args=(_WRITER,), name='s3-flush', daemon=True).start()
+            atexit.register(_complete_at_exit, _WRITER, _WRITER_PID)
+        return _WRITER
+
+
+def _complete_at_exit(writer: BufferedS3Writer, pid: int):
+    # A forked child inherits the exit handlers, but not the responsibility for the parent's objects
+    if os.getpid() == pid:
+        writer.complete_all()
+
+
+def _complete_due_loop(writer: BufferedS3Writer):
+    while True:
+        time.sleep(S3_FLUSH_CHECK_INTERVAL_SECONDS)
+        writer.complete_due()
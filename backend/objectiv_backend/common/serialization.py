@@ -0,0 +1,61 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Json serialization and parsing of events. Uses orjson if it is available, which is considerably faster than
+the json module from the standard library. See JSON_SERIALIZER in config.py.
+"""
+import json
+from typing import Any, List, Union
+
+from objectiv_backend.common.config import JSON_SERIALIZER
+from objectiv_backend.common.metrics import STAGE_SECONDS
+from objectiv_backend.common.types import EventDataList
+
+
+def _load_orjson() -> Any:
+    """ Get the orjson module, or None if it is disabled or not installed. """
+    if JSON_SERIALIZER == 'json':
+        return None
+    try:
+        import orjson
+        return orjson
+    except ImportError:
+        if JSON_SERIALIZER == 'orjson':
+            raise
+        return None
+
+
+_orjson = _load_orjson()
+
+
+def json_dumps(obj: Any) -> str:
+    """ Serialize obj to a compact json string, i.e. without any whitespace. """
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson doesn't support some values, e.g. integers that don't fit in 64 bits. Leave those
+            # to the standard library.
+            pass
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """ Parse a json document. """
+    if _orjson is not None:
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            # orjson is stricter than the standard library, e.g. it doesn't accept NaN, or integers that
+            # don't fit in 64 bits. Leave those to the standard library, which raises if data is not valid.
+            pass
+    return json.loads(data)
+
+
+def serialize_events(events: EventDataList) -> List[str]:
+    """
+    Serialize each event to a json string. Meant to be done once, after which the strings can be passed to
+    all outputs.
+    """
+    with STAGE_SECONDS.time(labels=('serialization',)):
+        return [json_dumps(event) for event in events]
@@ -0,0 +1,121 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Buffer to coalesce writes of concurrent requests ("group commit").
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class _FlushResult:
+    """ Outcome of a single flush, shared by all writers whose batches are part of that flush. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class WriteBuffer(Generic[T]):
+    """
+    Thread-safe buffer, that combines batches written by concurrent callers, and flushes them together.
+
+    write() adds a batch to the buffer, and blocks until the flush that contains the batch is done. A
+    background thread flushes all buffered batches with a single call to the flush function, as soon as
+    max_size items are buffered, or max_delay_seconds after the first batch was added. Batches that are
+    written while a flush is running are part of the next flush.
+
+    If the flush function raises an exception, then write() raises that exception in all callers whose
+    batch was part of that flush.
+    """
+
+    def __init__(self,
+                 flush: Callable[[List[T]], None],
+                 max_delay_seconds: float,
+                 max_size: int,
+                 get_size: Callable[[T], int]):
+        """
+        :param flush: function that writes a list of batches, e.g. in a single transaction
+        :param max_delay_seconds: maximum time that a batch waits before it is flushed
+        :param max_size: number of items that triggers a flush, without waiting for max_delay_seconds
+        :param get_size: function that returns the number of items in a batch
+        """
+        self._flush = flush
+        self._max_delay_seconds = max_delay_seconds
+        self._max_size = max_size
+        self._get_size = get_size
+        self._condition = threading.Condition()
+        self._batches: List[T] = []
+        self._size = 0
+        self._first_added = 0.0
+        self._result = _FlushResult()
+        self._flushes = 0
+        self._thread = threading.Thread(target=self._run, name='write-buffer', daemon=True)
+        self._thread.start()
+
+    def write(self, batch: T) -> None:
+        """
+        Add the batch to the buffer, and wait till it is flushed.
+        :raise: the exception raised by the flush function, if any
+        """
+        with self._condition:
+            if not self._batches:
+                self._first_added = time.monotonic()
+            self._batches.append(batch)
+            self._size += self._get_size(batch)
+            result = self._result
+            self._condition.notify()
+        result.done.wait()
+        if result.error is not None:
+            raise result.error
+
+    @property
+    def flushes(self) -> int:
+        """ Number of flushes done so far. """
+        with self._condition:
+            return self._flushes
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._batches:
+                    self._condition.wait()
+                deadline = self._first_added + self._max_delay_seconds
+                while self._size < self._max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batches, result = self._batches, self._result
+                self._batches, self._size, self._result = [], 0, _FlushResult()
+                self._flushes += 1
+            try:
+                self._flush(batches)
+            except BaseException as exc:
+                result.error = exc
+            finally:
+                result.done.set()
+
+
+# Buffers are per process, as the background thread doesn't survive a fork. We remember the pid of the
+# process that created the buffers, such that a forked process (e.g. a gunicorn worker) creates its own.
+_BUFFERS: Dict[str, WriteBuffer] = {}
+_BUFFERS_PID = os.getpid()
+_BUFFERS_LOCK = threading.Lock()
+
+
+def get_write_buffer(name: str, create: Callable[[], WriteBuffer]) -> WriteBuffer:
+    """
+    Get the write buffer with the given name for this process, call create to create it if it doesn't exist
+    yet.
+    """
+    global _BUFFERS, _BUFFERS_PID
+    with _BUFFERS_LOCK:
+        if _BUFFERS_PID != os.getpid():
+            _BUFFERS = {}
+            _BUFFERS_PID = os.getpid()
+        if name not in _BUFFERS:
+            _BUFFERS[name] = create()
+        return _BUFFERS[name]
@@ -1,17 +1,23 @@
 begin;
 
+-- The queues are consumed in insert_order, the primary key makes that an index range scan, and lets the
+-- workers delete the claimed rows by primary key. Consumed rows are deleted, so autovacuum is tuned to clean
+-- up the dead rows after a fixed number of deletes, rather than after a fraction of the (small) table.
+-- If POSTGRES_UNLOGGED_QUEUES is set, db_init creates these tables unlogged, see db_init.py.
 create table queue_entry (
     event_id uuid not null,
-    insert_order bigserial,
+    insert_order bigserial primary key,
     value json not null
-);
+) with (autovacuum_vacuum_scale_factor = 0, autovacuum_vacuum_threshold = 10000);
 
 create table queue_finalize (
     event_id uuid not null,
-    insert_order bigserial,
+    insert_order bigserial primary key,
     value json not null
-);
+) with (autovacuum_vacuum_scale_factor = 0, autovacuum_vacuum_threshold = 10000);
 
+-- section: data
+-- This section is replaced if the data table is partitioned, see create_tables_partitioned.sql
 create table data (
     event_id uuid not null,
     day date not null, -- This is for query convenience; a possible sharding key? We might well put an index on this badboy
@@ -22,6 +28,15 @@ create table data (
 );
 
 create index on data(day);
+-- end section: data
+
+-- section: data_layout
+-- This section is replaced if the data table has the typed layout, see create_tables_typed.sql
+-- end section: data_layout
+
+-- section: data_gin_index
+-- This section is replaced if the data table has a GIN index, see create_tables_typed.sql
+-- end section: data_gin_index
 
 create type failure_reason as enum('failed validation', 'duplicate');
 
@@ -36,51 +51,6 @@ create table nok_data (
 );
 
 
-create view data_with_sessions as
-with session_starts as (
-    select
-        cookie_id as cookie_id,
-        event_id as event_id,
-        coalesce(
-            -- TODO: session is now 5 seconds, change this.
-            extract(epoch from (moment - lag(moment, 1) over (partition by cookie_id order by moment, event_id))) > 5,
-            true
-        ) as is_start_of_session,
-        moment as moment
-    from data
-),
-session_id_and_start as (
-    select
-            -- We need a unique identifier for the session. We use event_id, as that gives us a unique id
-            -- per session. The event_ids are all unique, and an event can only belong to one
-            -- session, and thus we can use the event_id as a unique session_id.
-           event_id as session_id,
-           cookie_id,
-           event_id as event_id,
-           moment as moment
-    from session_starts
-    where is_start_of_session
-)
-select
-        s.session_id as session_id,
-        row_number() over (partition by s.session_id order by d.moment, d.event_id asc) as session_hit_number,
-        d.*
-from data as d
-inner join session_id_and_start as s on s.cookie_id = d.cookie_id and s.moment <= d.moment
-where not exists (
-    select *
-    from session_id_and_start as s2
-    where
-      -- a session start for the same cookie
-          s2.cookie_id = d.cookie_id
-      and s2.moment <= d.moment
-      -- and that session is closer to pq.moment than the selected session s
-      and s2.moment > s.moment
-)
-order by session_id, moment
-;
-
-
 -- used by collector to write incoming events
 create role obj_collector_role noinherit;
 grant select, update, insert on queue_entry to obj_collector_role;
@@ -97,7 +67,54 @@ grant insert on data, nok_data to obj_worker_role;
 
 -- used by for example notebook to query session data
 create role obj_reader_role noinherit;
-grant select on data, data_with_sessions to obj_reader_role;
+grant select on data to obj_reader_role;
+
+-- section: data_grants
+-- This section is replaced if the data table is partitioned, see create_tables_partitioned.sql
+-- end section: data_grants
+
+-- section: sessions
+-- Sessions of each cookie: maximal series of events in which consecutive events are at most
+-- SESSION_GAP_SECONDS apart. The session_id is the event_id of the first event of the session. The table is
+-- updated in the transaction that inserts events into data, by merging the new events with the sessions
+-- around them, see update_sessions(). Late events can extend or merge sessions, so a session_id can change
+-- when an event arrives that is earlier than the first event of its session.
+-- db_init creates this section for databases that were initialized by an older version, and rebuilds the
+-- table with --rebuild-sessions, e.g. after changing SESSION_GAP_SECONDS.
+create table sessions (
+    session_id uuid not null,
+    cookie_id uuid not null,
+    start_moment timestamp not null,
+    end_moment timestamp not null,
+    event_count bigint not null,
+    primary key(session_id)
+);
+
+create index on sessions(cookie_id, start_moment);
+
+grant select, insert, delete on sessions to obj_collector_role, obj_worker_role;
+grant select on sessions to obj_reader_role;
+-- end section: sessions
+
+-- section: data_with_sessions
+-- All events, with their session. If updating the sessions failed (see try_update_sessions()), then events
+-- are not in a session until the sessions are rebuilt with `objectiv-db-init --rebuild-sessions`. Such events
+-- are still included, with null as session_id and session_hit_number.
+-- db_init replaces the view on every run, such that older databases get the current definition.
+create or replace view data_with_sessions as
+select
+        s.session_id as session_id,
+        case when s.session_id is not null then
+            row_number() over (partition by s.session_id order by d.moment, d.event_id asc)
+        end as session_hit_number,
+        d.*
+from data as d
+left join sessions as s on s.cookie_id = d.cookie_id and d.moment between s.start_moment and s.end_moment
+order by session_id, moment
+;
+
+grant select on data_with_sessions to obj_reader_role;
+-- end section: data_with_sessions
 
 
 commit;
@@ -0,0 +1,78 @@
+-- Replacements for the sections of create_tables.sql, to create a data table that is partitioned by day.
+-- See objectiv_backend/tools/db_init/db_init.py
+
+-- section: data
+-- The data table is partitioned by day. Partitions are named data_YYYYMMDD, and are created ahead of time
+-- by db_init, the collector and the workers, with create_data_partitions(). Events for days without a
+-- partition end up in data_default.
+create table data (
+    event_id uuid not null,
+    day date not null,
+    moment timestamp not null,
+    cookie_id uuid not null,
+    value json not null
+) partition by range (day);
+
+create table data_default partition of data default;
+
+create index on data(day);
+
+-- A unique index on a partitioned table must include the partition key, so it cannot guarantee that an
+-- event_id is unique over all partitions. Instead every event_id that is inserted into data is also
+-- inserted into this table, which has a primary key on event_id.
+create table data_event_id (
+    event_id uuid not null,
+    primary key(event_id)
+);
+-- end section: data
+
+-- section: data_grants
+grant select, insert on data_event_id to obj_collector_role, obj_worker_role;
+
+-- Creates the partitions of the data table for the days from first_day up to and including last_day, that
+-- don't exist yet. Rows in data_default that belong to a new partition are moved to it, as attaching a
+-- partition fails otherwise. The new partitions have the same columns in the same order as data_default, also
+-- with the typed layout. Concurrent calls are serialized with an advisory lock, that is held until the end of
+-- the transaction.
+-- Creating and attaching partitions requires owning the data table, so this is a security definer function:
+-- the collector and workers call it to create the upcoming partitions, see ensure_data_partitions(). db_init
+-- runs this section again for databases that were initialized by an older version.
+create or replace function create_data_partitions(first_day date, last_day date) returns void
+language plpgsql security definer as $$
+declare
+    partition_day date := first_day;
+    partition_name text;
+begin
+    perform pg_advisory_xact_lock(hashtext('objectiv_data_partitions'));
+    while partition_day <= last_day loop
+        partition_name := 'data_' || to_char(partition_day, 'YYYYMMDD');
+        if to_regclass(partition_name) is null then
+            execute format('create table %I (like data including defaults)', partition_name);
+            execute format('
+                with moved as (
+                    delete from data_default
+                    where day >= $1 and day < $2
+                    returning *
+                )
+                insert into %I
+                select * from moved', partition_name) using partition_day, partition_day + 1;
+            execute format('alter table data attach partition %I for values from (%L) to (%L)',
+                           partition_name, partition_day, partition_day + 1);
+        end if;
+        partition_day := partition_day + 1;
+    end loop;
+end;
+$$;
+
+-- A security definer function must not find tables of the caller, so its search_path is fixed to the schema
+-- of the data table, with the temporary schema last.
+do $$
+begin
+    execute format('alter function create_data_partitions(date, date) set search_path = %I, pg_temp',
+                   current_schema());
+end;
+$$;
+
+revoke all on function create_data_partitions(date, date) from public;
+grant execute on function create_data_partitions(date, date) to obj_collector_role, obj_worker_role;
+-- end section: data_grants
@@ -0,0 +1,19 @@
+-- Replacements for the sections of create_tables.sql, for the typed layout of the data table. This works for
+-- both the regular and the partitioned data table. See objectiv_backend/tools/db_init/db_init.py
+
+-- section: data_layout
+-- The value column is jsonb instead of json, such that queries don't have to parse the json text of every
+-- event again. The type of the event is also stored in a typed column, which the modelhub reads without
+-- touching value at all. The column is filled by insert_events_into_data():
+--  * event_type: the _type of the event
+-- The user id and the time of the event are already typed columns: cookie_id and moment.
+alter table data
+    alter column value type jsonb,
+    add column event_type text not null;
+-- end section: data_layout
+
+-- section: data_gin_index
+-- Index for containment queries on the events, e.g. `value @> '{"_type": "PressEvent"}'`. Only created if
+-- POSTGRES_DATA_GIN_INDEX is set.
+create index on data using gin (value jsonb_path_ops);
+-- end section: data_gin_index
@@ -1,25 +1,31 @@
 import json
 import urllib.parse
+import zlib
 from datetime import datetime
 
 import flask
 import time
 from urllib.parse import urlparse, parse_qs
-from typing import List
+from functools import partial
+from typing import Callable, IO, Iterator, List, NamedTuple, Optional, Tuple
 
 import psycopg2
 from flask import Response, Request
 
-from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.config import get_collector_config, PostgresConfig
 from objectiv_backend.common.types import EventData, EventDataList, EventList
-from objectiv_backend.common.db import get_db_connection
-from objectiv_backend.common.event_utils import add_global_context_to_event, get_contexts
+from objectiv_backend.common.db import get_connection_pool
+from objectiv_backend.common.event_utils import add_global_context_to_event, ContextIndex
+from objectiv_backend.common.metrics import REQUEST_EVENTS, REQUEST_SIZE, SINK_ERRORS, STAGE_SECONDS
+from objectiv_backend.common.serialization import json_loads, serialize_events
+from objectiv_backend.common.write_buffer import WriteBuffer, get_write_buffer
 from objectiv_backend.end_points.common import get_json_response, get_cookie_id
-from objectiv_backend.end_points.extra_output import events_to_json, write_data_to_fs_if_configured, \
-    write_data_to_s3_if_configured, write_data_to_snowplow_if_configured
+from objectiv_backend.end_points.extra_output import write_events_to_fs_if_configured, \
+    write_events_to_s3_if_configured, write_data_to_snowplow_if_configured
 from objectiv_backend.schema.validate_events import validate_structure_event_list, EventError
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
-from objectiv_backend.workers.pg_storage import insert_events_into_nok_data
+from objectiv_backend.workers.pg_storage import insert_events_into_nok_data, ensure_data_partitions, \
+    try_update_sessions
 from objectiv_backend.workers.worker_entry import process_events_entry
 from objectiv_backend.workers.worker_finalize import insert_events_into_data
 
@@ -29,6 +35,13 @@ from objectiv_backend.schema.schema import HttpContext, CookieIdContext, Marketi
 DATA_MAX_SIZE_BYTES = 1_000_000
 DATA_MAX_EVENT_COUNT = 1_000
 
+# Limits for the bulk endpoint. The total size of a bulk request is not limited, but it is processed in chunks
+# that are no bigger than a regular request. A single line (i.e. event) cannot be bigger than a regular request.
+BULK_CHUNK_EVENT_COUNT = DATA_MAX_EVENT_COUNT
+BULK_CHUNK_SIZE_BYTES = DATA_MAX_SIZE_BYTES
+BULK_READ_SIZE_BYTES = 64 * 1024
+BULK_MAX_REPORTED_ERRORS = DATA_MAX_EVENT_COUNT
+
 
 def collect() -> Response:
     """
@@ -43,19 +56,63 @@ def collect() -> Response:
         print(f'Data problem: {exc}')  # todo: real error logging
         return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__())
 
-    # Do all the enrichment steps that can only be done in this phase
-    add_enriched_contexts(events)
+    error_count, event_errors = _process_events(events, current_millis, transport_time)
+    return _get_collector_response(error_count=error_count, event_count=len(events), event_errors=event_errors)
+
+
+def collect_bulk() -> Response:
+    """
+    Endpoint that accepts a large number of events, e.g. for backfills, and stores them for further
+    processing.
+
+    The body contains one event per line (newline-delimited json), and can be compressed with gzip or deflate,
+    as indicated by the Content-Encoding header. The body is read and processed incrementally, in chunks of at
+    most BULK_CHUNK_EVENT_COUNT events. Each chunk is handled like the events of a regular request, and
+    written to the configured outputs before the next chunk is read.
+    The time offset of the client can be given with the X-Transport-Time header, in milliseconds since epoch.
 
-    set_time_in_events(events, current_millis, transport_time)
+    If a line cannot be parsed, or a chunk is not structured well, then processing stops. The events of
+    earlier chunks have been stored at that point, the returned event_count is the number of those events.
+    """
+    current_millis = round(time.time() * 1000)
+    event_count = 0
+    error_count = 0
+    event_errors: List[EventError] = []
+    try:
+        transport_time = _get_bulk_transport_time(flask.request)
+        for events in _get_bulk_event_chunks(flask.request, transport_time):
+            chunk_error_count, chunk_event_errors = _process_events(events, current_millis, transport_time)
+            event_count += len(events)
+            error_count += chunk_error_count
+            # Don't let the error report grow without bounds
+            event_errors.extend(chunk_event_errors[:BULK_MAX_REPORTED_ERRORS - len(event_errors)])
+    except ValueError as exc:
+        print(f'Data problem: {exc}')  # todo: real error logging
+        return _get_collector_response(error_count=error_count + 1, event_count=event_count,
+                                       event_errors=event_errors, data_error=exc.__str__())
+    return _get_collector_response(error_count=error_count, event_count=event_count, event_errors=event_errors)
+
+
+def _process_events(
+        events: EventDataList, current_millis: int, transport_time: int) -> Tuple[int, List[EventError]]:
+    """
+    Enrich the events, and write them to the configured outputs.
+    :return: tuple: number of events that are not ok, and the errors of those events. In async mode the events
+        are not validated here, so there are no errors.
+    """
+    # Do all the enrichment steps that can only be done in this phase
+    with STAGE_SECONDS.time(labels=('enrichment',)):
+        add_enriched_contexts(events)
+        set_time_in_events(events, current_millis, transport_time)
 
     if not get_collector_config().async_mode:
         ok_events, nok_events, event_errors = process_events_entry(events=events, current_millis=current_millis)
         print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
         write_sync_events(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors)
-        return _get_collector_response(error_count=len(nok_events), event_count=len(events), event_errors=event_errors)
+        return len(nok_events), event_errors
     else:
         write_async_events(events=events)
-        return _get_collector_response(error_count=0, event_count=len(events))
+        return 0, []
 
 
 def _get_event_data(request: Request) -> EventList:
@@ -75,10 +132,19 @@ def _get_event_data(request: Request) -> EventList:
     :return: the parsed data, an EventList (structure as sent by the tracker)
     """
     post_data = request.data
+    REQUEST_SIZE.observe(len(post_data))
     if len(post_data) > DATA_MAX_SIZE_BYTES:
         # if it's more than a megabyte, we'll refuse to process
         raise ValueError(f'Data size exceeds limit')
-    event_data: EventList = json.loads(post_data)
+    with STAGE_SECONDS.time(labels=('parse',)):
+        event_data = _parse_event_data(post_data)
+    REQUEST_EVENTS.observe(len(event_data['events']))
+    return event_data
+
+
+def _parse_event_data(post_data: bytes) -> EventList:
+    """ Parse and check the data, see _get_event_data() """
+    event_data: EventList = json_loads(post_data)
     if not isinstance(event_data, dict):
         raise ValueError('Parsed post data is not a dict')
     if 'events' not in event_data:
@@ -87,13 +153,136 @@ def _get_event_data(request: Request) -> EventList:
         raise ValueError('events is not a list')
     if len(event_data['events']) > DATA_MAX_EVENT_COUNT:
         raise ValueError('Events exceeds limit')
-    error_info = validate_structure_event_list(event_data=event_data)
+    # The events will be validated in detail by process_events_entry(), so a non-deep check suffices here.
+    error_info = validate_structure_event_list(event_data=event_data, deep=False)
     if error_info:
         raise ValueError(f'List of Events not structured well: {error_info[0].info}')
 
     return event_data
 
 
+def _get_bulk_transport_time(request: Request) -> int:
+    """
+    Get the transport time from the X-Transport-Time header, or 0 if it's not set.
+    :raise ValueError: if the header is not an integer
+    """
+    transport_time = request.headers.get('X-Transport-Time')
+    if not transport_time:
+        return 0
+    try:
+        return int(transport_time)
+    except ValueError:
+        raise ValueError('X-Transport-Time is not an integer')
+
+
+def _get_bulk_event_chunks(request: Request, transport_time: int) -> Iterator[EventDataList]:
+    """
+    Parse the newline-delimited events in the request body, and yield them in chunks of at most
+    BULK_CHUNK_EVENT_COUNT events and BULK_CHUNK_SIZE_BYTES bytes.
+
+    :raise ValueError:
+        1) the Content-Encoding is not supported, or the body could not be decompressed
+        2) a line is bigger than DATA_MAX_SIZE_BYTES
+        3) a line could not be parsed as JSON
+        4) a chunk did not validate as a valid EventList (validate_structure_event_list()
+    """
+    lines = _get_bulk_lines(request.stream, request.headers.get('Content-Encoding'))
+    events: EventDataList = []
+    chunk_size = 0
+    line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            events.append(json_loads(line))
+        except ValueError:
+            raise ValueError(f'Line {line_number} could not be parsed as json')
+        chunk_size += len(line)
+        if len(events) >= BULK_CHUNK_EVENT_COUNT or chunk_size >= BULK_CHUNK_SIZE_BYTES:
+            yield _validate_bulk_event_chunk(events, transport_time, line_number)
+            events = []
+            chunk_size = 0
+    if events:
+        yield _validate_bulk_event_chunk(events, transport_time, line_number)
+
+
+def _validate_bulk_event_chunk(events: EventDataList, transport_time: int, line_number: int) -> EventDataList:
+    """
+    Check the structure of a chunk of events, see _get_event_data().
+    :raise ValueError: if the chunk is not structured well
+    """
+    event_data: EventList = {'events': events, 'transport_time': transport_time}
+    error_info = validate_structure_event_list(event_data=event_data, deep=False)
+    if error_info:
+        raise ValueError(f'List of Events up to line {line_number} not structured well: {error_info[0].info}')
+    return events
+
+
+def _get_bulk_lines(stream: IO[bytes], content_encoding: Optional[str]) -> Iterator[bytes]:
+    """
+    Read the stream, decompress it if needed, and yield the lines in it, without newline characters.
+    :raise ValueError: if the encoding is not supported, the data cannot be decompressed, or a line is bigger
+        than DATA_MAX_SIZE_BYTES
+    """
+    pending = b''
+    for block in _get_bulk_blocks(stream, content_encoding):
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        if len(pending) > DATA_MAX_SIZE_BYTES:
+            raise ValueError('Line size exceeds limit')
+        yield from lines
+    if pending:
+        yield pending
+
+
+def _get_bulk_blocks(stream: IO[bytes], content_encoding: Optional[str]) -> Iterator[bytes]:
+    """
+    Read the stream, and yield the decompressed data in blocks of at most BULK_READ_SIZE_BYTES.
+    Decompression is bounded too, so a small compressed request cannot make us allocate a lot of memory.
+    :raise ValueError: if the encoding is not supported, or the data cannot be decompressed
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        while True:
+            data = stream.read(BULK_READ_SIZE_BYTES)
+            if not data:
+                return
+            yield data
+
+    if encoding in ('gzip', 'x-gzip'):
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == 'deflate':
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError(f'Unsupported Content-Encoding: {content_encoding}')
+    decompressor = zlib.decompressobj(wbits=wbits)
+    data = b''
+    try:
+        while True:
+            if not data:
+                data = stream.read(BULK_READ_SIZE_BYTES)
+            if not data:
+                block = decompressor.flush()
+                if block:
+                    yield block
+                if not decompressor.eof:
+                    raise ValueError('Compressed data is truncated')
+                return
+            if decompressor.eof:
+                # A gzip file can consist of multiple members, e.g. `cat a.gz b.gz`, that are decompressed
+                # one after the other.
+                if wbits == zlib.MAX_WBITS:
+                    raise ValueError('Unexpected data after the end of the compressed data')
+                decompressor = zlib.decompressobj(wbits=wbits)
+            block = decompressor.decompress(data, BULK_READ_SIZE_BYTES)
+            if block:
+                yield block
+            # Input that didn't fit within the maximum output size, or the start of the next gzip member
+            data = decompressor.unconsumed_tail or decompressor.unused_data
+    except zlib.error as exc:
+        raise ValueError(f'Could not decompress data: {exc}')
+
+
 def _get_collector_response(
         error_count: int, event_count: int, event_errors: List[EventError] = None, data_error: str = '') -> Response:
     """
@@ -124,24 +313,25 @@ def add_enriched_contexts(events: EventDataList):
     """
     Enrich the list of events
     """
-
-    add_cookie_id_contexts(events)
+    cookie_id_context = get_cookie_id_context()
     for event in events:
-        add_http_context_to_event(event=event, request=flask.request)
-        add_marketing_context_to_event(event=event)
+        # Index the contexts once, for all lookups by the enrichment functions below
+        index = ContextIndex(event)
+        if cookie_id_context:
+            add_global_context_to_event(event, cookie_id_context, index)
+        add_http_context_to_event(event=event, request=flask.request, index=index)
+        add_marketing_context_to_event(event=event, index=index)
 
 
-def add_cookie_id_contexts(events: EventDataList):
+def get_cookie_id_context() -> Optional[CookieIdContext]:
     """
-    Modify the given list of events: Add the CookieIdContext to each event, if cookies are enabled.
+    Get the CookieIdContext to add to the events of the current request, or None if cookies are disabled.
     """
     cookie_config = get_collector_config().cookie
     if not cookie_config:
-        return
+        return None
     cookie_id = get_cookie_id()
-    cookie_id_context = CookieIdContext(id=cookie_id, cookie_id=cookie_id)
-    for event in events:
-        add_global_context_to_event(event, cookie_id_context)
+    return CookieIdContext(id=cookie_id, cookie_id=cookie_id)
 
 
 def set_time_in_events(events: EventDataList, current_millis: int, client_millis: int):
@@ -197,7 +387,7 @@ def _get_remote_address(request: Request) -> str:
     return 'unknown'
 
 
-def add_http_context_to_event(event: EventData, request: Request):
+def add_http_context_to_event(event: EventData, request: Request, index: ContextIndex = None):
     """
         Create or enrich an HttpContext based on the data in the current request. If an HttpContext is already
         present, the remote address is added to the existing context. Otherwise, a new context is created and
@@ -205,15 +395,17 @@ def add_http_context_to_event(event: EventData, request: Request):
 
         :param event - event to add context to
         :param request - request object, used to extract extra context from.
+        :param index - index of the event's contexts. Will be created if not given.
     """
+    if index is None:
+        index = ContextIndex(event)
 
     remote_address = _get_remote_address(request)
 
     # check if there is a pre-existing http_context
     # if so, use that.
-    contexts = get_contexts(event, 'HttpContext')
-    if contexts:
-        tracker_http_context = contexts[0]
+    tracker_http_context = index.get_optional_context('HttpContext')
+    if tracker_http_context is not None:
         tracker_http_context['remote_address'] = remote_address
     else:
         # if a pre-existing context cannot be found, we create one from scratch
@@ -224,23 +416,24 @@ def add_http_context_to_event(event: EventData, request: Request):
             'user_agent': request.headers.get('User-Agent', '')
         }
 
-        add_global_context_to_event(event, HttpContext(**http_context))
+        add_global_context_to_event(event, HttpContext(**http_context), index)
 
 
-def add_marketing_context_to_event(event: EventData) -> None:
+def add_marketing_context_to_event(event: EventData, index: ContextIndex = None) -> None:
     """
     Tries to generate MarketingContext(s) based on parameters in the query string, and add to global contexts
     in the provided event.
     :param event: EventData
+    :param index: index of the event's contexts. Will be created if not given.
     :return:
     """
-    path_contexts = get_contexts(event, 'PathContext')
+    if index is None:
+        index = ContextIndex(event)
+    path_context = index.get_optional_context('PathContext')
 
-    if not path_contexts:
+    if path_context is None:
         # without a PathContext, we have no query_string
         return
-    else:
-        path_context = path_contexts[0]
 
     query_string = urlparse(str(path_context.get('id', ''))).query
     parsed_qs = parse_qs(query_string)
@@ -277,7 +470,7 @@ def add_marketing_context_to_event(event: EventData) -> None:
         if len(marketing_context_fields) > 1:
             # if no fields are set (other than id), no point in trying
             try:
-                add_global_context_to_event(event, MarketingContext(**marketing_context_fields))
+                add_global_context_to_event(event, MarketingContext(**marketing_context_fields), index)
             except TypeError as e:
                 # couldn't create a marketing context for this mapping, no problem, as this is not a mandatory context
                 #
@@ -290,35 +483,110 @@ def write_sync_events(ok_events: EventDataList, nok_events: EventDataList, event
     """
     Write the events to the following sinks, if configured:
         * postgres
+        * snowplow
         * aws
         * file system
+
+    A Postgres error is counted and printed, and doesn't stop the writes to the other sinks.
     """
-    output_config = get_collector_config().output
-    # todo: add exception handling. if one output fails, continue to next if configured.
-    if output_config.postgres:
+    for writer in get_sync_writers(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors):
         try:
-            connection = get_db_connection(output_config.postgres)
-            try:
-                with connection:
-                    insert_events_into_data(connection, events=ok_events)
-                    insert_events_into_nok_data(connection, events=nok_events)
-            finally:
-                connection.close()
+            writer()
         except psycopg2.DatabaseError as oe:
+            SINK_ERRORS.inc(labels=('postgres',))
             print(f'Error occurred in postgres: {oe}')
 
+
+def get_sync_writers(ok_events: EventDataList,
+                     nok_events: EventDataList,
+                     event_errors: List[EventError] = None) -> List[Callable[[], None]]:
+    """
+    Get a function per configured sink, that writes the events to that sink. See write_sync_events().
+    The functions are independent of each other, so they can be called concurrently.
+    """
+    output_config = get_collector_config().output
+    # Serialize the events once, for all sinks that store the events as json
+    ok_event_jsons = serialize_events(ok_events)
+    nok_event_jsons = serialize_events(nok_events)
+    writers: List[Callable[[], None]] = []
+    if output_config.postgres:
+        writers.append(partial(_write_sync_events_to_postgres, output_config.postgres,
+                               ok_events, nok_events, ok_event_jsons, nok_event_jsons))
     if output_config.snowplow:
-        write_data_to_snowplow_if_configured(events=ok_events, good=True)
-        write_data_to_snowplow_if_configured(events=nok_events, good=False, event_errors=event_errors)
+        writers.append(partial(_write_sync_events_to_snowplow, ok_events, nok_events, event_errors))
+    if output_config.file_system or output_config.aws:
+        writers.append(partial(_write_events_to_files, [
+            ('OK', ok_events, ok_event_jsons),
+            ('NOK', nok_events, nok_event_jsons)
+        ]))
+    return writers
+
+
+class _SyncWrite(NamedTuple):
+    ok_events: EventDataList
+    nok_events: EventDataList
+    ok_event_jsons: List[str]
+    nok_event_jsons: List[str]
+
+
+def _write_sync_events_to_postgres(pg_config: PostgresConfig,
+                                   ok_events: EventDataList,
+                                   nok_events: EventDataList,
+                                   ok_event_jsons: List[str],
+                                   nok_event_jsons: List[str]):
+    """
+    Write the events to Postgres, see _flush_sync_writes_to_postgres(). Raises psycopg2.DatabaseError if
+    writing fails, such that the caller can decide whether the request fails, see write_sync_events().
+    """
+    write = _SyncWrite(ok_events, nok_events, ok_event_jsons, nok_event_jsons)
+    if pg_config.write_buffer_millis:
+        write_buffer = get_write_buffer('sync', lambda: WriteBuffer(
+            flush=partial(_flush_sync_writes_to_postgres, pg_config),
+            max_delay_seconds=pg_config.write_buffer_millis / 1000,
+            max_size=pg_config.write_buffer_max_events,
+            get_size=lambda w: len(w.ok_events) + len(w.nok_events)))
+        write_buffer.write(write)
+    else:
+        _flush_sync_writes_to_postgres(pg_config, [write])
 
-    if not output_config.file_system and not output_config.aws:
-        return
-    for prefix, events in ('OK', ok_events), ('NOK', nok_events):
+
+def _flush_sync_writes_to_postgres(pg_config: PostgresConfig, writes: List[_SyncWrite]):
+    """
+    Write the events of one or more requests to the data and nok_data tables, and update the sessions, in a
+    single transaction. A failure to update the sessions doesn't fail the write, see try_update_sessions().
+    """
+    ok_events = [event for write in writes for event in write.ok_events]
+    ok_event_jsons = [event_json for write in writes for event_json in write.ok_event_jsons]
+    nok_events = [event for write in writes for event in write.nok_events]
+    nok_event_jsons = [event_json for write in writes for event_json in write.nok_event_jsons]
+    partition_data = pg_config.partition_data
+    with get_connection_pool(pg_config).connection() as connection:
+        if partition_data:
+            ensure_data_partitions(connection)
+        with connection:
+            inserted_events = insert_events_into_data(connection, events=ok_events, partitioned=partition_data,
+                                                      event_jsons=ok_event_jsons, typed_data=pg_config.typed_data)
+            insert_events_into_nok_data(connection, events=nok_events, event_jsons=nok_event_jsons)
+            try_update_sessions(connection, events=inserted_events)
+
+
+def _write_sync_events_to_snowplow(ok_events: EventDataList,
+                                   nok_events: EventDataList,
+                                   event_errors: List[EventError] = None):
+    write_data_to_snowplow_if_configured(events=ok_events, good=True)
+    write_data_to_snowplow_if_configured(events=nok_events, good=False, event_errors=event_errors)
+
+
+def _write_events_to_files(outputs: List[Tuple[str, EventDataList, List[str]]]):
+    """
+    Write events to the file system and aws, if configured.
+    :param outputs: list of tuples: prefix, events, and the serialized events
+    """
+    for prefix, events, event_jsons in outputs:
         if events:
-            data = events_to_json(events)
             moment = datetime.utcnow()
-            write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
-            write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+            write_events_to_fs_if_configured(events=events, event_jsons=event_jsons, prefix=prefix, moment=moment)
+            write_events_to_s3_if_configured(events=events, event_jsons=event_jsons, prefix=prefix, moment=moment)
 
 
 def write_async_events(events: EventDataList):
@@ -328,23 +596,50 @@ def write_async_events(events: EventDataList):
         * aws - to the 'RAW' prefix
         * file system - to the 'RAW' directory
     """
+    for writer in get_async_writers(events=events):
+        writer()
+
+
+def get_async_writers(events: EventDataList) -> List[Callable[[], None]]:
+    """
+    Get a function per configured sink, that writes the events to that sink. See write_async_events().
+    The functions are independent of each other, so they can be called concurrently.
+    """
     output_config = get_collector_config().output
-    # todo: add exception handling. if one output fails, continue to next if configured.
+    # Serialize the events once, for all sinks
+    event_jsons = serialize_events(events)
+    writers: List[Callable[[], None]] = []
     if output_config.postgres:
-        connection = get_db_connection(output_config.postgres)
-        try:
-            with connection:
-                pg_queue = PostgresQueues(connection=connection)
-                pg_queue.put_events(queue=ProcessingStage.ENTRY, events=events)
-        finally:
-            connection.close()
+        writers.append(partial(_write_async_events_to_postgres, output_config.postgres, events, event_jsons))
+    if output_config.file_system or output_config.aws:
+        writers.append(partial(_write_events_to_files, [('RAW', events, event_jsons)]))
+    return writers
+
+
+class _AsyncWrite(NamedTuple):
+    events: EventDataList
+    event_jsons: List[str]
+
+
+def _write_async_events_to_postgres(pg_config: PostgresConfig, events: EventDataList, event_jsons: List[str]):
+    # todo: add exception handling. if one output fails, continue to next if configured.
+    write = _AsyncWrite(events, event_jsons)
+    if pg_config.write_buffer_millis:
+        write_buffer = get_write_buffer('async', lambda: WriteBuffer(
+            flush=partial(_flush_async_writes_to_postgres, pg_config),
+            max_delay_seconds=pg_config.write_buffer_millis / 1000,
+            max_size=pg_config.write_buffer_max_events,
+            get_size=lambda w: len(w.events)))
+        write_buffer.write(write)
+    else:
+        _flush_async_writes_to_postgres(pg_config, [write])
 
-    if not output_config.file_system and not output_config.aws:
-        return
-    prefix = 'RAW'
-    if events:
-        data = events_to_json(events)
-        moment = datetime.utcnow()
-        write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
-        write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
 
+def _flush_async_writes_to_postgres(pg_config: PostgresConfig, writes: List[_AsyncWrite]):
+    """ Put the events of one or more requests on the entry queue, in a single transaction. """
+    events = [event for write in writes for event in write.events]
+    event_jsons = [event_json for write in writes for event_json in write.event_jsons]
+    with get_connection_pool(pg_config).connection() as connection:
+        with connection:
+            pg_queue = PostgresQueues(connection=connection)
+            pg_queue.put_events(queue=ProcessingStage.ENTRY, events=events, event_jsons=event_jsons)
@@ -5,14 +5,20 @@ Functions to write data to S3 and the local filesystem.
 
 This is experimental code, and not ready for production use.
 """
-import json
+import os
+import threading
+import uuid
 from datetime import datetime
 from io import BytesIO
 
-from typing import List
+from typing import Any, Dict, List, Optional, Sequence
 
 
-from objectiv_backend.common.config import get_collector_config, SnowplowConfig
+from objectiv_backend.common.config import get_collector_config, SnowplowConfig, AwsOutputConfig
+from objectiv_backend.common.metrics import SINK_ERRORS
+from objectiv_backend.common.rolling_file import RollingFileWriter, get_rolling_file_writer
+from objectiv_backend.common.s3_writer import BufferedS3Writer, get_s3_writer
+from objectiv_backend.common.serialization import serialize_events
 from objectiv_backend.common.types import EventDataList
 from objectiv_backend.schema.validate_events import EventError
 from objectiv_backend.snowplow.snowplow_helper import write_data_to_aws_pipeline, write_data_to_gcp_pubsub
@@ -21,14 +27,56 @@ if get_collector_config().output.aws:
     import boto3
     from botocore.exceptions import ClientError
 
+# S3 clients per configuration, for this process. See get_connection_pool() for why the pid is checked.
+_s3_clients: Dict[AwsOutputConfig, Any] = {}
+_s3_clients_pid = os.getpid()
+_s3_clients_lock = threading.Lock()
 
-def events_to_json(events: EventDataList) -> str:
+
+def events_to_json(events: EventDataList, event_jsons: Optional[Sequence[str]] = None) -> str:
     """
     Convert list of events to a string with on each line a json object representing a single event.
     Note that the returned string is not a json list; This format makes it suitable as raw input to AWS
     Athena.
+    :param events: list of events
+    :param event_jsons: optional, the events serialized with serialize_events(), to prevent serializing
+        the events again.
     """
-    return json.dumps(events)
+    if event_jsons is None:
+        event_jsons = serialize_events(events)
+    return f'[{",".join(event_jsons)}]'
+
+
+def write_events_to_fs_if_configured(events: EventDataList,
+                                     event_jsons: Sequence[str],
+                                     prefix: str,
+                                     moment: datetime) -> None:
+    """
+    Write events to disk, if file_system output is configured. If file_system output is not configured, then
+    this function returns directly.
+
+    Depending on the configured file_format, the events are either written to a new json file, see
+    write_data_to_fs_if_configured(), or appended to the current segment of the prefix, see RollingFileWriter.
+    :param events: events to write
+    :param event_jsons: the events serialized with serialize_events()
+    :param prefix: directory prefix, added to path after the configured path/
+    :param moment: timestamp that the data arrived
+    """
+    fs_config = get_collector_config().output.file_system
+    if not fs_config:
+        return
+    if fs_config.file_format == 'json':
+        write_data_to_fs_if_configured(data=events_to_json(events, event_jsons), prefix=prefix, moment=moment)
+        return
+    directory = f'{fs_config.path}/{prefix}'
+    writer = get_rolling_file_writer(directory, lambda: RollingFileWriter(
+        directory=directory,
+        file_format=fs_config.file_format,
+        compression=fs_config.compression,
+        max_bytes=fs_config.segment_max_bytes,
+        max_seconds=fs_config.segment_max_seconds,
+        fsync=fs_config.fsync))
+    writer.write(events, event_jsons)
 
 
 def write_data_to_fs_if_configured(data: str, prefix: str, moment: datetime) -> None:
@@ -43,9 +91,62 @@ def write_data_to_fs_if_configured(data: str, prefix: str, moment: datetime) ->
     if not fs_config:
         return
     timestamp = moment.timestamp()
-    path = f'{fs_config.path}/{prefix}/{timestamp}.json'
-    with open(path, 'w') as of:
+    # Requests that arrive at the same moment must not overwrite each other's file, hence the random part.
+    # The data is written to a hidden file first, so readers never see an incomplete file.
+    filename = f'{timestamp}-{uuid.uuid4().hex[:8]}.json'
+    path = f'{fs_config.path}/{prefix}/{filename}'
+    temp_path = f'{fs_config.path}/{prefix}/.{filename}.inprogress'
+    with open(temp_path, 'w') as of:
         of.write(data)
+    os.rename(temp_path, path)
+
+
+def _get_s3_client(aws_config: AwsOutputConfig):
+    """ Get the cached boto3 S3 client for the configuration for this process, creating it if needed. """
+    global _s3_clients, _s3_clients_pid
+    with _s3_clients_lock:
+        if _s3_clients_pid != os.getpid():
+            _s3_clients = {}
+            _s3_clients_pid = os.getpid()
+        if aws_config not in _s3_clients:
+            _s3_clients[aws_config] = boto3.client(
+                service_name='s3',
+                region_name=aws_config.region,
+                endpoint_url=aws_config.endpoint_url,
+                aws_access_key_id=aws_config.access_key_id,
+                aws_secret_access_key=aws_config.secret_access_key)
+        return _s3_clients[aws_config]
+
+
+def write_events_to_s3_if_configured(events: EventDataList,
+                                     event_jsons: Sequence[str],
+                                     prefix: str,
+                                     moment: datetime) -> None:
+    """
+    Write events to AWS S3, if S3 output is configured. If S3 output is not configured, then this function
+    returns directly.
+
+    Depending on the configured file_format, the events are either uploaded in a new object, see
+    write_data_to_s3_if_configured(), or added to the current object of the prefix and hour, see
+    BufferedS3Writer.
+    :param events: events to write
+    :param event_jsons: the events serialized with serialize_events()
+    :param prefix: prefix, included in the key name after the configured path/ and datestamp/
+    :param moment: timestamp that the data arrived
+    """
+    aws_config = get_collector_config().output.aws
+    if not aws_config:
+        return
+    if aws_config.file_format == 'json':
+        write_data_to_s3_if_configured(data=events_to_json(events, event_jsons), prefix=prefix, moment=moment)
+        return
+    writer = get_s3_writer(lambda: BufferedS3Writer(
+        client=_get_s3_client(aws_config),
+        bucket=aws_config.bucket,
+        key_prefix=aws_config.s3_prefix,
+        max_bytes=aws_config.object_max_bytes,
+        max_seconds=aws_config.object_max_seconds))
+    writer.write(events=events, event_jsons=event_jsons, prefix=prefix, moment=moment)
 
 
 def write_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) -> None:
@@ -65,14 +166,11 @@ def write_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) ->
     datestamp = moment.strftime('%Y/%m/%d')
     object_name = f'{aws_config.s3_prefix}/{datestamp}/{prefix}/{timestamp}.json'
     file_obj = BytesIO(data.encode('utf-8'))
-    s3_client = boto3.client(
-        service_name='s3',
-        region_name=aws_config.region,
-        aws_access_key_id=aws_config.access_key_id,
-        aws_secret_access_key=aws_config.secret_access_key)
+    s3_client = _get_s3_client(aws_config)
     try:
         s3_client.upload_fileobj(file_obj, aws_config.bucket, object_name)
     except ClientError as e:
+        SINK_ERRORS.inc(labels=('s3',))
         print(f'Error uploading to s3: {e} ')
 
 
@@ -0,0 +1,25 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import psycopg2
+from flask import Response
+
+from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.db import update_pool_metrics
+from objectiv_backend.common.metrics import generate_metrics, METRICS_CONTENT_TYPE
+
+
+def metrics() -> Response:
+    """
+    Endpoint that returns the metrics of this collector process, in the Prometheus text format. Only
+    registered if COLLECTOR_METRICS_ENDPOINT is set. With multiple collector processes, every request gets the
+    metrics of the process that handles it, so this is only correct with a single process. This doesn't
+    query the database: the depth of the queues is exported by the workers.
+    """
+    pg_config = get_collector_config().output.postgres
+    if pg_config:
+        try:
+            update_pool_metrics(pg_config)
+        except psycopg2.Error as exc:
+            print(f'Error getting connection pool metrics: {exc}')
+    return Response(generate_metrics(), status=200, content_type=METRICS_CONTENT_TYPE)
@@ -1,24 +1,110 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import gzip
+import hashlib
 import json
+import threading
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
 
+import flask
 from flask import Response
 
-from objectiv_backend.common.config import get_collector_config
-from objectiv_backend.end_points.common import get_json_response
+from objectiv_backend.common.config import SCHEMA_CACHE_MAX_AGE, get_collector_config
+from objectiv_backend.schema.event_schemas import EventSchema
 from objectiv_backend.schema.generate_json_schema import generate_json_schema
 
 
+class _CachedBody(NamedTuple):
+    """ Serialized body of a response, with a strong ETag. """
+    body: bytes
+    etag: str
+
+
+class _CachedResponse(NamedTuple):
+    """ Precomputed body of a schema endpoint, uncompressed and gzip-compressed. """
+    identity: _CachedBody
+    gzip: _CachedBody
+
+
+def _serialize_schema(event_schema: EventSchema) -> str:
+    """ The event schema in our own notation. """
+    return str(event_schema)
+
+
+def _serialize_json_schema(event_schema: EventSchema) -> str:
+    """ A jsonschema that describes the event schema. """
+    return json.dumps(generate_json_schema(event_schema), indent=4)
+
+
+_SERIALIZERS: Dict[str, Callable[[EventSchema], str]] = {
+    'schema': _serialize_schema,
+    'jsonschema': _serialize_json_schema,
+}
+
+# The responses for the event_schema that they were computed for. Recomputed if the event schema of the
+# collector config changes.
+_CACHE: Tuple[Optional[EventSchema], Dict[str, _CachedResponse]] = (None, {})
+_CACHE_LOCK = threading.Lock()
+
+
+def _make_cached_response(msg: str) -> _CachedResponse:
+    body = msg.encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    # A strong ETag identifies the exact bytes, so the compressed body gets its own ETag. mtime=0 makes the
+    # compressed body the same for each process.
+    return _CachedResponse(
+        identity=_CachedBody(body=body, etag=digest),
+        gzip=_CachedBody(body=gzip.compress(body, compresslevel=9, mtime=0), etag=f'{digest}-gzip')
+    )
+
+
+def init_schema_responses() -> Dict[str, _CachedResponse]:
+    """
+    Serialize and compress the bodies of the schema endpoints, for the event schema of the collector config.
+    Called when the app is created, and again if the event schema changes.
+    """
+    global _CACHE
+    event_schema = get_collector_config().event_schema
+    with _CACHE_LOCK:
+        cached_schema, responses = _CACHE
+        if cached_schema is not event_schema:
+            responses = {name: _make_cached_response(serializer(event_schema))
+                         for name, serializer in _SERIALIZERS.items()}
+            _CACHE = (event_schema, responses)
+        return responses
+
+
+def _get_response(name: str) -> Response:
+    """
+    Response with the precomputed body of the given endpoint. Returns the gzip-compressed body if the client
+    accepts it, and 304 Not Modified if the client already has the body, according to If-None-Match.
+    """
+    cached_schema, responses = _CACHE
+    if cached_schema is not get_collector_config().event_schema:
+        responses = init_schema_responses()
+    cached = responses[name]
+
+    request = flask.request
+    cached_body = cached.gzip if request.accept_encodings['gzip'] else cached.identity
+    if request.if_none_match.contains_weak(cached_body.etag):
+        response = Response(status=304)
+    else:
+        response = Response(mimetype='application/json', status=200, response=cached_body.body)
+        if cached_body is cached.gzip:
+            response.content_encoding = 'gzip'
+    response.set_etag(cached_body.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = SCHEMA_CACHE_MAX_AGE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 def schema() -> Response:
     """ Endpoint that returns the event schema in our own notation. """
-    event_schema = get_collector_config().event_schema
-    msg = str(event_schema)
-    return get_json_response(status=200, msg=msg)
+    return _get_response('schema')
 
 
 def json_schema() -> Response:
     """ Endpoint that returns a jsonschema that describes the event schema. """
-    event_schema = get_collector_config().event_schema
-    msg = json.dumps(generate_json_schema(event_schema), indent=4)
-    return get_json_response(status=200, msg=msg)
+    return _get_response('jsonschema')
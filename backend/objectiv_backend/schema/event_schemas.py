@@ -3,17 +3,34 @@ Copyright 2021 Objectiv B.V.
 """
 import json5  # type: ignore
 import json
+import jsonschema
 import os
 import re
 import sys
 from copy import deepcopy
-from typing import Set, List, Dict, Any, Optional, Tuple
+from typing import Set, List, Dict, Any, Optional, Tuple, FrozenSet
 import pkgutil
 
 from objectiv_backend.common.types import EventType, ContextType, EventListSchema
 
 MAX_HIERARCHY_DEPTH = 100
 
+# Name of the base schema file, in this package
+BASE_SCHEMA_NAME = 'base_schema.json5'
+
+
+def compile_json_schema_validator(schema: Dict[str, Any], check: bool = True) -> Any:
+    """
+    Check that schema is a valid json-schema, and create a validator object for it.
+    Creating a validator is expensive, validating an instance with an existing validator is cheap.
+    :param check: If False, then schema is not checked. Only use this for schemas that have been checked
+        before, checking is the expensive part.
+    """
+    validator_class = jsonschema.validators.validator_for(schema)
+    if check:
+        validator_class.check_schema(schema)
+    return validator_class(schema)
+
 
 class EventSubSchema:
     """
@@ -31,7 +48,9 @@ class EventSubSchema:
         # _compiled_* fields are derived fields that need to be calculated after self.schema is set.
         self._compiled_list_event_types: List[EventType] = []
         self._compiled_all_parents_and_required_contexts: \
-            Dict[EventType, Tuple[Set[EventType], Set[ContextType]]] = {}
+            Dict[EventType, Tuple[FrozenSet[EventType], FrozenSet[ContextType]]] = {}
+        self._compiled_sorted_parent_event_types: Dict[EventType, Tuple[EventType, ...]] = {}
+        self._compiled_validators: Dict[EventType, Any] = {}
 
     def get_extended_schema(self, event_schema: Dict[str, Any]) -> 'EventSubSchema':
         """
@@ -63,8 +82,9 @@ class EventSubSchema:
 
     def _compile(self):
         """
-        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(), and
-        get_all_required_contexts.
+        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(),
+        get_sorted_parent_event_types(), get_all_required_contexts, get_required_contexts() and
+        get_event_validator().
         2) Makes sure the event hierarchy has no cycles
         Must be called after the schema has changed.
         """
@@ -73,12 +93,58 @@ class EventSubSchema:
         self._compiled_all_parents_and_required_contexts = {}
         for event_type in self._compiled_list_event_types:
             self._compile_parents_and_contexts(event_type)
+        self._compiled_sorted_parent_event_types = {
+            event_type: tuple(sorted(parents))
+            for event_type, (parents, _) in self._compiled_all_parents_and_required_contexts.items()
+        }
+        self._compile_validators(check=True)
+
+    def _compile_validators(self, check: bool):
+        self._compiled_validators = {}
+        for event_type in self._compiled_list_event_types:
+            schema = self.get_event_schema(event_type)
+            assert schema is not None  # help out mypy
+            self._compiled_validators[event_type] = compile_json_schema_validator(schema, check=check)
+
+    def get_compiled_hierarchy(self) -> Dict[EventType, Dict[str, List[str]]]:
+        """
+        Give the compiled hierarchy as a json-serializable dict: per event type the sorted parent event types,
+        and the sorted required context types. See from_compiled_hierarchy().
+        """
+        return {
+            event_type: {
+                'parents': list(self._compiled_sorted_parent_event_types[event_type]),
+                'requiresContext': sorted(self._compiled_all_parents_and_required_contexts[event_type][1])
+            }
+            for event_type in self._compiled_list_event_types
+        }
+
+    @staticmethod
+    def from_compiled_hierarchy(schema: Dict[EventType, Any],
+                                hierarchy: Dict[EventType, Dict[str, List[str]]]) -> 'EventSubSchema':
+        """
+        Create an EventSubSchema from a schema, and the get_compiled_hierarchy() of an EventSubSchema with that
+        schema. This skips the checks of get_extended_schema(), and the checks of the json-schemas of the
+        validators, so it's only safe for a schema and hierarchy that have been compiled before.
+        """
+        event_sub_schema = EventSubSchema()
+        event_sub_schema.schema = schema
+        event_sub_schema._compiled_list_event_types = sorted(schema.keys())
+        event_sub_schema._compiled_all_parents_and_required_contexts = {
+            event_type: (frozenset(compiled['parents']), frozenset(compiled['requiresContext']))
+            for event_type, compiled in hierarchy.items()
+        }
+        event_sub_schema._compiled_sorted_parent_event_types = {
+            event_type: tuple(compiled['parents']) for event_type, compiled in hierarchy.items()
+        }
+        event_sub_schema._compile_validators(check=False)
+        return event_sub_schema
 
     def _compile_parents_and_contexts(
             self,
             event_type: EventType,
             count=MAX_HIERARCHY_DEPTH
-    ) -> Tuple[Set[EventType], Set[ContextType]]:
+    ) -> Tuple[FrozenSet[EventType], FrozenSet[ContextType]]:
         """
         For a given event-type give:
         1) all event-types that this type is, i.e. the type itself and all its parents
@@ -109,7 +175,7 @@ class EventSubSchema:
             event_types |= parent_event_types
             context_types |= parent_context_types
 
-        result = event_types, context_types
+        result = frozenset(event_types), frozenset(context_types)
         self._compiled_all_parents_and_required_contexts[event_type] = result
         return result
 
@@ -125,7 +191,18 @@ class EventSubSchema:
         """
         if not self.is_valid_event_type(event_type):
             raise ValueError(f'Not a valid event_type {event_type}')
-        return {e for e in self._compiled_all_parents_and_required_contexts[event_type][0]}
+        return set(self.get_sorted_parent_event_types(event_type))
+
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        """
+        Same as get_all_parent_event_types(), but as an alphabetically sorted tuple. The tuple is not copied,
+        so this is a cheap lookup.
+        :param event_type: event type. Must be a valid event_type
+        """
+        try:
+            return self._compiled_sorted_parent_event_types[event_type]
+        except KeyError:
+            raise ValueError(f'Not a valid event_type {event_type}')
 
     def get_all_required_contexts(self, event_type: EventType) -> Set[ContextType]:
         """
@@ -136,7 +213,17 @@ class EventSubSchema:
         """
         if not self.is_valid_event_type(event_type):
             raise ValueError(f'Not a valid event_type {event_type}')
-        return {ctx for ctx in self._compiled_all_parents_and_required_contexts[event_type][1]}
+        return set(self.get_required_contexts(event_type))
+
+    def get_required_contexts(self, event_type: EventType) -> FrozenSet[ContextType]:
+        """
+        Same as get_all_required_contexts(), but as a frozenset that is not copied, so this is a cheap lookup.
+        :param event_type: event type. Must be a valid event_type
+        """
+        try:
+            return self._compiled_all_parents_and_required_contexts[event_type][1]
+        except KeyError:
+            raise ValueError(f'Not a valid event_type {event_type}')
 
     def is_valid_event_type(self, event_type: EventType) -> bool:
         return event_type in self.schema
@@ -166,6 +253,13 @@ class EventSubSchema:
         }
         return schema
 
+    def get_event_validator(self, event_type: EventType) -> Optional[Any]:
+        """
+        Give a json-schema validator for the schema returned by get_event_schema(), or None if the event
+        type doesn't exist.
+        """
+        return self._compiled_validators.get(event_type)
+
 
 class ContextSubSchema:
     """
@@ -181,9 +275,11 @@ class ContextSubSchema:
         self.schema: Dict[str, Any] = {}
         # _compiled_* fields are derived fields that need to be calculated after self.schema is set.
         self._compiled_list_context_types: List[ContextType] = []
-        self._compiled_all_parents_and_required_context_types: \
-            Dict[ContextType, Dict[str, Set[ContextType]]] = {}
-        self._compiled_all_child_context_types = {}
+        self._compiled_all_parent_and_required_context_types: \
+            Dict[ContextType, Dict[str, FrozenSet[ContextType]]] = {}
+        self._compiled_sorted_parent_context_types: Dict[ContextType, Tuple[ContextType, ...]] = {}
+        self._compiled_all_child_context_types: Dict[ContextType, Set[ContextType]] = {}
+        self._compiled_validators: Dict[ContextType, Any] = {}
 
     CONTEXT_NAME_REGEX = r'^[A-Z][a-zA-Z0-9]*Context$'
 
@@ -228,7 +324,8 @@ class ContextSubSchema:
     def _compile(self):
         """
         1) Pre calculate the return values of list_context_types(), get_all_parent_context_types(),
-            and get_all_child_context_types().
+            get_parent_context_types(), get_sorted_parent_context_types(), get_all_child_context_types(),
+            get_required_context_types(), and get_context_validator().
         2) Makes sure the event hierarchy has no cycles, and all parent-reference exist.
         Must be called after the schema has changed.
         """
@@ -238,6 +335,10 @@ class ContextSubSchema:
         # Calculate parent relations, and do some basic checks on graph
         for context_type in self._compiled_list_context_types:
             self._compile_parent_and_required_context_types(context_type)
+        self._compiled_sorted_parent_context_types = {
+            context_type: tuple(sorted(compiled['parents']))
+            for context_type, compiled in self._compiled_all_parent_and_required_context_types.items()
+        }
 
         # Calculate child relations based on parent relations
         for context_type in self._compiled_list_context_types:
@@ -247,8 +348,59 @@ class ContextSubSchema:
                     children.add(ct)
             self._compiled_all_child_context_types[context_type] = children
 
+        self._compile_validators(check=True)
+
+    def _compile_validators(self, check: bool):
+        self._compiled_validators = {}
+        for context_type in self._compiled_list_context_types:
+            schema = self.get_context_schema(context_type)
+            assert schema is not None  # help out mypy
+            self._compiled_validators[context_type] = compile_json_schema_validator(schema, check=check)
+
+    def get_compiled_hierarchy(self) -> Dict[ContextType, Dict[str, List[str]]]:
+        """
+        Give the compiled hierarchy as a json-serializable dict: per context type the sorted parent context
+        types, required context types and child context types. See from_compiled_hierarchy().
+        """
+        return {
+            context_type: {
+                'parents': list(self._compiled_sorted_parent_context_types[context_type]),
+                'requiresContext': sorted(
+                    self._compiled_all_parent_and_required_context_types[context_type]['requiredContexts']),
+                'children': sorted(self._compiled_all_child_context_types[context_type])
+            }
+            for context_type in self._compiled_list_context_types
+        }
+
+    @staticmethod
+    def from_compiled_hierarchy(schema: Dict[ContextType, Any],
+                                hierarchy: Dict[ContextType, Dict[str, List[str]]]) -> 'ContextSubSchema':
+        """
+        Create a ContextSubSchema from a schema, and the get_compiled_hierarchy() of a ContextSubSchema with
+        that schema. This skips the checks of get_extended_schema(), and the checks of the json-schemas of the
+        validators, so it's only safe for a schema and hierarchy that have been compiled before.
+        """
+        context_schema = ContextSubSchema()
+        context_schema.schema = schema
+        context_schema._compiled_list_context_types = sorted(schema.keys())
+        context_schema._compiled_all_parent_and_required_context_types = {
+            context_type: {
+                'parents': frozenset(compiled['parents']),
+                'requiredContexts': frozenset(compiled['requiresContext'])
+            }
+            for context_type, compiled in hierarchy.items()
+        }
+        context_schema._compiled_sorted_parent_context_types = {
+            context_type: tuple(compiled['parents']) for context_type, compiled in hierarchy.items()
+        }
+        context_schema._compiled_all_child_context_types = {
+            context_type: set(compiled['children']) for context_type, compiled in hierarchy.items()
+        }
+        context_schema._compile_validators(check=False)
+        return context_schema
+
     def _compile_parent_and_required_context_types(self, context_type: ContextType, count=MAX_HIERARCHY_DEPTH) -> \
-            Tuple[Set[ContextType], Set[ContextType]]:
+            Tuple[FrozenSet[ContextType], FrozenSet[ContextType]]:
         """
         * Give the parent context-types of the given context-type (including the given type itself).
         * Fill self._compiled_all_parent_context_types for the explored context_types.
@@ -275,11 +427,12 @@ class ContextSubSchema:
             required_context_types |= rct
             parent_context_types |= pct
 
-        self._compiled_all_parent_and_required_context_types[context_type] = {
-            'parents': parent_context_types,
-            'requiredContexts': required_context_types
+        compiled = {
+            'parents': frozenset(parent_context_types),
+            'requiredContexts': frozenset(required_context_types)
         }
-        return parent_context_types, required_context_types
+        self._compiled_all_parent_and_required_context_types[context_type] = compiled
+        return compiled['parents'], compiled['requiredContexts']
 
     def list_context_types(self) -> List[ContextType]:
         """ Give a alphabetically sorted list of all context-types. """
@@ -289,15 +442,41 @@ class ContextSubSchema:
         """
         Given a context_type, give a set with that context_type and all its parent context_types
         """
-        return {t for t in self._compiled_all_parent_and_required_context_types.get(context_type, {}).get('parents', {
-            context_type})}
+        return set(self.get_parent_context_types(context_type))
+
+    def get_parent_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        """
+        Same as get_all_parent_context_types(), but as a frozenset that is not copied, so this is a cheap
+        lookup for valid context types.
+        """
+        compiled = self._compiled_all_parent_and_required_context_types.get(context_type)
+        if compiled is None:
+            return frozenset([context_type])
+        return compiled['parents']
+
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        """
+        Same as get_all_parent_context_types(), but as an alphabetically sorted tuple that is not copied, so
+        this is a cheap lookup for valid context types.
+        """
+        return self._compiled_sorted_parent_context_types.get(context_type, (context_type,))
 
     def get_all_required_context_types(self, context_type: ContextType) -> Set[ContextType]:
         """
-        Given a context_type, give a set with that context_type and all its parent context_types
+        Given a context_type, give a set with all context_types that are required by that context_type and
+        its parent context_types
+        """
+        return set(self.get_required_context_types(context_type))
+
+    def get_required_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        """
+        Same as get_all_required_context_types(), but as a frozenset that is not copied, so this is a cheap
+        lookup.
         """
-        return {c for c in
-                self._compiled_all_parent_and_required_context_types.get(context_type, {}).get('requiredContexts', {})}
+        compiled = self._compiled_all_parent_and_required_context_types.get(context_type)
+        if compiled is None:
+            return frozenset()
+        return compiled['requiredContexts']
 
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         """
@@ -332,6 +511,13 @@ class ContextSubSchema:
         }
         return schema
 
+    def get_context_validator(self, context_type: ContextType) -> Optional[Any]:
+        """
+        Give a json-schema validator for the schema returned by get_context_schema(), or None if the
+        context type doesn't exist.
+        """
+        return self._compiled_validators.get(context_type)
+
 
 class EventSchema:
     """
@@ -362,12 +548,11 @@ class EventSchema:
             * adding properties to an existing context
             * adding sub-properties to an existing context (e.g. a "minimum" field for an integer)
         """
-        events = deepcopy(self.events)
-        contexts = deepcopy(self.contexts)
+        # The sub-schemas are immutable, and get_extended_schema() returns a new object, so there is no
+        # need to copy them here.
+        events = self.events.get_extended_schema(schema['events'])
+        contexts = self.contexts.get_extended_schema(schema['contexts'])
         version = deepcopy(self.version)
-
-        events = events.get_extended_schema(schema['events'])
-        contexts = contexts.get_extended_schema(schema['contexts'])
         version.update(schema['version'])
         # todo: separate version merging, and do some validation on this
         # extension_name = event_schema['name']
@@ -421,12 +606,21 @@ class EventSchema:
         """
         return self.events.get_all_parent_event_types(event_type=event_type)
 
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        return self.events.get_sorted_parent_event_types(event_type=event_type)
+
     def get_all_required_contexts_for_event(self, event_type: EventType) -> Set[ContextType]:
         return self.events.get_all_required_contexts(event_type=event_type)
 
+    def get_required_contexts_for_event(self, event_type: EventType) -> FrozenSet[ContextType]:
+        return self.events.get_required_contexts(event_type=event_type)
+
     def get_all_required_contexts_for_context(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_required_context_types(context_type=context_type)
 
+    def get_required_contexts_for_context(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        return self.contexts.get_required_context_types(context_type=context_type)
+
     def is_valid_event_type(self, event_type: EventType) -> bool:
         return self.events.is_valid_event_type(event_type=event_type)
 
@@ -436,6 +630,12 @@ class EventSchema:
     def get_all_parent_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_parent_context_types(context_type=context_type)
 
+    def get_parent_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        return self.contexts.get_parent_context_types(context_type=context_type)
+
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        return self.contexts.get_sorted_parent_context_types(context_type=context_type)
+
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_child_context_types(context_type=context_type)
 
@@ -445,52 +645,123 @@ class EventSchema:
     def get_event_schema(self, event_type: EventType) -> Optional[Dict[str, Any]]:
         return self.events.get_event_schema(event_type=event_type)
 
+    def get_context_validator(self, context_type: ContextType) -> Optional[Any]:
+        return self.contexts.get_context_validator(context_type=context_type)
 
-def get_event_list_schema() -> EventListSchema:
-    data = pkgutil.get_data(__name__, "event_list.json5")
-    schema_json = json5.loads(data)
-
-    return schema_json
+    def get_event_validator(self, event_type: EventType) -> Optional[Any]:
+        return self.events.get_event_validator(event_type=event_type)
 
 
-def get_event_schema(schema_extensions_directory: Optional[str]) -> EventSchema:
+def get_event_list_schema(event_schema: EventSchema, deep: bool = True) -> EventListSchema:
     """
-    Get the event schema.
-
-    The schema is based on schema/base_schema.json5 and the schema files in the optional
+    Give a json-schema to validate a list of events, as sent by the tracker. The schema is based on
+    schema/event_list.json5, in which the events are described with the properties of the AbstractEvent from
+    the event_schema.
+
+    The schema checks the structure of the list and the events, but not the schema-dependent details, e.g.
+    whether the event type is valid, or whether the contexts have the right properties. For that use the
+    validators of the event_schema.
+
+    :param event_schema: schema from which the definition of AbstractEvent is taken
+    :param deep: If True, then the events are checked against all details of the properties of
+        AbstractEvent, and all contexts must have an id and _type. If False, then only the presence and
+        json-type of the event properties, and the presence of _type in the contexts are checked. This suffices
+        for calling validate_event_adheres_to_schema() on the events, which checks the remaining details.
+    """
+    data = pkgutil.get_data(__name__, "event_list.json5")
+    event_list_schema = json5.loads(data)
+
+    # The event_list schema wants a list of AbstractEvents. As that is not a valid json-schema type, we
+    # replace it with an 'object' with the properties of AbstractEvent.
+    events_items = event_list_schema.get('properties', {}).get('events', {}).get('items', {})
+    if events_items.get('type') != 'AbstractEvent':
+        return event_list_schema
+    events_items['type'] = 'object'
+    if not event_schema.is_valid_event_type('AbstractEvent'):
+        return event_list_schema
+
+    abstract_properties = event_schema.events.schema['AbstractEvent']['properties']
+    properties: Dict[str, Any] = {}
+    for property_name, property_desc in abstract_properties.items():
+        items_type = property_desc.get('items', {}).get('type', '')
+        property_desc = deepcopy(property_desc) if deep else {'type': property_desc['type']}
+        if re.match('^Abstract.*?Context$', items_type):
+            # we don't want to go into the validation / schema of contexts here, a check on the properties
+            # that every context has will suffice
+            property_desc['items'] = {
+                'type': 'object',
+                'properties': {'_type': {'type': 'string'}, 'id': {'type': 'string'}},
+                'required': ['_type', 'id']
+            } if deep else {
+                'type': 'object',
+                'required': ['_type']
+            }
+        properties[property_name] = property_desc
+    events_items['properties'] = properties
+    events_items['required'] = sorted(
+        p for p, v in abstract_properties.items() if not v.get('optional', False)
+    )
+    return event_list_schema
+
+
+def get_schema_sources(schema_extensions_directory: Optional[str]) -> List[Tuple[str, bytes]]:
+    """
+    Get the schema files that get_event_schema() combines, in the order in which they are combined: the base
+    schema (BASE_SCHEMA_NAME), unless LOAD_BASE_SCHEMA is false, and the files in the optional
     schema_extension_directory.
     Files in the extension directory qualify for loading if their name matches [a-z0-9_]+\\.json.
     The files are loaded in alphabetical order.
 
     :param schema_extensions_directory: optional directory path.
+    :return: list of tuples: name of the file (the path for files in the extension directory), and the
+        contents of the file.
     """
-
-    schema_jsons = []
+    sources = []
     # load base schema from the current dir using pkgutil
     # this should also work when running from a zipped package
     from objectiv_backend.common.config import LOAD_BASE_SCHEMA
     if LOAD_BASE_SCHEMA:
-        data = pkgutil.get_data(__name__, "base_schema.json5")
+        data = pkgutil.get_data(__name__, BASE_SCHEMA_NAME)
         if data:
-            base_schema = json5.loads(data)
-            schema_jsons.append(base_schema)
+            sources.append((BASE_SCHEMA_NAME, data))
 
-    files_to_load = []
     if schema_extensions_directory:
         all_filenames = sorted(os.listdir(schema_extensions_directory))
         for filename in all_filenames:
             if not re.match(r'[a-z0-9_]+\.json', filename):
                 print(f'Ignoring non-schema file: {filename}', file=sys.stderr)
                 continue
-            files_to_load.append(os.path.join(schema_extensions_directory, filename))
+            filepath = os.path.join(schema_extensions_directory, filename)
+            with open(filepath, mode='rb') as file:
+                sources.append((filepath, file.read()))
+    return sources
+
+
+def get_event_schema(schema_extensions_directory: Optional[str]) -> EventSchema:
+    """
+    Get the event schema.
+
+    The schema is based on schema/base_schema.json5 and the schema files in the optional
+    schema_extension_directory, see get_schema_sources().
+
+    :param schema_extensions_directory: optional directory path.
+    """
+    return get_event_schema_from_sources(get_schema_sources(schema_extensions_directory))
+
 
-    for filepath in files_to_load:
-        with open(filepath, mode='r') as file:
-            raw_data = file.read()
+def get_event_schema_from_sources(sources: List[Tuple[str, bytes]]) -> EventSchema:
+    """
+    Combine the schema files, as returned by get_schema_sources(), into an event schema.
+    """
+    schema_jsons = []
+    for name, data in sources:
+        if name == BASE_SCHEMA_NAME:
+            schema_jsons.append(json5.loads(data))
+            continue
         try:
-            schema = json.loads(raw_data)
+            schema = json.loads(data)
         except ValueError as exc:
-            raise Exception(f'Schema file does not contain valid json {filepath}') from exc
+            raise Exception(f'Schema file does not contain valid json {name}') from exc
         # todo: schema validation
         schema_jsons.append(schema)
 
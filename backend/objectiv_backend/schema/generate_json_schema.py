@@ -6,8 +6,7 @@ import json
 import sys
 from typing import List, Any, Dict, NamedTuple, Set
 
-from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
-from objectiv_backend.schema.validate_events import get_event_list_schema
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema
 
 
 class SchemaDefinitionTuple(NamedTuple):
@@ -17,7 +16,7 @@ class SchemaDefinitionTuple(NamedTuple):
 
 def generate_json_schema(event_schema: EventSchema) -> Dict[str, Any]:
     sub_schemas = [
-        get_schema_base_properties(),
+        get_schema_base_properties(event_schema=event_schema),
         get_schema_event_required_contexts(event_schema=event_schema),
         get_schema_context_validation(event_schema=event_schema)
     ]
@@ -48,14 +47,14 @@ def _combine_definition(schema_definitions: List[SchemaDefinitionTuple]) -> Dict
     return combined_definitions
 
 
-def get_schema_base_properties() -> SchemaDefinitionTuple:
+def get_schema_base_properties(event_schema: EventSchema) -> SchemaDefinitionTuple:
     """
     Return a json-schema to validate that the data is a list of events, and each event has the base
     properties (event and contexts) and that they are of the right type. Also check that each context
     has the properties id and _type.
     """
     return SchemaDefinitionTuple(
-        schema=get_event_list_schema(),
+        schema=get_event_list_schema(event_schema=event_schema),
         definitions={}
     )
 
@@ -14,41 +14,52 @@ from objectiv_backend.common.types import EventData
 def hydrate_types_into_event(event_schema: EventSchema, event: EventData) -> EventData:
     """
     Modifies the given event:
-        1. adds a "events" field: a list of all inherited event-types (including the event)
-        2. For each context adds a "_types" fields: a list of all inherited context-types
+        1. adds a "_types" field: a sorted tuple of all inherited event-types (including the event)
+        2. For each context adds a "_types" fields: a sorted tuple of all inherited context-types
+
+    The tuples are shared with the event_schema and between events, which is fine as they are immutable.
     :param event_schema: schema to use for type-hydration
     :param event: event object. Must have passed event validation by validate_events.validate_event_data.
     :return: The modified event object.
     """
-    event_name = event['_type']
-    all_event_types = event_schema.get_all_parent_event_types(event_name)
-    event["_types"] = sorted(all_event_types)
-    global_contexts = event['global_contexts']
-    for context in global_contexts:
-        context["_types"] = sorted(
-            event_schema.get_all_parent_context_types(context["_type"])
-        )
-    location_stack = event['location_stack']
-    for context in location_stack:
-        context["_types"] = sorted(
-            event_schema.get_all_parent_context_types(context["_type"])
-        )
+    event["_types"] = event_schema.get_sorted_parent_event_types(event['_type'])
+    get_sorted_parent_context_types = event_schema.get_sorted_parent_context_types
+    for context in event['global_contexts']:
+        context["_types"] = get_sorted_parent_context_types(context["_type"])
+    for context in event['location_stack']:
+        context["_types"] = get_sorted_parent_context_types(context["_type"])
     return event
 
 
 def main(argv: List[str]):
     parser = argparse.ArgumentParser(description='Hydrate events')
     parser.add_argument('--schema-extensions-directory', type=str)
+    # imported here, as stream_events imports this module
+    from objectiv_backend.schema.stream_events import add_stream_arguments, process_event_files
+    add_stream_arguments(parser)
     parser.add_argument('filenames', type=str, nargs='+')
     args = parser.parse_args(argv[1:])
 
+    if args.ndjson:
+        # The hydrated events are written to stdout as ndjson. Invalid events are skipped, and reported on
+        # stderr.
+        summary = process_event_files(paths=args.filenames, hydrate=True,
+                                      schema_extensions_directory=args.schema_extensions_directory,
+                                      processes=args.processes, chunk_size=args.chunk_size,
+                                      errors_output=sys.stderr)
+        if summary.error_count:
+            print(f'Skipped invalid events: {summary.error_count} error(s) in files {summary.files_with_errors}',
+                  file=sys.stderr)
+            exit(1)
+        return
+
     filenames = args.filenames
     event_schema = get_event_schema(schema_extensions_directory=args.schema_extensions_directory)
 
     for filename in filenames:
         with open(filename) as file:
             event_data = json.loads(file.read())
-        errors = validate_event_list(event_schema=event_schema, event_data=event_data['events'])
+        errors = validate_event_list(event_schema=event_schema, event_data=event_data)
         if errors:
             raise Exception(f'Error in file: {filename} - {errors}')
         events = event_data['events']
@@ -0,0 +1,158 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Compiled event schema: a json file with the combined event schema and its compiled type hierarchy. Creating
+the EventSchema from it takes milliseconds, while get_event_schema() parses the schema files with json5 and
+checks the hierarchy and the json-schema of every type, which takes a significant part of a second.
+
+The artifact records the sha256 of each schema file that it was compiled from, and the version of this
+package. It is only used if both match, otherwise the schema is compiled from the schema files as usual.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+from objectiv_backend import __version__
+from objectiv_backend.schema.event_schemas import ContextSubSchema, EventSchema, EventSubSchema, \
+    get_event_schema_from_sources, get_schema_sources
+
+# Version of the layout of the artifact. Increase when the layout changes.
+ARTIFACT_FORMAT = 1
+
+
+def _get_source_hashes(sources: List[Tuple[str, bytes]]) -> List[List[str]]:
+    """ Name and sha256 of each schema file. Only the filename is used, such that artifacts can be moved. """
+    return [[os.path.basename(name), hashlib.sha256(data).hexdigest()] for name, data in sources]
+
+
+def compile_event_schema_artifact(schema_extensions_directory: Optional[str]) -> Dict[str, Any]:
+    """
+    Compile the event schema into a json-serializable artifact. This does all checks of get_event_schema().
+    :param schema_extensions_directory: optional directory path, see get_schema_sources()
+    """
+    sources = get_schema_sources(schema_extensions_directory)
+    event_schema = get_event_schema_from_sources(sources)
+    return {
+        'format': ARTIFACT_FORMAT,
+        'backend_version': __version__,
+        'sources': _get_source_hashes(sources),
+        'version': event_schema.version,
+        'events': {
+            'schema': event_schema.events.schema,
+            'hierarchy': event_schema.events.get_compiled_hierarchy()
+        },
+        'contexts': {
+            'schema': event_schema.contexts.schema,
+            'hierarchy': event_schema.contexts.get_compiled_hierarchy()
+        }
+    }
+
+
+def get_artifact_mismatch(artifact: Dict[str, Any], schema_extensions_directory: Optional[str]) -> Optional[str]:
+    """
+    Check whether the artifact was compiled by this version of the package, from the current schema files.
+    :return: None if the artifact can be used, otherwise a description of the mismatch
+    """
+    if artifact.get('format') != ARTIFACT_FORMAT:
+        return f'format {artifact.get("format")} is not supported, expected {ARTIFACT_FORMAT}'
+    if artifact.get('backend_version') != __version__:
+        return f'compiled by objectiv-backend {artifact.get("backend_version")}, running {__version__}'
+    sources = _get_source_hashes(get_schema_sources(schema_extensions_directory))
+    if artifact.get('sources') != sources:
+        compiled_names = [name for name, _ in artifact.get('sources', [])]
+        current_names = [name for name, _ in sources]
+        if compiled_names != current_names:
+            return f'compiled from schema files {compiled_names}, current files are {current_names}'
+        changed = [name for (name, digest), (_, compiled_digest) in zip(sources, artifact['sources'])
+                   if digest != compiled_digest]
+        return f'schema files changed since compilation: {changed}'
+    return None
+
+
+def event_schema_from_artifact(artifact: Dict[str, Any]) -> EventSchema:
+    """
+    Create the EventSchema from an artifact, without checking it. Use get_artifact_mismatch() to check that the
+    artifact matches the schema files.
+    """
+    event_schema = EventSchema()
+    event_schema.version = artifact['version']
+    event_schema.events = EventSubSchema.from_compiled_hierarchy(
+        schema=artifact['events']['schema'], hierarchy=artifact['events']['hierarchy'])
+    event_schema.contexts = ContextSubSchema.from_compiled_hierarchy(
+        schema=artifact['contexts']['schema'], hierarchy=artifact['contexts']['hierarchy'])
+    return event_schema
+
+
+def write_event_schema_artifact(path: str, artifact: Dict[str, Any]):
+    """ Write the artifact to path. The file is replaced atomically, so readers never see a partial file. """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(artifact, file)
+    os.replace(temp_path, path)
+
+
+def read_event_schema_artifact(path: str) -> Dict[str, Any]:
+    """
+    Read the artifact at path.
+    :raise OSError: if the file cannot be read
+    :raise ValueError: if the file doesn't contain valid json
+    """
+    with open(path, 'rb') as file:
+        return json.loads(file.read())
+
+
+def load_event_schema_artifact(path: str, schema_extensions_directory: Optional[str]) -> Optional[EventSchema]:
+    """
+    Load the event schema from the artifact at path.
+    :param schema_extensions_directory: optional directory path, see get_schema_sources()
+    :return: the EventSchema, or None if the artifact cannot be read, or doesn't match the schema files.
+    """
+    try:
+        artifact = read_event_schema_artifact(path)
+    except (OSError, ValueError) as exc:
+        print(f'Cannot read schema artifact {path}, compiling the schema instead: {exc}', file=sys.stderr)
+        return None
+    mismatch = get_artifact_mismatch(artifact, schema_extensions_directory)
+    if mismatch:
+        print(f'Schema artifact {path} is out of date, compiling the schema instead: {mismatch}. '
+              f'Run objectiv-compile-schema to update it.', file=sys.stderr)
+        return None
+    return event_schema_from_artifact(artifact)
+
+
+def main():
+    from objectiv_backend.common.config import SCHEMA_EXTENSION_DIRECTORY
+    parser = argparse.ArgumentParser(
+        description='Compile the event schema into an artifact, from which the collector and workers load the '
+                    'schema at startup, if SCHEMA_ARTIFACT is set to its path.')
+    parser.add_argument('--schema-extensions-directory', type=str, default=SCHEMA_EXTENSION_DIRECTORY,
+                        help='default: the SCHEMA_EXTENSION_DIRECTORY environment variable')
+    parser.add_argument('--output', type=str, required=True, help='path of the artifact')
+    parser.add_argument('--check', action='store_true',
+                        help='do not write the artifact, but exit with status 1 if it is out of date')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.check:
+        try:
+            artifact = read_event_schema_artifact(args.output)
+        except (OSError, ValueError) as exc:
+            print(f'Cannot read {args.output}: {exc}')
+            sys.exit(1)
+        mismatch = get_artifact_mismatch(artifact, args.schema_extensions_directory)
+        if mismatch:
+            print(f'{args.output} is out of date: {mismatch}')
+            sys.exit(1)
+        print(f'{args.output} is up to date')
+        return
+
+    artifact = compile_event_schema_artifact(args.schema_extensions_directory)
+    write_event_schema_artifact(args.output, artifact)
+    print(f'Wrote {args.output}: {len(artifact["events"]["schema"])} event types, '
+          f'{len(artifact["contexts"]["schema"])} context types')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Streaming validation and hydration of event files, for the --ndjson mode of objectiv-validate-events and
+hydrate_events. Files are read in chunks of events, which are validated (and hydrated) by a pool of
+processes. The results are written in the order of the input, as soon as they are available. At most a few
+chunks per process are in memory at any time, so the memory use doesn't depend on the size of the files.
+
+Supported files:
+    * ndjson: files named *.ndjson or *.jsonl, optionally compressed (*.gz, or *.zst which requires
+        zstandard), with an event per line. E.g. the segments of the file system output with
+        FILESYSTEM_OUTPUT_FORMAT=ndjson. These are split into chunks.
+    * json: any other file, with a json list of events (as written by the file system output with
+        FILESYSTEM_OUTPUT_FORMAT=json), or a json object with an 'events' list (as sent by the tracker).
+        These are processed as a single chunk.
+Directories are searched recursively for files. Hidden files, e.g. segments that are still being written,
+are skipped.
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, BinaryIO, Deque, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+from objectiv_backend.common.serialization import json_dumps, json_loads
+from objectiv_backend.common.types import EventData
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
+from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
+from objectiv_backend.schema.validate_events import ErrorInfo, validate_event_adheres_to_schema, \
+    validate_structure_event_list
+
+# Number of events per chunk, for ndjson files
+DEFAULT_CHUNK_SIZE = 1000
+# Interval at which the progress is reported
+PROGRESS_INTERVAL_SECONDS = 10.0
+
+_NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+_COMPRESSION_EXTENSIONS = ('.gz', '.zst')
+
+# Event schema of a process of the pool, see _init_process()
+_EVENT_SCHEMA: Optional[EventSchema] = None
+_EVENT_SCHEMA_DIRECTORY: Optional[str] = None
+
+
+class _Chunk(NamedTuple):
+    """ Part of a file. For ndjson files the lines, starting at first_line. For json files lines is None. """
+    filename: str
+    first_line: int
+    lines: Optional[List[bytes]]
+
+
+class ChunkResult(NamedTuple):
+    filename: str
+    event_count: int
+    # Size of the processed data, uncompressed
+    byte_count: int
+    # A line per error: its location (the file and line, or index in the list of events), the event id, and the
+    # first line of the error message
+    errors: List[str]
+    # The hydrated valid events as json, if hydrating
+    output: List[str]
+
+
+class StreamSummary(NamedTuple):
+    file_count: int
+    event_count: int
+    error_count: int
+    files_with_errors: List[str]
+
+
+def add_stream_arguments(parser: argparse.ArgumentParser):
+    """ Add the arguments of the streaming mode, see objectiv_backend.schema.stream_events """
+    parser.add_argument('--ndjson', action='store_true',
+                        help='streaming mode: process the files, and the files in directories, in chunks with a '
+                             'pool of processes. Files named *.ndjson or *.jsonl (optionally .gz or .zst) have an '
+                             'event per line.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='number of processes, for --ndjson. Default: the number of cpus')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='number of events per chunk of an ndjson file, for --ndjson')
+
+
+def list_event_files(paths: List[str]) -> List[str]:
+    """
+    Give the files to process: the paths that are files, and the files in the paths that are directories,
+    recursively and in sorted order. Hidden files and directories are skipped.
+    """
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories[:] = sorted(d for d in subdirectories if not d.startswith('.'))
+            filenames.extend(os.path.join(directory, f) for f in sorted(files) if not f.startswith('.'))
+    return filenames
+
+
+def _is_ndjson(filename: str) -> bool:
+    name = filename
+    for extension in _COMPRESSION_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith(_NDJSON_EXTENSIONS)
+
+
+def _open_file(filename: str) -> BinaryIO:
+    """ Open the file for reading, decompressing it if it's named *.gz or *.zst. """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')  # type: ignore
+    if filename.endswith('.zst'):
+        import zstandard  # type: ignore
+        return zstandard.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _read_chunks(filename: str, chunk_size: int) -> Iterator[_Chunk]:
+    if not _is_ndjson(filename):
+        yield _Chunk(filename=filename, first_line=1, lines=None)
+        return
+    with _open_file(filename) as file:
+        first_line = 1
+        lines: List[bytes] = []
+        for line in file:
+            lines.append(line)
+            if len(lines) >= chunk_size:
+                yield _Chunk(filename=filename, first_line=first_line, lines=lines)
+                first_line += len(lines)
+                lines = []
+        if lines:
+            yield _Chunk(filename=filename, first_line=first_line, lines=lines)
+
+
+def _init_process(schema_extensions_directory: Optional[str]):
+    """ Load the event schema, unless this process already has it, e.g. because it's a fork of the parent. """
+    global _EVENT_SCHEMA, _EVENT_SCHEMA_DIRECTORY
+    if _EVENT_SCHEMA is None or _EVENT_SCHEMA_DIRECTORY != schema_extensions_directory:
+        _EVENT_SCHEMA = get_event_schema(schema_extensions_directory=schema_extensions_directory)
+        _EVENT_SCHEMA_DIRECTORY = schema_extensions_directory
+
+
+def _parse_chunk(chunk: _Chunk) -> Tuple[List[Tuple[str, Any]], List[str], int]:
+    """
+    Parse the events of the chunk.
+    :return: tuple: list with the location and data of each event, errors for lines that are not valid json,
+        and the size of the data
+    """
+    if chunk.lines is None:
+        with open(chunk.filename, 'rb') as file:
+            data = file.read()
+        try:
+            event_data = json_loads(data)
+        except ValueError as exc:
+            return [], [f'{chunk.filename}: invalid json: {exc}'], len(data)
+        events = event_data.get('events') if isinstance(event_data, dict) else event_data
+        if not isinstance(events, list):
+            return [], [f'{chunk.filename}: not a list of events, nor an object with an events list'], len(data)
+        return [(f'{chunk.filename}[{index}]', event) for index, event in enumerate(events)], [], len(data)
+
+    located_events = []
+    errors = []
+    for line_number, line in enumerate(chunk.lines, start=chunk.first_line):
+        if not line.strip():
+            continue
+        location = f'{chunk.filename}:{line_number}'
+        try:
+            located_events.append((location, json_loads(line)))
+        except ValueError as exc:
+            errors.append(f'{location}: invalid json: {exc}')
+    return located_events, errors, sum(len(line) for line in chunk.lines)
+
+
+def _validate_event(event_schema: EventSchema, event: Any) -> List[ErrorInfo]:
+    errors = validate_structure_event_list({'events': [event], 'transport_time': 0})
+    if errors:
+        return errors
+    return validate_event_adheres_to_schema(event_schema=event_schema, event=event)
+
+
+def _process_chunk(chunk: _Chunk, hydrate: bool) -> ChunkResult:
+    """ Validate, and optionally hydrate, the events of the chunk. Runs in the processes of the pool. """
+    assert _EVENT_SCHEMA is not None  # set by _init_process()
+    event_schema = _EVENT_SCHEMA
+    located_events, errors, byte_count = _parse_chunk(chunk)
+
+    # Check the structure of all events at once, and only check them one by one if that fails, to find the
+    # invalid ones.
+    events: List[EventData] = [event for _, event in located_events]
+    structure_valid = not validate_structure_event_list({'events': events, 'transport_time': 0})
+    output = []
+    for location, event in located_events:
+        if structure_valid:
+            event_errors = validate_event_adheres_to_schema(event_schema=event_schema, event=event)
+        else:
+            event_errors = _validate_event(event_schema=event_schema, event=event)
+        if event_errors:
+            event_id = event.get('id') if isinstance(event, dict) else None
+            errors.extend(f'{location}: event {event_id}: {error.info.splitlines()[0]}' for error in event_errors)
+        elif hydrate:
+            output.append(json_dumps(hydrate_types_into_event(event_schema=event_schema, event=event)))
+    return ChunkResult(filename=chunk.filename, event_count=len(located_events), byte_count=byte_count,
+                       errors=errors, output=output)
+
+
+def _process_chunks_in_pool(chunks: Iterator[_Chunk],
+                            hydrate: bool,
+                            schema_extensions_directory: Optional[str],
+                            processes: int) -> Iterator[ChunkResult]:
+    """
+    Process the chunks with a pool of processes, and yield the results in the order of the chunks. Only a few
+    chunks per process are read ahead, so that memory use is bounded.
+    """
+    max_pending = processes * 4
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_process,
+                             initargs=(schema_extensions_directory,)) as executor:
+        pending: Deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_process_chunk, chunk, hydrate))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process_event_files(paths: List[str],
+                        hydrate: bool,
+                        schema_extensions_directory: Optional[str] = None,
+                        processes: int = 1,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        output: TextIO = sys.stdout,
+                        errors_output: TextIO = sys.stdout,
+                        progress_output: TextIO = sys.stderr) -> StreamSummary:
+    """
+    Validate, and optionally hydrate, the events in the files. See the module documentation for the supported
+    files.
+    :param paths: files and directories with event files
+    :param hydrate: If True, the valid events are hydrated and written to output as ndjson
+    :param schema_extensions_directory: optional directory with schema extensions, see get_event_schema()
+    :param processes: number of processes that validate events. With 1, the events are validated in this
+        process.
+    :param chunk_size: number of events per chunk, for ndjson files
+    :param output: where the hydrated events are written
+    :param errors_output: where the errors are written, a line per error
+    :param progress_output: where the progress and throughput are reported
+    :return: summary
+    """
+    # Loaded here, such that the processes of the pool don't load it again if they are forked
+    _init_process(schema_extensions_directory)
+    filenames = list_event_files(paths)
+    chunks = (chunk for filename in filenames for chunk in _read_chunks(filename, chunk_size))
+    if processes > 1:
+        results = _process_chunks_in_pool(chunks, hydrate, schema_extensions_directory, processes)
+    else:
+        results = (_process_chunk(chunk, hydrate) for chunk in chunks)
+
+    start = time.monotonic()
+    last_report = start
+    event_count = byte_count = error_count = 0
+    files_with_errors: List[str] = []
+    for result in results:
+        event_count += result.event_count
+        byte_count += result.byte_count
+        if result.errors:
+            error_count += len(result.errors)
+            if not files_with_errors or files_with_errors[-1] != result.filename:
+                files_with_errors.append(result.filename)
+            errors_output.write(''.join(f'{error}\n' for error in result.errors))
+        if result.output:
+            output.write(''.join(f'{event_json}\n' for event_json in result.output))
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+            _report_progress(progress_output, event_count, byte_count, error_count, now - start)
+            last_report = now
+    output.flush()
+    _report_progress(progress_output, event_count, byte_count, error_count, time.monotonic() - start)
+    return StreamSummary(file_count=len(filenames), event_count=event_count, error_count=error_count,
+                         files_with_errors=files_with_errors)
+
+
+def _report_progress(progress_output: TextIO, event_count: int, byte_count: int, error_count: int,
+                     seconds: float):
+    seconds = max(seconds, 1e-6)
+    progress_output.write(f'{event_count} events, {error_count} errors, {byte_count / 1e6:.1f} MB in '
+                          f'{seconds:.1f} s: {event_count / seconds:.0f} events/s, '
+                          f'{byte_count / 1e6 / seconds:.1f} MB/s\n')
+    progress_output.flush()
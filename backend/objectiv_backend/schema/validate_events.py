@@ -6,16 +6,14 @@ import json
 import sys
 from typing import List, Any, Dict, NamedTuple, Set
 import uuid
-import re
 
-import jsonschema
-from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
 
 from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
 from objectiv_backend.common.config import \
     get_config_timestamp_validation, get_collector_config
 
-from objectiv_backend.common.types import EventData
+from objectiv_backend.common.types import EventData, ContextType
 
 
 class ErrorInfo(NamedTuple):
@@ -38,57 +36,24 @@ class EventError(Dict):
         dict.__init__(self, event_id=event_id.__str__(), error_info=[e.asdict() for e in error_info])
 
 
-def get_event_list_schema() -> Dict[str, Any]:
-    """
-
-    :return: a dictionary containing a JSON schema like string to validate an array of events
-    """
-    event_schema = get_collector_config().event_schema
-    events = event_schema.events.schema
-
-    # we use AbstractEvent as the blueprint for what an event should look like
-    abstract_event = events['AbstractEvent']
-
-    # # list of properties for an event (can be nested)
-    items: Dict[str, dict] = {}
-    for property_name, property_desc in abstract_event['properties'].items():
-
-        if 'items' in property_desc and re.match('^Abstract.*?Context$', property_desc['items']['type']):
-            # we don't want to go into the validation / schema of contexts here
-            # so a simple object will suffice
-            property_desc['items']['type'] = 'object'
-        items[property_name] = property_desc
-
-    # we want a schema for a list of events (the base_schema only specifies a single event)
-    # the schema wants a list of abstract events. As that is not a valid JSON type,
-    # we replace that type with the more generic 'object' type, and the actual definition of
-    # an abstract event
-    event_list_schema = get_collector_config().event_list_schema
-    if 'events' in event_list_schema['properties'] and \
-            'items' in event_list_schema['properties']['events'] and \
-            'type' in event_list_schema['properties']['events']['items'] and \
-            event_list_schema['properties']['events']['items']['type'] == 'AbstractEvent':
-        event_list_schema['properties']['events']['items'] = {
-            'type': 'object',
-            'items': items
-        }
-    return event_list_schema
-
-
-def validate_structure_event_list(event_data: Any) -> List[ErrorInfo]:
+def validate_structure_event_list(event_data: Any, deep: bool = True) -> List[ErrorInfo]:
     """
     Checks that event_data is a list of events, that each event has the required fields, and that all
         contexts have the base required fields (id and _type).
     Does not perform any schema-dependent validation, e.g. doesn't check that the event type is valid,
     that an event has the right contexts, or that contexts have the right fields. For those checks call
     validate_event_adheres_to_schema on each individual event.
+    :param event_data: data to validate
+    :param deep: If False, skip the checks that are repeated by validate_event_adheres_to_schema(), e.g.
+        the format of the event id and the id of contexts. Only use this if validate_event_adheres_to_schema()
+        will be called on all events afterwards. See get_event_list_schema()
     :return: list of found errors. Empty list indicates not errors
     """
-    try:
-        event_list_schema = get_event_list_schema()
-        jsonschema.validate(instance=event_data, schema=event_list_schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {exc}')]
+    config = get_collector_config()
+    validator = config.event_list_validator if deep else config.event_list_validator_fast
+    error = best_match(validator.iter_errors(event_data))
+    if error:
+        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {error}')]
     return []
 
 
@@ -150,19 +115,20 @@ def _validate_required_contexts(event_schema: EventSchema, event: EventData) ->
     :return: list of found errors. Will contain 1 item with all missing contexts if any are missing.
     """
     event_name = event['_type']
-    global_contexts = event['global_contexts']
-    location_stack = event['location_stack']
-    required_context_types: Set = event_schema.get_all_required_contexts_for_event(event_name)
-    actual_types = set()
-    for context in global_contexts:
-        actual_types |= event_schema.get_all_parent_context_types(context['_type'])
-    for context in location_stack:
-        actual_types |= event_schema.get_all_parent_context_types(context['_type'])
-
-    for context in actual_types:
-        required_context_types |= event_schema.get_all_required_contexts_for_context(context)
-
-    if not required_context_types.issubset(actual_types):
+    contexts = event['global_contexts'] + event['location_stack']
+    actual_types: Set[ContextType] = set()
+    for context in contexts:
+        actual_types.update(event_schema.get_parent_context_types(context['_type']))
+
+    # The required context types of a context type include those of its parents, so checking the
+    # types of the actual contexts is enough. Only build the full set of required types if one is missing.
+    is_complete = event_schema.get_required_contexts_for_event(event_name) <= actual_types and \
+        all(event_schema.get_required_contexts_for_context(context['_type']) <= actual_types
+            for context in contexts)
+    if not is_complete:
+        required_context_types = set(event_schema.get_required_contexts_for_event(event_name))
+        for context_type in actual_types:
+            required_context_types |= event_schema.get_required_contexts_for_context(context_type)
         error_info = ErrorInfo(
             event,
             f'Required contexts missing: {required_context_types - actual_types} '
@@ -182,13 +148,13 @@ def _validate_contexts(event_schema: EventSchema, event: EventData) -> List[Erro
     errors = []
     for context in global_contexts:
         errors_context = _validate_context_item(event_schema=event_schema, context=context)
-        if 'AbstractGlobalContext' not in event_schema.get_all_parent_context_types(context['_type']):
+        if 'AbstractGlobalContext' not in event_schema.get_parent_context_types(context['_type']):
             errors.append(ErrorInfo(context, 'Not an instance of GlobalContext'))
 
         errors.extend(errors_context)
     for context in location_stack:
         errors_context = _validate_context_item(event_schema=event_schema, context=context)
-        if 'AbstractLocationContext' not in event_schema.get_all_parent_context_types(context['_type']):
+        if 'AbstractLocationContext' not in event_schema.get_parent_context_types(context['_type']):
             errors.append(ErrorInfo(context, 'Not an instance of LocationContext'))
 
         errors.extend(errors_context)
@@ -204,25 +170,23 @@ def _validate_context_item(event_schema: EventSchema, context) -> List[ErrorInfo
     context_type = context['_type']
     # theoretically we could generate some json schema with if-then that we could just validate, without
     # having to select the right sub-schema here, but that would be very complex and not very readable.
-    schema = event_schema.get_context_schema(context_type)
-    if not schema:
+    validator = event_schema.get_context_validator(context_type)
+    if not validator:
         print(f'Unknown context {context_type}, ignoring')
         return []
-    try:
-        jsonschema.validate(instance=context, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(context, f'context validation failed: {exc}')]
+    error = best_match(validator.iter_errors(context))
+    if error:
+        return [ErrorInfo(context, f'context validation failed: {error}')]
     return []
 
 
 def _validate_event_item(event_schema: EventSchema, event) -> List[ErrorInfo]:
     event_type = event['_type']
-    schema = event_schema.get_event_schema(event_type=event_type)
-    try:
-        jsonschema.validate(instance=event, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event, f'event validation failed {exc}')]
-
+    validator = event_schema.get_event_validator(event_type=event_type)
+    assert validator is not None  # validate_event_adheres_to_schema() already checked the event type
+    error = best_match(validator.iter_errors(event))
+    if error:
+        return [ErrorInfo(event, f'event validation failed {error}')]
     return []
 
 
@@ -235,7 +199,7 @@ def validate_events_in_file(event_schema: EventSchema, filename: str) -> List[Er
     """
     with open(filename) as file:
         event_data = json.loads(file.read())
-    errors = validate_event_list(event_schema=event_schema, event_data=event_data['events'])
+    errors = validate_event_list(event_schema=event_schema, event_data=event_data)
     if errors:
         print(f'\n{len(errors)} error(s) found:')
         for error in errors:
@@ -264,9 +228,25 @@ def validate_event_time(event: EventData, current_millis: int) -> List[ErrorInfo
 def main():
     parser = argparse.ArgumentParser(description='Validate events')
     parser.add_argument('--schema-extensions-directory', type=str)
+    # imported here, as stream_events imports this module
+    from objectiv_backend.schema.stream_events import add_stream_arguments, process_event_files
+    add_stream_arguments(parser)
     parser.add_argument('filenames', type=str, nargs='+')
     args = parser.parse_args(sys.argv[1:])
 
+    if args.ndjson:
+        summary = process_event_files(paths=args.filenames, hydrate=False,
+                                      schema_extensions_directory=args.schema_extensions_directory,
+                                      processes=args.processes, chunk_size=args.chunk_size)
+        if summary.error_count:
+            print(f'\n\nCombined summary: {summary.error_count} error(s) in {summary.event_count} events, in '
+                  f'{len(summary.files_with_errors)} / {summary.file_count} file(s). '
+                  f'Files with errors: {summary.files_with_errors}')
+            exit(1)
+        print(f'\n\nCombined summary: No errors found in {summary.event_count} events, in '
+              f'{summary.file_count} file(s).')
+        return
+
     errors: Dict[str, List[ErrorInfo]] = {}
     filenames = args.filenames
     event_schema = get_event_schema(schema_extensions_directory=args.schema_extensions_directory)
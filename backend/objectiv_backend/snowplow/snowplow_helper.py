@@ -1,29 +1,93 @@
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union, cast
 
 import base64
-import json
+import os
+import struct
+import threading
+import time
 from datetime import datetime
-from urllib.parse import urlparse
+
+import boto3
+import botocore.exceptions
 
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload  # type: ignore
 
 from objectiv_backend.common.config import SnowplowConfig, get_collector_config
-from objectiv_backend.common.event_utils import get_context
-from objectiv_backend.common.types import EventDataList, EventData
+from objectiv_backend.common.event_utils import get_global_contexts
+from objectiv_backend.common.metrics import SINK_ERRORS
+from objectiv_backend.common.serialization import json_dumps, json_loads
+from objectiv_backend.common.types import ContextData, EventDataList, EventData
 from objectiv_backend.schema.validate_events import EventError
 
-from thrift.protocol import TBinaryProtocol
-from thrift.transport import TTransport
+from thrift.Thrift import TType
 
 # only load imports if needed
 snowplow_config = get_collector_config().output.snowplow
 if snowplow_config.gcp_enabled:
     from google.cloud import pubsub_v1
-    from google.api_core.exceptions import NotFound
 
-if snowplow_config.aws_enabled:
-    import boto3
-    import botocore.exceptions
+T = TypeVar('T')
+
+# Limits of the Kinesis PutRecords and SQS SendMessageBatch calls
+KINESIS_MAX_BATCH_RECORDS = 500
+KINESIS_MAX_BATCH_BYTES = 5 * 1024 * 1024
+SQS_MAX_BATCH_MESSAGES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+# Records that are throttled are retried this many times, with an exponential backoff starting at
+# RETRY_DELAY_SECONDS
+MAX_RETRIES = 3
+RETRY_DELAY_SECONDS = 0.1
+_THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'KMSThrottlingException',
+    'LimitExceededException',
+    'RequestThrottled',
+    'Throttling',
+    'ThrottlingException',
+}
+
+# PubSub batches messages in the background. We wait for the results after publishing PUBSUB_MAX_IN_FLIGHT
+# messages, so the number of outstanding futures is bounded.
+PUBSUB_MAX_BATCH_MESSAGES = 500
+PUBSUB_MAX_BATCH_BYTES = 1024 * 1024
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = 0.05
+PUBSUB_MAX_IN_FLIGHT = 1000
+
+# Fields of the CollectorPayload thrift struct, in the order in which the generated CollectorPayload.write()
+# writes them: attribute name, thrift type, and field id.
+_COLLECTOR_PAYLOAD_FIELDS = (
+    ('ipAddress', TType.STRING, 100),
+    ('timestamp', TType.I64, 200),
+    ('encoding', TType.STRING, 210),
+    ('collector', TType.STRING, 220),
+    ('userAgent', TType.STRING, 300),
+    ('refererUri', TType.STRING, 310),
+    ('path', TType.STRING, 320),
+    ('querystring', TType.STRING, 330),
+    ('body', TType.STRING, 340),
+    ('headers', TType.LIST, 350),
+    ('contentType', TType.STRING, 360),
+    ('hostname', TType.STRING, 400),
+    ('networkUserId', TType.STRING, 410),
+    ('schema', TType.STRING, 31337),
+)
+# Headers of fields in the thrift binary protocol: field type, field id, and for strings the length, for i64
+# the value, and for lists the element type and count.
+_THRIFT_STRING_FIELD = struct.Struct('>bhi')
+_THRIFT_I64_FIELD = struct.Struct('>bhq')
+_THRIFT_LIST_FIELD = struct.Struct('>bhbi')
+_THRIFT_STRING_LENGTH = struct.Struct('>i')
+_THRIFT_STOP = bytes([TType.STOP])
+
+# Global contexts that are used to fill the CollectorPayload
+_PAYLOAD_CONTEXT_TYPES = frozenset(['HttpContext', 'CookieIdContext', 'PathContext'])
+
+# Clients are expensive to create, so we create them once per process. The cache is keyed on the pid, such
+# that a forked process (e.g. a gunicorn worker) doesn't share the clients and their connections with its
+# parent.
+_clients: Dict[str, Any] = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
 
 
 def make_snowplow_custom_context(self_describing_event: Dict, config: SnowplowConfig) -> str:
@@ -39,7 +103,7 @@ def make_snowplow_custom_context(self_describing_event: Dict, config: SnowplowCo
         'schema': snowplow_contexts_schema,
         'data': [self_describing_event]
     }
-    custom_context_json = json.dumps(custom_context)
+    custom_context_json = json_dumps(custom_context)
     return str(base64.b64encode(custom_context_json.encode('UTF-8')), 'UTF-8')
 
 
@@ -58,83 +122,125 @@ def objectiv_event_to_snowplow(event: EventData, config: SnowplowConfig) -> Dict
     }
 
 
-def objectiv_event_to_snowplow_payload(event: EventData, config: SnowplowConfig) -> CollectorPayload:
+def _get_payload_contexts(event: EventData) -> Dict[str, ContextData]:
+    """
+    Get the first global context of each of the _PAYLOAD_CONTEXT_TYPES, in a single pass over the global
+    contexts. A context matches a type if it has that type, or if it's a subtype of it (i.e. the type is in
+    its hydrated _types).
+    """
+    contexts: Dict[str, ContextData] = {}
+    for context in get_global_contexts(event):
+        context_type = context.get('_type')
+        if context_type in _PAYLOAD_CONTEXT_TYPES:
+            contexts.setdefault(context_type, context)
+        else:
+            for parent_type in _PAYLOAD_CONTEXT_TYPES.intersection(cast(List[str], context.get('_types', ()))):
+                contexts.setdefault(parent_type, context)
+    return contexts
+
+
+def objectiv_event_to_snowplow_payload(event: EventData,
+                                       config: SnowplowConfig,
+                                       timestamp: int = None) -> CollectorPayload:
     """
     Transform Objectiv event to Snowplow Collector Payload object
     :param event: EventData
     :param config: SnowplowConfig
+    :param timestamp: optional, time at which the collector received the event, in milliseconds since the
+        epoch. Defaults to now.
     :return: CollectorPayload
     """
-    snowplow_payload_data_schema = config.schema_payload_data
-    snowplow_collector_payload_schema = config.schema_collector_payload
+    payload, _, _ = _objectiv_event_to_snowplow_payload(event=event, config=config, timestamp=timestamp)
+    return payload
 
-    try:
-        http_context = get_context(event, 'HttpContext')
-    except ValueError:
-        http_context = {}
 
-    try:
-        cookie_context = get_context(event, 'CookieIdContext')
-    except ValueError:
-        cookie_context = {}
+def _objectiv_event_to_snowplow_payload(event: EventData,
+                                        config: SnowplowConfig,
+                                        timestamp: int = None) -> Tuple[CollectorPayload, Dict[str, str], EventData]:
+    """
+    Implementation of objectiv_event_to_snowplow_payload(), that also returns the data of the payload body and
+    the event in the custom context, such that schema violations can be generated without decoding them again.
+    :return: tuple: payload, data of the payload body, event in the custom context
+    """
+    snowplow_payload_data_schema = config.schema_payload_data
+    snowplow_collector_payload_schema = config.schema_collector_payload
 
-    try:
-        path_context = get_context(event, 'PathContext')
-    except ValueError:
-        path_context = {}
+    contexts = _get_payload_contexts(event)
+    http_context = contexts.get('HttpContext', {})
+    cookie_context = contexts.get('CookieIdContext', {})
+    path_context = contexts.get('PathContext', {})
 
-    query_string = urlparse(str(path_context.get('id', ''))).query
+    # The query string of the url, which is the part after the '?' and before the '#' (like urlsplit() does)
+    query_string = str(path_context.get('id', '')).split('#', 1)[0].partition('?')[2]
 
     rich_event = {'event_id' if k == 'id' else k: v for k, v in event.items()}
     rich_event['cookie_id'] = cookie_context.get('id', '')
 
     snowplow_event = objectiv_event_to_snowplow(event=rich_event, config=config)
     snowplow_custom_context = make_snowplow_custom_context(self_describing_event=snowplow_event, config=config)
+    payload_data = {
+        "e": "se",  # mandatory: event type: structured event
+        "p": "web",  # mandatory: platform
+        "tv": "objectiv-tracker-0.0.5",  # mandatory: tracker version
+        "eid": event['id'],  # event_id
+        "url": path_context.get('id', ''),
+        "cx": snowplow_custom_context
+    }
     payload = {
         "schema": snowplow_payload_data_schema,
-        "data": [{
-            "e": "se",  # mandatory: event type: structured event
-            "p": "web",  # mandatory: platform
-            "tv": "objectiv-tracker-0.0.5",  # mandatory: tracker version
-            "eid": event['id'],  # event_id
-            "url": path_context.get('id', ''),
-            "cx": snowplow_custom_context
-        }]
+        "data": [payload_data]
     }
-    return CollectorPayload(
+    collector_payload = CollectorPayload(
         schema=snowplow_collector_payload_schema,
         ipAddress=http_context.get('remote_address', ''),
-        timestamp=int(datetime.now().timestamp() * 1000),
+        timestamp=timestamp if timestamp is not None else int(datetime.now().timestamp() * 1000),
         encoding='UTF-8',
         collector='objectiv_collector',
         userAgent=http_context.get('user_agent', ''),
         refererUri=http_context.get('referrer', ''),
         path='/com.snowplowanalytics.snowplow/tp2',
         querystring=query_string,
-        body=json.dumps(payload),
+        body=json_dumps(payload),
         headers=[],
         contentType='application/json',
         hostname='',
         networkUserId=cookie_context.get('id', '')
     )
+    return collector_payload, payload_data, rich_event
 
 
 def payload_to_thrift(payload: CollectorPayload) -> bytes:
     """
     Generate Thrift message for payload, based on Thrift schema here:
         https://github.com/snowplow/snowplow/blob/master/2-collectors/thrift-schemas/collector-payload-1/src/main/thrift/collector-payload.thrift
+
+    The message is encoded with the binary protocol, and is byte for byte the same as what
+    CollectorPayload.write() gives with a TBinaryProtocol, but encoding is several times faster. The
+    C-accelerated protocol of the thrift package doesn't help here: it iterates over the thrift_spec of the
+    struct, which has an entry for every field id up to the 31337 of the schema field.
     :param payload: CollectorPayload - class instance representing Thrift message
     :return: bytes - serialized string
     """
-
-    # use memory buffer as transport layer
-    trans = TTransport.TMemoryBuffer()
-
-    # use the binary encoding protocol
-    oprot = TBinaryProtocol.TBinaryProtocol(trans=trans)
-    payload.write(oprot=oprot)
-
-    return trans.getvalue()
+    parts: List[bytes] = []
+    for name, field_type, field_id in _COLLECTOR_PAYLOAD_FIELDS:
+        value = getattr(payload, name)
+        if value is None:
+            continue
+        if field_type == TType.STRING:
+            data = value.encode('utf-8')
+            parts.append(_THRIFT_STRING_FIELD.pack(field_type, field_id, len(data)))
+            parts.append(data)
+        elif field_type == TType.I64:
+            parts.append(_THRIFT_I64_FIELD.pack(field_type, field_id, value))
+        else:
+            # list of strings
+            parts.append(_THRIFT_LIST_FIELD.pack(field_type, field_id, TType.STRING, len(value)))
+            for item in value:
+                data = item.encode('utf-8')
+                parts.append(_THRIFT_STRING_LENGTH.pack(len(data)))
+                parts.append(data)
+    parts.append(_THRIFT_STOP)
+    return b''.join(parts)
 
 
 def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowConfig,
@@ -146,7 +252,28 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
     :param event_error: error for this event
     :return: Dictionary representing the schema violation
     """
+    data = json_loads(payload.body)['data'][0]
 
+    # look for our custom context, so we can fill the enrich section
+    event = {}
+    if 'cx' in data:
+        context_container_decoded = json_loads(base64.b64decode(data['cx']).decode('utf-8'))
+        contexts = context_container_decoded['data']
+        for context in contexts:
+            if 'schema' in context and context['schema'] == config.schema_objectiv_taxonomy and 'data' in context:
+                event = context['data']
+                # we pick the first
+                break
+    return _snowplow_schema_violation_json(payload=payload, payload_data=data, enrich_event=event, config=config,
+                                           event_error=event_error)
+
+
+def _snowplow_schema_violation_json(payload: CollectorPayload, payload_data: Dict[str, Any], enrich_event: Dict,
+                                    config: SnowplowConfig, event_error: Optional[EventError]) -> Dict[str, Any]:
+    """
+    Implementation of snowplow_schema_violation_json(), for a payload of which the data of the body and the event
+    in the custom context are already known.
+    """
     data_reports = []
 
     if event_error and event_error.error_info:
@@ -159,25 +286,12 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
             })
 
     parameters = []
-    data = json.loads(payload.body)['data'][0]
-    for key, value in data.items():
+    for key, value in payload_data.items():
         parameters.append({
             "name": key,
             "value": value[:512]
         })
 
-    # look for our custom context, so we can fill the enrich section
-    event = {}
-    if 'cx' in data:
-        context_container_encoded = data['cx']
-        context_container_decoded = json.loads(base64.b64decode(context_container_encoded).decode('utf-8'))
-        contexts = context_container_decoded['data']
-        for context in contexts:
-            if 'schema' in context and context['schema'] == config.schema_objectiv_taxonomy and 'data' in context:
-                event = context['data']
-                # we pick the first
-                break
-
     ts_format = '%Y-%m-%dT%H:%M:%S.%fZ'
     return {
         "schema": config.schema_schema_violations,
@@ -223,8 +337,8 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
                     "userId": payload.networkUserId
                 },
                 "enrich": {
-                    "event_id": event.get('id'),
-                    "context": context_container_encoded
+                    "event_id": enrich_event.get('id'),
+                    "context": payload_data.get('cx')
                 }
             },
             # Information about the piece of software responsible for the creation of schema violations
@@ -252,22 +366,176 @@ def prepare_event_for_snowplow_pipeline(event: EventData,
     :param event_errors: list of EventError
     :return: bytes object to be ingested by Snowplow pipeline
     """
-    payload: CollectorPayload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    return prepare_events_for_snowplow_pipeline(events=[event], good=good, config=config,
+                                                event_errors=event_errors)[0]
+
+
+def prepare_events_for_snowplow_pipeline(events: EventDataList,
+                                         good: bool,
+                                         config: SnowplowConfig,
+                                         event_errors: List[EventError] = None) -> List[bytes]:
+    """
+    Transform events into data suitable for writing to the Snowplow Pipeline, see
+    prepare_event_for_snowplow_pipeline(). All events of a batch get the same collector timestamp.
+    :param events: EventDataList
+    :param good: bool - True if these events should go to the "good" channel
+    :param config: SnowplowConfig
+    :param event_errors: list of EventError
+    :return: list with a bytes object per event, to be ingested by Snowplow pipeline
+    """
+    timestamp = int(datetime.now().timestamp() * 1000)
     if good:
-        data = payload_to_thrift(payload=payload)
-    else:
-        event_error = None
-        # try to find errors for the current event_id
-        if event_errors:
-            for ee in event_errors:
-                if ee.event_id == event['id']:
-                    event_error = ee
-        failed_event = snowplow_schema_violation_json(payload=payload, config=config, event_error=event_error)
+        return [payload_to_thrift(payload=objectiv_event_to_snowplow_payload(event=event, config=config,
+                                                                             timestamp=timestamp))
+                for event in events]
 
+    # If there are multiple errors for an event_id, then the last one is used
+    errors_per_event_id = {event_error.event_id: event_error for event_error in event_errors or []}
+    result = []
+    for event in events:
+        payload, payload_data, enrich_event = _objectiv_event_to_snowplow_payload(
+            event=event, config=config, timestamp=timestamp)
+        failed_event = _snowplow_schema_violation_json(payload=payload, payload_data=payload_data,
+                                                       enrich_event=enrich_event, config=config,
+                                                       event_error=errors_per_event_id.get(event['id']))
         # serialize (json) and encode to bytestring for publishing
-        data = json.dumps(failed_event, separators=(',', ':')).encode('utf-8')
+        result.append(json_dumps(failed_event).encode('utf-8'))
+    return result
+
+
+def _reset_clients_after_fork():
+    """ Drop the clients of the parent process, if this is a forked process. Caller must hold _clients_lock """
+    global _clients, _clients_pid
+    if _clients_pid != os.getpid():
+        _clients = {}
+        _clients_pid = os.getpid()
+
+
+def _get_aws_client(service_name: str):
+    """ Get the cached boto3 client for the given service, creating it if needed. """
+    with _clients_lock:
+        _reset_clients_after_fork()
+        if service_name not in _clients:
+            _clients[service_name] = boto3.client(service_name)
+        return _clients[service_name]
+
+
+def _get_gcp_publisher():
+    """ Get the cached PubSub PublisherClient, creating it if needed. """
+    with _clients_lock:
+        _reset_clients_after_fork()
+        if 'pubsub' not in _clients:
+            _clients['pubsub'] = pubsub_v1.PublisherClient(
+                batch_settings=pubsub_v1.types.BatchSettings(
+                    max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+                    max_bytes=PUBSUB_MAX_BATCH_BYTES,
+                    max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS),
+                publisher_options=pubsub_v1.types.PublisherOptions(
+                    flow_control=pubsub_v1.types.PublishFlowControl(
+                        message_limit=PUBSUB_MAX_IN_FLIGHT,
+                        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK)))
+        return _clients['pubsub']
+
+
+def _get_batches(items: List[T], max_count: int, max_bytes: int, get_size: Callable[[T], int]) -> Iterator[List[T]]:
+    """
+    Split items into batches of at most max_count items, and at most max_bytes in total.
+    A single item that is bigger than max_bytes gets its own batch.
+    """
+    batch: List[T] = []
+    batch_bytes = 0
+    for item in items:
+        size = get_size(item)
+        if batch and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _send_with_retries(send: Callable[[List[T]], List[T]], items: List[T], description: str) -> None:
+    """
+    Call send with the items, and retry the items that it returns, up to MAX_RETRIES times.
+    send should return the items that failed because of throttling, and only raise for the batch as a whole.
+    :param send: function that sends a batch of items
+    :param items: items to send
+    :param description: description of the destination, used for error messages
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+        try:
+            items = send(items)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in _THROTTLING_ERROR_CODES:
+                SINK_ERRORS.inc(labels=('snowplow_aws',))
+                print(f'Failed to deliver {len(items)} events to {description}: {e}')
+                return
+        if not items:
+            return
+    SINK_ERRORS.inc(labels=('snowplow_aws',))
+    print(f'Could not deliver {len(items)} events to {description}: throughput exceeded')
+
+
+def _put_kinesis_records(client, stream_name: str, records: List[Dict[str, Any]]) -> None:
+    """
+    Write records to a Kinesis stream, in batches, retrying throttled records.
+    :param client: boto3 kinesis client
+    :param stream_name: name of the stream
+    :param records: list of records, with Data and PartitionKey
+    """
+    def put_records(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        response = client.put_records(StreamName=stream_name, Records=batch)
+        if not response.get('FailedRecordCount'):
+            return []
+        # Failed records have an ErrorCode, which is either ProvisionedThroughputExceededException or
+        # InternalFailure. Both are worth retrying.
+        return [record for record, result in zip(batch, response['Records']) if 'ErrorCode' in result]
+
+    def get_size(record: Dict[str, Any]) -> int:
+        return len(record['Data']) + len(record['PartitionKey'])
+
+    for batch in _get_batches(records, KINESIS_MAX_BATCH_RECORDS, KINESIS_MAX_BATCH_BYTES, get_size):
+        _send_with_retries(put_records, batch, description=f'Kinesis ({stream_name})')
 
-    return data
+
+def _send_sqs_messages(client, queue_url: str, entries: List[Dict[str, Any]]) -> None:
+    """
+    Write messages to an SQS queue, in batches, retrying messages that failed because of the server.
+    :param client: boto3 sqs client
+    :param queue_url: url of the queue
+    :param entries: list of SendMessageBatch entries. The Id is set per batch.
+    """
+    def send_message_batch(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        batch = [{**entry, 'Id': str(index)} for index, entry in enumerate(batch)]
+        response = client.send_message_batch(QueueUrl=queue_url, Entries=batch)
+        retry = []
+        for failure in response.get('Failed', []):
+            if failure['SenderFault']:
+                SINK_ERRORS.inc(labels=('snowplow_aws',))
+                print(f'Failed to deliver event to SQS ({queue_url}): {failure["Code"]} {failure.get("Message")}')
+            else:
+                retry.append(batch[int(failure['Id'])])
+        return retry
+
+    def get_size(entry: Dict[str, Any]) -> int:
+        return len(entry['MessageBody']) + 64  # approximate size of the message attributes
+
+    for batch in _get_batches(entries, SQS_MAX_BATCH_MESSAGES, SQS_MAX_BATCH_BYTES, get_size):
+        _send_with_retries(send_message_batch, batch, description=f'SQS ({queue_url})')
+
+
+def _wait_for_pubsub_futures(futures: List[Any], topic: str) -> None:
+    """ Wait until the published messages are sent, and report any errors. """
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            SINK_ERRORS.inc(labels=('snowplow_gcp',))
+            print(f'Failed to publish event to PubSub topic {topic}: {e}')
 
 
 def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good: bool = True,
@@ -289,16 +557,19 @@ def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good
         # not ok events get sent to the bad topic
         topic = config.gcp_pubsub_topic_bad
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = _get_gcp_publisher()
     topic_path = f'projects/{project}/topics/{topic}'
 
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
-
-        try:
-            publisher.publish(topic_path, data=data)
-        except NotFound as e:
-            print(f'PubSub topic {topic} could not be found! {e}')
+    # The client batches the messages, and retries messages that fail with a retryable error (e.g.
+    # RESOURCE_EXHAUSTED).
+    futures = []
+    for data in prepare_events_for_snowplow_pipeline(events=events, good=good, config=config,
+                                                     event_errors=event_errors):
+        futures.append(publisher.publish(topic_path, data=data))
+        if len(futures) >= PUBSUB_MAX_IN_FLIGHT:
+            _wait_for_pubsub_futures(futures, topic)
+            futures = []
+    _wait_for_pubsub_futures(futures, topic)
 
 
 def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
@@ -324,45 +595,33 @@ def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
         # the bad stream always goes to kinesis
         client_type = 'kinesis'
 
+    # The events are batched, and the event id is used as partition key, to spread the events over the
+    # shards of the stream.
+    data_per_event = prepare_events_for_snowplow_pipeline(events=events, good=good, config=config,
+                                                          event_errors=event_errors)
     if client_type == 'kinesis':
-        client = boto3.client('kinesis')
-    else:
-        client = boto3.client('sqs')
-
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
-
-        if client_type == 'kinesis':
-            try:
-                client.put_record(
-                    StreamName=stream_name,
-                    Data=data,
-                    PartitionKey='event_id')
-            except client.exceptions.ProvisionedThroughputExceededException as e:
-                print(f'Could not deliver event to Kinesis: throughput exceeded in {stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Exception sending event to Kinesis ({stream_name}: {e}')
-
-        elif client_type == 'sqs':
-            # sqs doesn't support binary payloads, so in this case we base64 encode
-            payload = str(base64.b64encode(data), 'UTF-8')
-
-            try:
-                client.send_message(QueueUrl=stream_name,
-                                    MessageBody=payload,
-                                    MessageAttributes={
-                                        #  The sqs message attribute that will be used to set the kinesis partition key
-                                        'kinesisKey': {
-                                            'StringValue': 'event_id',
-                                            'DataType': 'String'
-                                        }
-                                    })
-            except client.exceptions.InvalidMessageContents as e:
-                print(f'Failed to deliver event to SQS: Invalid Message Contents ({stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Failed to deliver event to SQS ({stream_name}: {e}')
-
-        else:
-            # this should never happen
-            raise ValueError(f'Unknown Client-Type: {client_type}')
+        records = [{
+            'Data': data,
+            'PartitionKey': event['id']
+        } for event, data in zip(events, data_per_event)]
+        _put_kinesis_records(_get_aws_client('kinesis'), stream_name=stream_name, records=records)
+
+    elif client_type == 'sqs':
+        entries = []
+        for event, data in zip(events, data_per_event):
+            entries.append({
+                # sqs doesn't support binary payloads, so in this case we base64 encode
+                'MessageBody': str(base64.b64encode(data), 'UTF-8'),
+                'MessageAttributes': {
+                    #  The sqs message attribute that will be used to set the kinesis partition key
+                    'kinesisKey': {
+                        'StringValue': event['id'],
+                        'DataType': 'String'
+                    }
+                }
+            })
+        _send_sqs_messages(_get_aws_client('sqs'), queue_url=stream_name, entries=entries)
 
+    else:
+        # this should never happen
+        raise ValueError(f'Unknown Client-Type: {client_type}')
@@ -3,32 +3,122 @@ Tool that connects to the database and creates the needed tables as defined in c
 If a duplicate-table error is encounterd, then the script will assume that the databse is already
 initialized correctly and exit successfully.
 
+If POSTGRES_PARTITION_DATA is set, then the data table is created partitioned by day, with the sections
+from create_tables_partitioned.sql. In that case the create_data_partitions() function, which the collector
+and workers use to create partitions, is created or replaced, and the upcoming partitions are created too,
+also if the database was already initialized.
+
+If POSTGRES_TYPED_DATA is set, then the data table gets the typed layout from create_tables_typed.sql: value
+is jsonb, and frequently used fields are stored in typed columns too. Like the partitioning, this can only be
+chosen when the database is initialized.
+
+The queue tables of a database that was initialized by an older version are updated to the current layout,
+see update_queue_tables(). If POSTGRES_UNLOGGED_QUEUES is set, the queue tables are created unlogged, or made
+unlogged if they already exist.
+
+If the sessions table doesn't exist yet, because the database was initialized by an older version, it is
+created and filled from the data table, see update_sessions_table(). The data_with_sessions view is replaced
+by its current definition. With --rebuild-sessions the sessions are computed again from scratch, which is
+needed after changing SESSION_GAP_SECONDS.
+
 This assumes that the user and database already exist.
 
 Copyright 2021 Objectiv B.V.
 """
 import argparse
 import os
+import re
 import sys
+from datetime import datetime, timedelta
 from time import sleep
+from typing import Dict, Optional
 
 import psycopg2
 
-from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.config import get_config_postgres, DATA_PARTITION_DAYS_AHEAD
 from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.workers.pg_queues import update_queue_tables
+from objectiv_backend.workers.pg_storage import create_data_partitions, rebuild_sessions
 
 _MAX_RETRIES = 5
 _POSTGRES_DUPLICATE_TABLE_ERROR = '42P07'
 
 
-def get_sql() -> str:
-    """ get content of ../../create_tables.sql as string """
+# Matches a section in a sql file, that starts with '-- section: <name>' and ends with
+# '-- end section: <name>'
+_SECTION_REGEX = re.compile(r'^-- section: (\w+)\n(.*?)^-- end section: \1\n', re.MULTILINE | re.DOTALL)
+
+
+def _read_sql_file(name: str) -> str:
+    """ get content of ../../<name> as string """
     dirname = os.path.dirname(__file__)
-    filename = os.path.join(dirname, '../../create_tables.sql')
+    filename = os.path.join(dirname, '../../', name)
     with open(filename) as f:
         return f.read()
 
 
+def get_sql(partition_data: bool = False,
+            typed_data: bool = False,
+            data_gin_index: bool = False,
+            unlogged_queues: bool = False) -> str:
+    """
+    get content of ../../create_tables.sql as string
+    :param partition_data: If True, the sections of create_tables.sql are replaced by the sections with the
+        same name in create_tables_partitioned.sql
+    :param typed_data: If True, the sections of create_tables.sql are replaced by the sections with the
+        same name in create_tables_typed.sql, except for the data_gin_index section
+    :param data_gin_index: If True, the data_gin_index section is replaced too. Requires typed_data.
+    :param unlogged_queues: If True, the queue tables are created unlogged
+    """
+    sql = _read_sql_file('create_tables.sql')
+    if unlogged_queues:
+        sql = sql.replace('create table queue_', 'create unlogged table queue_')
+    replacement_files = []
+    if partition_data:
+        replacement_files.append('create_tables_partitioned.sql')
+    if typed_data:
+        replacement_files.append('create_tables_typed.sql')
+    if not replacement_files:
+        return sql
+    replacements: Dict[str, str] = {
+        match.group(1): match.group(2)
+        for file_name in replacement_files
+        for match in _SECTION_REGEX.finditer(_read_sql_file(file_name))
+    }
+    if not data_gin_index:
+        replacements.pop('data_gin_index', None)
+    # Sections without a replacement keep their content, only the section markers are removed
+    return _SECTION_REGEX.sub(lambda match: replacements.get(match.group(1), match.group(2)), sql)
+
+
+def _get_sql_section(file_name: str, name: str) -> Optional[str]:
+    """ Get the content of the section with the given name in file_name, or None if there is no such section """
+    for match in _SECTION_REGEX.finditer(_read_sql_file(file_name)):
+        if match.group(1) == name:
+            return match.group(2)
+    return None
+
+
+def update_sessions_table(connection) -> bool:
+    """
+    Create the sessions table, if the database was initialized by a version without sessions table. The table
+    is filled from the data table. Also creates or replaces the data_with_sessions view that uses it.
+
+    Does not do any transaction management.
+    :param connection: database connection
+    :return: True if the sessions table was created
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("select to_regclass('sessions')")
+        created = cursor.fetchone()[0] is None
+        if created:
+            cursor.execute(_get_sql_section('create_tables.sql', 'sessions'))
+        cursor.execute(_get_sql_section('create_tables.sql', 'data_with_sessions'))
+    if created:
+        rebuild_sessions(connection)
+    return created
+
+
 def get_connection_with_retries(retry: bool):
     """ Connect to database. If retry set will attempt multiple times"""
     pg_config = get_config_postgres()
@@ -54,8 +144,17 @@ def main():
                              "giving the database time to start up if run at start up. If set won't retry")
     parser.add_argument('--print', dest='print', default=False, action='store_true',
                         help="Instead of running sql to setup schema, print it to stdout")
+    parser.add_argument('--rebuild-sessions', dest='rebuild_sessions', default=False, action='store_true',
+                        help="Compute the sessions table again from all events, e.g. after changing "
+                             "SESSION_GAP_SECONDS")
     args = parser.parse_args(sys.argv[1:])
-    sql = get_sql()
+    pg_config = get_config_postgres()
+    partition_data = pg_config is not None and pg_config.partition_data
+    typed_data = pg_config is not None and pg_config.typed_data
+    data_gin_index = pg_config is not None and pg_config.data_gin_index
+    unlogged_queues = pg_config is not None and pg_config.unlogged_queues
+    sql = get_sql(partition_data=partition_data, typed_data=typed_data, data_gin_index=data_gin_index,
+                  unlogged_queues=unlogged_queues)
 
     if args.print:
         print(sql)
@@ -67,10 +166,32 @@ def main():
             cursor.execute(sql)
             print('Succesfully initialized database.')
         except psycopg2.Error as error:
-            if error.pgcode == _POSTGRES_DUPLICATE_TABLE_ERROR:
-                print('Got "duplicate table error", assuming database is already initialized')
-                exit(0)
-            raise
+            if error.pgcode != _POSTGRES_DUPLICATE_TABLE_ERROR:
+                raise
+            print('Got "duplicate table error", assuming database is already initialized')
+            connection.rollback()
+
+    with connection:
+        for statement in update_queue_tables(connection, unlogged=unlogged_queues):
+            print(f'Updated queue table: {statement}')
+
+    with connection:
+        if update_sessions_table(connection):
+            print('Succesfully created sessions table.')
+        elif args.rebuild_sessions:
+            rebuild_sessions(connection)
+            print('Succesfully rebuilt sessions table.')
+
+    if partition_data:
+        today = datetime.utcnow().date()
+        with connection:
+            # Creates or replaces the create_data_partitions() function, also for older databases
+            with connection.cursor() as cursor:
+                cursor.execute(_get_sql_section('create_tables_partitioned.sql', 'data_grants'))
+            create_data_partitions(connection,
+                                   first_day=today - timedelta(days=1),
+                                   last_day=today + timedelta(days=DATA_PARTITION_DAYS_AHEAD))
+        print('Succesfully created data partitions.')
 
 
 if __name__ == '__main__':
@@ -1,17 +1,26 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
+import select
+import time
 import uuid
 from enum import Enum
-from typing import List, Tuple
+from typing import List, Tuple, Sequence, Any, Optional
 
 import psycopg2
 from psycopg2.extras import execute_values
 
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.db import COPY_MIN_ROW_COUNT, copy_rows, get_db_connection, get_connection_pool
+from objectiv_backend.common.metrics import DB_WRITE_SECONDS, QUEUE_DEPTH
+from objectiv_backend.common.serialization import serialize_events
 from objectiv_backend.common.types import EventDataList
 
 
+# Storage parameters of the queue tables, must match create_tables.sql
+_QUEUE_TABLE_STORAGE_PARAMETERS = 'autovacuum_vacuum_scale_factor = 0, autovacuum_vacuum_threshold = 10000'
+
+
 class ProcessingStage(Enum):
     ENTRY = "entry"
     FINALIZE = "finalize"
@@ -44,48 +53,183 @@ class PostgresQueues:
             return 'queue_finalize'
         raise Exception('Implementation incomplete')
 
+    @staticmethod
+    def queue_to_channel(queue: ProcessingStage) -> str:
+        """ Name of the channel on which a notification is sent when events are put on the queue. """
+        return PostgresQueues._queue_to_table(queue)
+
     def get_events(self, queue: ProcessingStage, max_items: int) -> EventDataList:
         """
         Get a list of events from a queue for processing.
 
         :param queue: Queue from which to pick events
         :param max_items: maximum number of items to pick from the queue.
-        :return: list of events with id, at most max_items, but can be less.
+        :return: list of events, at most max_items, but can be less.
         """
         table_name = self._queue_to_table(queue)
+        # Claim the oldest events that no other worker has claimed, and delete them by primary key. The
+        # claimed rows are a range at the start of the primary key index, so the cost doesn't depend on the
+        # number of events on the queue.
         query = f'''
-            delete from {table_name}
-            where event_id in (
-                select event_id
+            with claimed as (
+                select insert_order
                 from {table_name}
                 order by insert_order asc
                 limit %s
                 for update skip locked
             )
-            returning event_id, value;
+            delete from {table_name} as queue
+            using claimed
+            where queue.insert_order = claimed.insert_order
+            returning queue.event_id, queue.value;
         '''
         with self.connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
             cursor.execute(query, (max_items, ))
-            events_with_id: EventDataList = cursor.fetchall()
-        return events_with_id
+            events: EventDataList = [row.value for row in cursor.fetchall()]
+        return events
 
     def put_events(self,
                    queue: ProcessingStage,
-                   events: EventDataList):
+                   events: EventDataList,
+                   event_jsons: Optional[Sequence[str]] = None):
         """
-        Put an event with a given event-id on a queue
+        Put an event with a given event-id on a queue, and notify listeners on the queue's channel. The
+        notification is delivered when the transaction is committed, see QueueListener.
 
         :param queue: Which queue to put the event on
         :param events: list of events with ids
+        :param event_jsons: optional, the events serialized with serialize_events(), to prevent serializing
+            the events again.
         """
         if not events:
             return
         table_name = self._queue_to_table(queue)
-        insert_query = f'''
-            insert into
-            {table_name}(event_id, value)
-            values %s
-            '''
-        values: List[Tuple[uuid.UUID, str]] = [(event['id'], json.dumps(event)) for event in events]
+        if event_jsons is None:
+            event_jsons = serialize_events(events)
+        values: List[Tuple[uuid.UUID, str]] = [
+            (event['id'], event_json) for event, event_json in zip(events, event_jsons)
+        ]
+        with DB_WRITE_SECONDS.time(labels=(table_name,)), self.connection.cursor() as cursor:
+            if len(values) >= COPY_MIN_ROW_COUNT:
+                copy_rows(cursor, table_name, ('event_id', 'value'), values)
+            else:
+                insert_query = f'''
+                    insert into
+                    {table_name}(event_id, value)
+                    values %s
+                    '''
+                execute_values(cursor, insert_query, values, template=None, page_size=100)
+            cursor.execute(f'notify {self.queue_to_channel(queue)}')
+
+    def get_queue_depth(self, queue: ProcessingStage) -> int:
+        """
+        Get an estimate of the number of events on the queue, including events that are being processed.
+        Uses the statistics of the table, which lag a little behind, rather than counting the rows: that
+        would have to scan the table, which can be big if the workers fall behind.
+        """
         with self.connection.cursor() as cursor:
-            execute_values(cursor, insert_query, values, template=None, page_size=100)
+            cursor.execute('select n_live_tup from pg_stat_user_tables where relid = %s::regclass',
+                           (self._queue_to_table(queue), ))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+
+def update_queue_tables(connection, unlogged: bool) -> List[str]:
+    """
+    Bring the queue tables of a database that was created by an older version of create_tables.sql up to
+    date: add the primary key on insert_order, set the autovacuum settings, and make the tables logged or
+    unlogged. Tables that are up to date are not changed. Changing a table requires owning it.
+
+    Making a table logged or unlogged rewrites it, and locks it while doing so. As the queues are normally
+    nearly empty, that is quick.
+    :param connection: database connection
+    :param unlogged: whether the tables should be unlogged, see PostgresConfig.unlogged_queues
+    :return: the statements that were executed
+    """
+    statements = []
+    with connection.cursor() as cursor:
+        for queue in ProcessingStage:
+            table_name = PostgresQueues._queue_to_table(queue)
+            cursor.execute('''
+                select
+                    c.relpersistence = 'u',
+                    exists(select * from pg_index as i where i.indrelid = c.oid and i.indisprimary)
+                from pg_class as c
+                where c.oid = %s::regclass
+            ''', (table_name, ))
+            is_unlogged, has_primary_key = cursor.fetchone()
+            if not has_primary_key:
+                statements.append(f'alter table {table_name} add primary key (insert_order)')
+                statements.append(f'alter table {table_name} set ({_QUEUE_TABLE_STORAGE_PARAMETERS})')
+            if is_unlogged != unlogged:
+                statements.append(f'alter table {table_name} set {"unlogged" if unlogged else "logged"}')
+        for statement in statements:
+            cursor.execute(statement)
+    return statements
+
+
+def update_queue_depth_metric(pg_config: PostgresConfig):
+    """ Set the QUEUE_DEPTH metric to the (estimated) number of events on each queue. """
+    with get_connection_pool(pg_config).connection() as connection:
+        with connection:
+            pg_queues = PostgresQueues(connection=connection)
+            for queue in ProcessingStage:
+                QUEUE_DEPTH.set(pg_queues.get_queue_depth(queue), labels=(queue.value,))
+
+
+class QueueListener:
+    """
+    Wait for events to be put on one or more queues, using Postgres' LISTEN/NOTIFY.
+
+    Uses a dedicated connection, that is not part of a connection pool. Listening starts when the listener is
+    created, notifications that arrive while the caller is processing events are remembered until the next
+    call to wait(). So there is no window in which notifications can be missed. If the connection is lost,
+    then wait() falls back to sleeping, and reconnects on the next call.
+    """
+
+    def __init__(self, pg_config: PostgresConfig, queues: Sequence[ProcessingStage]):
+        self.pg_config = pg_config
+        self.channels = [PostgresQueues.queue_to_channel(queue) for queue in queues]
+        self._connection: Any = None
+        self._connect()
+
+    def _connect(self):
+        connection = get_db_connection(self.pg_config)
+        # Notifications are only delivered outside of transactions
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            for channel in self.channels:
+                cursor.execute(f'listen {channel}')
+        self._connection = connection
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Block until events were put on one of the queues since the previous call, or until timeout seconds
+        have passed.
+        :return: True if there was a notification, False on timeout or if there was a connection problem.
+        """
+        try:
+            if self._connection is None:
+                self._connect()
+            connection = self._connection
+            connection.poll()
+            if not connection.notifies:
+                readable, _, _ = select.select([connection], [], [], timeout)
+                if readable:
+                    connection.poll()
+            notified = bool(connection.notifies)
+            connection.notifies.clear()
+            return notified
+        except psycopg2.Error as exc:
+            print(f'Cannot listen for queue notifications, sleeping instead: {exc}')
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+            self._connection = None
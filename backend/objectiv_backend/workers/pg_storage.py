@@ -1,17 +1,26 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
-from datetime import datetime, timedelta
-
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, List, Optional, Sequence, Tuple
 
+import psycopg2
 from psycopg2.extras import execute_values
 
+from objectiv_backend.common.config import DATA_PARTITION_DAYS_AHEAD, SESSION_GAP_SECONDS
+from objectiv_backend.common.db import COPY_MIN_ROW_COUNT, copy_rows
 from objectiv_backend.common.event_utils import get_context
+from objectiv_backend.common.metrics import DB_WRITE_SECONDS, EVENTS, SINK_ERRORS
+from objectiv_backend.common.serialization import serialize_events
 from objectiv_backend.common.types import FailureReason, EventDataList
 
 
-def insert_events_into_data(connection, events: EventDataList):
+def insert_events_into_data(connection,
+                            events: EventDataList,
+                            partitioned: bool = False,
+                            event_jsons: Optional[Sequence[str]] = None,
+                            typed_data: bool = False) -> EventDataList:
     """
     Insert events into the 'data' table.
 
@@ -25,15 +34,31 @@ def insert_events_into_data(connection, events: EventDataList):
     fail if the blocking exceeds the lock_timeout. To minimize impact of blocks and rollbacks, try to keep
     transactions that use this function short and do not insert too much data in one call
 
+    Large batches (see COPY_MIN_ROW_COUNT) are first loaded into a temporary staging table with COPY, and
+    then inserted into the data table with a single 'insert ... select' statement. That is much faster than
+    multi-row insert statements, which makes a difference for backfills and replays.
+
+    If the data table is partitioned (see create_tables_partitioned.sql), then the primary key on event_id
+    is on the data_event_id table instead. The event_ids are inserted there first, and only the events for
+    which that succeeded are inserted in the data table. The same logic for duplicates applies.
+
+    If the data table has the typed layout (see create_tables_typed.sql), then the typed columns are filled
+    too.
+
     This function assumes that the postgres connection has the isolation level
     ISOLATION_LEVEL_READ_COMMITTED set and a lock_timeout is configured.
 
     :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
     :param events: EventDataList, list of events. Each event must be a valid Event, and must have a CookieIdContext
+    :param partitioned: whether the data table is partitioned.
+    :param event_jsons: optional, the events serialized with serialize_events(), to prevent serializing
+        the events again.
+    :param typed_data: whether the data table has the typed layout.
+    :return: the events that were inserted, i.e. without the duplicates
     :raise Exception: If the database is not available, or if it blocks longer than lock_timeout.
     """
     if not events:
-        return
+        return []
 
     # We use 'on conflict do nothing'. With the read-committed isolation level this guarantees that this
     # transaction will not insert a row that will conflict with another transaction, even if the results
@@ -50,67 +75,360 @@ def insert_events_into_data(connection, events: EventDataList):
     #
     # [1] https://www.postgresql.org/docs/13/transaction-iso.html
     # [2] https://www.postgresql.org/docs/13/sql-insert.html
-    insert_query = f'''
-        insert into data(event_id, day, moment, cookie_id, value)
-        values %s
-        on conflict(event_id) do nothing
-        returning event_id
-    '''
-    values = []
-    for event in events:
-        timestamp = _millis_to_datetime(event['time'])
-        cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
-        value = (event['id'],
-                 timestamp,
-                 timestamp,
-                 cookie_id,
-                 json.dumps(event))
-        values.append(value)
-    with connection.cursor() as cursor:
-        inserted_event_ids = execute_values(
-            cursor, insert_query, values, template=None, page_size=100, fetch=True)
+    if event_jsons is None:
+        event_jsons = serialize_events(events)
+    columns: Sequence[str]
+    if typed_data:
+        columns = _TYPED_DATA_COLUMNS
+        values = [_event_to_row(event, event_json) + _event_to_typed_values(event)
+                  for event, event_json in zip(events, event_jsons)]
+    else:
+        columns = _DATA_COLUMNS
+        values = [_event_to_row(event, event_json) for event, event_json in zip(events, event_jsons)]
+    with DB_WRITE_SECONDS.time(labels=('data',)), connection.cursor() as cursor:
+        if partitioned or len(values) >= COPY_MIN_ROW_COUNT:
+            inserted_event_ids = _copy_into_data(cursor, values, columns, partitioned)
+        else:
+            inserted_event_ids = _insert_into_data(cursor, values, columns)
 
     # Determine whether there were any duplicate events that were already in the table
-    # In case of duplicate events, we'll add those to the nok_data table for traceability
+    # In case of duplicate events, we'll add those to the nok_data table for traceability. An event_id is
+    # only returned once, so if it occurs multiple times in events, then only the first occurrence is
+    # considered inserted.
+    inserted_events = events
     duplicate_events: EventDataList = []
+    duplicate_event_jsons: List[str] = []
     if len(inserted_event_ids) < len(events):
-        inserted_event_ids_set = set(inserted_event_ids)
-        for event in events:
-            if event['id'] not in inserted_event_ids_set:
+        inserted_events = []
+        inserted_event_ids_set = {row[0] for row in inserted_event_ids}
+        for event, event_json in zip(events, event_jsons):
+            event_id = uuid.UUID(event['id'])
+            if event_id in inserted_event_ids_set:
+                inserted_event_ids_set.remove(event_id)
+                inserted_events.append(event)
+            else:
                 duplicate_events.append(event)
+                duplicate_event_jsons.append(event_json)
+    EVENTS.inc(len(events) - len(duplicate_events), labels=('ok',))
     if duplicate_events:
+        EVENTS.inc(len(duplicate_events), labels=('duplicate',))
         print(f'Duplicate events found, count: {len(duplicate_events)}. '
               f'Will be inserted in nok_data table.')
-        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE)
+        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE,
+                                    event_jsons=duplicate_event_jsons)
+    return inserted_events
 
 
 def insert_events_into_nok_data(connection,
                                 events: EventDataList,
-                                reason: FailureReason = FailureReason.FAILED_VALIDATION):
+                                reason: FailureReason = FailureReason.FAILED_VALIDATION,
+                                event_jsons: Optional[Sequence[str]] = None):
     """
     Insert events into the not-ok data ('nok_data') table
     Does not do any transaction management, this merely issues insert commands.
     :param connection: db connection
     :param events: EventDataList, list of events. Each event must have a CookieIdContext
     :param reason: Why are these events written to the nok_data table.
+    :param event_jsons: optional, the events serialized with serialize_events(), to prevent serializing
+        the events again.
     """
     if not events:
         return
 
-    insert_query = f'insert into nok_data (event_id, day, moment, cookie_id, value, reason) values %s'
-    values = []
+    if event_jsons is None:
+        event_jsons = serialize_events(events)
+    values = [_event_to_row(event, event_json) + (reason.value, )
+              for event, event_json in zip(events, event_jsons)]
+    with DB_WRITE_SECONDS.time(labels=('nok_data',)), connection.cursor() as cursor:
+        if len(values) >= COPY_MIN_ROW_COUNT:
+            # There are no unique constraints on nok_data, so we can copy straight into the table
+            copy_rows(cursor, 'nok_data', _NOK_DATA_COLUMNS, values)
+        else:
+            insert_query = f'insert into nok_data ({", ".join(_NOK_DATA_COLUMNS)}) values %s'
+            execute_values(cursor, insert_query, values, template=None, page_size=100)
+
+
+_DATA_COLUMNS = ('event_id', 'day', 'moment', 'cookie_id', 'value')
+_NOK_DATA_COLUMNS = _DATA_COLUMNS + ('reason', )
+# Columns of the data table with the typed layout, see create_tables_typed.sql
+_TYPED_DATA_COLUMNS = _DATA_COLUMNS + ('event_type', )
+
+
+def _event_to_row(event, event_json: str) -> Tuple[Any, ...]:
+    """ Get the values for the _DATA_COLUMNS of an event, and its serialized form. """
+    timestamp = _millis_to_datetime(event['time'])
+    cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
+    return (event['id'],
+            timestamp,
+            timestamp,
+            cookie_id,
+            event_json)
+
+
+def _event_to_typed_values(event) -> Tuple[Any, ...]:
+    """ Get the values for the columns that _TYPED_DATA_COLUMNS adds to _DATA_COLUMNS. """
+    return (event['_type'], )
+
+
+def _insert_into_data(cursor, values: List[Tuple[Any, ...]], columns: Sequence[str]) -> List[Tuple[Any, ...]]:
+    """
+    Insert rows into the data table with multi-row insert statements. See insert_events_into_data() for
+    how conflicts are handled.
+    :param columns: the columns of the data table, in the same order as the values in each row
+    :return: list of rows with the event_ids that were actually inserted
+    """
+    insert_query = f'''
+        insert into data({", ".join(columns)})
+        values %s
+        on conflict(event_id) do nothing
+        returning event_id
+    '''
+    return execute_values(cursor, insert_query, values, template=None, page_size=100, fetch=True)
+
+
+def _copy_into_data(cursor,
+                    values: List[Tuple[Any, ...]],
+                    columns: Sequence[str],
+                    partitioned: bool) -> List[Tuple[Any, ...]]:
+    """
+    Insert rows into the data table by copying them into a staging table first, and then inserting them
+    into the data table with a single statement. See insert_events_into_data() for how conflicts are handled.
+    :param columns: the columns of the data table, in the same order as the values in each row
+    :param partitioned: whether the data table is partitioned.
+    :return: list of rows with the event_ids that were actually inserted
+    """
+    # The staging table is only visible to this session, and is emptied on commit. Because connections are
+    # reused, the table is normally only created once per connection. We still truncate it, in case this
+    # function is called multiple times in the same transaction.
+    cursor.execute('''
+        create temporary table if not exists data_staging (like data) on commit delete rows;
+        truncate data_staging;
+    ''')
+    copy_rows(cursor, 'data_staging', columns, values)
+    column_list = ", ".join(columns)
+    if partitioned:
+        # An event_id can occur multiple times in the staging table, but is only returned once by the
+        # insert into data_event_id. We insert the first of those rows, the others are duplicates. As the
+        # staging table was just truncated, ordering on ctid gives the original order.
+        query = f'''
+            with new_event_ids as (
+                insert into data_event_id(event_id)
+                select event_id from data_staging
+                on conflict(event_id) do nothing
+                returning event_id
+            )
+            insert into data({column_list})
+            select distinct on (event_id) {column_list}
+            from data_staging
+            inner join new_event_ids using (event_id)
+            order by event_id, data_staging.ctid
+            returning event_id
+        '''
+    else:
+        query = f'''
+            insert into data({column_list})
+            select {column_list} from data_staging
+            on conflict(event_id) do nothing
+            returning event_id
+        '''
+    cursor.execute(query)
+    return cursor.fetchall()
+
+
+# Day on which this process last made sure that the upcoming data partitions exist.
+_data_partitions_ensured_on: Optional[date] = None
+
+
+def ensure_data_partitions(connection):
+    """
+    Make sure that the partitions of the data table exist for yesterday up to DATA_PARTITION_DAYS_AHEAD
+    days ahead. Does the actual work at most once a day per process, in its own transaction, so this must
+    not be called while a transaction is open.
+
+    Failures are printed and not raised: events for days without a partition end up in the default
+    partition, so nothing is lost. After a failure, the next call tries again.
+    :param connection: psycopg2 database connection.
+    """
+    global _data_partitions_ensured_on
+    today = datetime.utcnow().date()
+    if _data_partitions_ensured_on == today:
+        return
+    try:
+        with connection:
+            create_data_partitions(connection,
+                                   first_day=today - timedelta(days=1),
+                                   last_day=today + timedelta(days=DATA_PARTITION_DAYS_AHEAD))
+    except psycopg2.Error as exc:
+        print(f'Could not create data partitions: {exc}')
+        return
+    _data_partitions_ensured_on = today
+
+
+def create_data_partitions(connection, first_day: date, last_day: date):
+    """
+    Create the partitions of the partitioned data table for the days from first_day up to and including
+    last_day, that don't exist yet. Rows in the default partition that belong to a new partition are moved
+    to it.
+
+    Calls the create_data_partitions() function of create_tables_partitioned.sql, which runs with the
+    privileges of the owner of the data table. So this also works for the collector and worker roles, which
+    can only insert into the data table.
+
+    Does not do any transaction management. Concurrent calls are serialized with an advisory lock, that is
+    held until the end of the transaction.
+    :param connection: psycopg2 database connection.
+    :param first_day: first day to create a partition for
+    :param last_day: last day to create a partition for
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('select create_data_partitions(%s, %s)', (first_day, last_day))
+
+
+# Computes the sessions table from all events in the data table. A session starts at every event that is more
+# than %(gap)s after the previous event of the same cookie. The session_id is the event_id of the first event.
+_REBUILD_SESSIONS_QUERY = '''
+    with session_starts as (
+        select
+            cookie_id,
+            event_id,
+            moment,
+            coalesce(
+                moment - lag(moment) over (partition by cookie_id order by moment, event_id) > %(gap)s,
+                true
+            ) as is_start_of_session
+        from data
+    ),
+    numbered as (
+        select
+            *,
+            count(*) filter (where is_start_of_session)
+                over (partition by cookie_id order by moment, event_id) as session_number
+        from session_starts
+    )
+    insert into sessions(session_id, cookie_id, start_moment, end_moment, event_count)
+    select (array_agg(event_id order by moment, event_id))[1], cookie_id, min(moment), max(moment), count(*)
+    from numbered
+    group by cookie_id, session_number
+'''
+
+
+def update_sessions(connection, events: EventDataList, gap_seconds: int = SESSION_GAP_SECONDS):
+    """
+    Update the sessions table (see create_tables.sql) with events that were just inserted into the data table.
+
+    The cost depends on the number of new events, not on the number of events in the data table: the data
+    table is not read at all. The sessions of a cookie are more than gap_seconds apart, and within a session
+    consecutive events are at most gap_seconds apart. So a new event can only extend a session, start a new
+    session, or merge sessions, if it is within gap_seconds of them. Those sessions are deleted, merged with
+    the new events, and inserted again. This works the same for events that arrive late.
+
+    Updates of the same cookie are serialized with advisory locks, that are held until the end of the
+    transaction. To prevent deadlocks, this must be called after inserting the events, in the same
+    transaction, and the transaction must be committed soon after.
+
+    Does not do any transaction management.
+    :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
+    :param events: EventDataList, the events that were inserted, as returned by insert_events_into_data().
+        Duplicates that were not inserted must not be included. Each event must have a CookieIdContext
+    :param gap_seconds: maximum time between two consecutive events in a session. Must be the same as the
+        gap that the sessions table was built with.
+    """
+    if not events:
+        return
+    # Each new event is a session by itself, until it's merged
+    new_sessions: List[Tuple[uuid.UUID, uuid.UUID, datetime, datetime, int]] = []
     for event in events:
-        timestamp = _millis_to_datetime(event['time'])
-        cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
-        value = (event['id'],
-                 timestamp,
-                 timestamp,
-                 cookie_id,
-                 json.dumps(event),
-                 reason.value)
-        values.append(value)
+        moment = _millis_to_datetime(event['time'])
+        cookie_id = uuid.UUID(str(get_context(event, 'CookieIdContext')['cookie_id']))
+        new_sessions.append((uuid.UUID(event['id']), cookie_id, moment, moment, 1))
+    # The keys of the advisory locks are derived from the cookie_ids. The locks are taken in the order of the
+    # keys, such that concurrent transactions cannot deadlock on them.
+    lock_keys = sorted({session[1].int % 2**32 - 2**31 for session in new_sessions})
+    gap = timedelta(seconds=gap_seconds)
+    with DB_WRITE_SECONDS.time(labels=('sessions',)), connection.cursor() as cursor:
+        cursor.execute('''
+            select count(pg_advisory_xact_lock(hashtext('objectiv_sessions'), key))
+            from unnest(%s::integer[]) as key
+        ''', (lock_keys, ))
+        cursor.execute('''
+            delete from sessions as s
+            using unnest(%(cookie_ids)s::uuid[], %(moments)s::timestamp[]) as e(cookie_id, moment)
+            where s.cookie_id = e.cookie_id
+              and s.start_moment <= e.moment + %(gap)s
+              and s.end_moment >= e.moment - %(gap)s
+            returning s.session_id, s.cookie_id, s.start_moment, s.end_moment, s.event_count
+        ''', {'cookie_ids': [str(session[1]) for session in new_sessions],
+              'moments': [session[2] for session in new_sessions],
+              'gap': gap})
+        sessions = _merge_sessions(cursor.fetchall() + new_sessions, gap)
+        execute_values(cursor, '''
+            insert into sessions(session_id, cookie_id, start_moment, end_moment, event_count)
+            values %s
+        ''', sessions, template=None, page_size=100)
+
+
+def try_update_sessions(connection, events: EventDataList, gap_seconds: int = SESSION_GAP_SECONDS) -> bool:
+    """
+    Call update_sessions() in a savepoint, such that a failure doesn't fail the rest of the transaction,
+    e.g. the insert of the events into the data table. The sessions table is derived from the data table, so
+    if this fails, the events are not lost: they are in the data_with_sessions view without a session, until
+    `objectiv-db-init --rebuild-sessions` computes the sessions again. Failures are logged, and counted in the
+    SINK_ERRORS metric.
+
+    Does not do any transaction management, other than the savepoint.
+    :param connection: psycopg2 database connection, see update_sessions()
+    :param events: EventDataList, see update_sessions()
+    :param gap_seconds: see update_sessions()
+    :return: True if the sessions were updated, False otherwise
+    """
+    if not events:
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute('savepoint update_sessions')
+        try:
+            update_sessions(connection, events=events, gap_seconds=gap_seconds)
+        except psycopg2.Error as exc:
+            cursor.execute('rollback to savepoint update_sessions')
+            SINK_ERRORS.inc(labels=('sessions',))
+            print(f'Error updating sessions of {len(events)} events: {exc}')
+            return False
+        cursor.execute('release savepoint update_sessions')
+    return True
+
+
+def _merge_sessions(sessions: List[Tuple[uuid.UUID, uuid.UUID, datetime, datetime, int]],
+                    gap: timedelta) -> List[Tuple[uuid.UUID, uuid.UUID, datetime, datetime, int]]:
+    """
+    Merge the sessions of the same cookie that are at most gap apart.
+    :param sessions: list of tuples: session_id, cookie_id, start_moment, end_moment, event_count
+    :return: the merged sessions, in the same format. The session_id of a merged session is the one of the
+        session that starts first, which is the event_id of its first event.
+    """
+    merged: List[Tuple[uuid.UUID, uuid.UUID, datetime, datetime, int]] = []
+    for session in sorted(sessions, key=lambda s: (s[1], s[2], s[0])):
+        session_id, cookie_id, start_moment, end_moment, event_count = session
+        if merged and merged[-1][1] == cookie_id and start_moment - merged[-1][3] <= gap:
+            previous = merged[-1]
+            merged[-1] = (previous[0], cookie_id, previous[2], max(previous[3], end_moment),
+                          previous[4] + event_count)
+        else:
+            merged.append(session)
+    return merged
+
+
+def rebuild_sessions(connection, gap_seconds: int = SESSION_GAP_SECONDS):
+    """
+    Compute the sessions table from scratch, from all events in the data table. Needed after changing the
+    session gap. This locks the sessions table until the end of the transaction, so the workers wait until it
+    is committed.
+
+    Does not do any transaction management.
+    :param connection: psycopg2 database connection.
+    :param gap_seconds: maximum time between two consecutive events in a session.
+    """
     with connection.cursor() as cursor:
-        execute_values(cursor, insert_query, values, template=None, page_size=100)
+        cursor.execute('truncate sessions')
+        cursor.execute(_REBUILD_SESSIONS_QUERY, {'gap': timedelta(seconds=gap_seconds)})
 
 
 def _millis_to_datetime(millis: int) -> datetime:
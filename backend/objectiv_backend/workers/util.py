@@ -1,36 +1,163 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import argparse
 import time
-from typing import Callable, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Any, Sequence
 
-from objectiv_backend.common.config import get_config_postgres
-from objectiv_backend.common.db import get_db_connection
+import psycopg2
 
+from objectiv_backend.common.config import get_config_postgres, WORKER_BATCH_SIZE, WORKER_MIN_BATCH_SIZE, \
+    WORKER_SLEEP_SECONDS, PostgresConfig
+from objectiv_backend.common.db import get_connection_pool, update_pool_metrics
+from objectiv_backend.common.metrics import WORKER_BATCH_SECONDS, start_metrics_server
+from objectiv_backend.workers.pg_queues import ProcessingStage, QueueListener, update_queue_depth_metric
 
-def worker_main(function: Callable[[Any], int], loop: bool) -> int:
+
+class AdaptiveBatchSize:
+    """
+    Number of events to pick from a queue in one batch, that follows the depth of the queue.
+
+    If a full batch was picked, then there are probably more events waiting, and the batch size is doubled
+    (up to max_size). If fewer events were picked, then the batch size shrinks to the number of picked events
+    (but not below WORKER_MIN_BATCH_SIZE). Small batches keep transactions short when the queue is nearly
+    empty, while big batches give a higher throughput when there is a backlog.
+    """
+
+    def __init__(self, max_size: int = WORKER_BATCH_SIZE):
+        if max_size < 1:
+            raise ValueError(f'max_size must be at least 1, got {max_size}')
+        self.max_size = max_size
+        self.min_size = min(WORKER_MIN_BATCH_SIZE, max_size)
+        self.size = max_size
+
+    def update(self, event_count: int):
+        """ Update the batch size, based on the number of events that were picked with the current size. """
+        if event_count >= self.size:
+            self.size = min(self.size * 2, self.max_size)
+        else:
+            self.size = max(event_count, self.min_size)
+
+
+def _get_pg_config() -> PostgresConfig:
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    return pg_config
+
+
+def worker_run(function: Callable[[Any, int], int], batch_size: AdaptiveBatchSize) -> int:
+    """
+    Run the function once, with a connection from the process' connection pool and the current batch size.
+    Updates the batch_size based on the number of processed events.
+    :param function: function that will be called. Should take a `connection` and a maximum number of events
+        as arguments. The connection is a db_connection from the process' connection pool, as delivered by
+        get_connection_pool()
+    :param batch_size: batch size for the function
+    :return: number of processed events
+    """
+    start = time.time()
+    with get_connection_pool(_get_pg_config()).connection() as connection:
+        event_count = function(connection, batch_size.size)
+    batch_size.update(event_count)
+    end = time.time()
+    if event_count:
+        WORKER_BATCH_SECONDS.observe(end - start, labels=(function.__name__.split('_')[-1],))
+    print(f'Processing time: {(end - start):.5} s')
+    return event_count
+
+
+def start_worker_metrics_server(port: int):
+    """ Serve the metrics of this worker process on the given port, see start_metrics_server() """
+    pg_config = _get_pg_config()
+
+    def on_scrape():
+        update_pool_metrics(pg_config)
+        update_queue_depth_metric(pg_config)
+
+    start_metrics_server(port, on_scrape=on_scrape)
+
+
+def get_queue_listener(queues: Sequence[ProcessingStage]) -> QueueListener:
+    """ Get a listener that can be used to wait till events are put on one of the given queues. """
+    return QueueListener(pg_config=_get_pg_config(), queues=queues)
+
+
+def worker_main(function: Callable[[Any, int], int],
+                loop: bool,
+                max_batch: int = WORKER_BATCH_SIZE,
+                queue: ProcessingStage = None,
+                metrics_port: int = None) -> int:
     """
     Run the function once, or in a loop.
     Will print the last part of the function's name and information about the function's execution time.
 
-    If running in a loop it will sleep a second between invocations if the function returns 0.
-    :param function: function that will be called. Should take a `connection` as arguments. The connection
-        is a db_connection as delivered by get_db_connection()
+    If running in a loop and the function returns 0, then it will wait till events are put on the queue
+    before calling the function again, but not longer than WORKER_SLEEP_SECONDS. Without a queue it will sleep
+    a second between invocations if the function returns 0. If the database connection is lost while running
+    in a loop, then the function will be retried with a new connection.
+    :param function: function that will be called, see worker_run()
     :param loop: whether to call the function once (False) or in an endless loop (True)
+    :param max_batch: maximum number of events to process per call of function. If running in a loop the
+        actual number follows the depth of the queue, see AdaptiveBatchSize
+    :param queue: the queue that function processes. If not set, the worker will sleep a second if the
+        function returns 0.
+    :param metrics_port: if set, serve the metrics of this process on this port
     :return number of processed events, if loop is False
     """
-    pg_config = get_config_postgres()
-    if pg_config is None:
-        raise Exception('Missing Postgres configuration')
-    connection = get_db_connection(pg_config)
     name = function.__name__.split('_')[-1]
     print(f'{name} worker')
+    if metrics_port:
+        start_worker_metrics_server(metrics_port)
+    batch_size = AdaptiveBatchSize(max_size=max_batch)
+    listener = get_queue_listener(queues=[queue]) if loop and queue else None
     while True:
-        start = time.time()
-        event_count = function(connection)
-        end = time.time()
-        print(f'Processing time: {(end - start):.5} s')
+        try:
+            event_count = worker_run(function, batch_size)
+        except psycopg2.OperationalError as exc:
+            if not loop:
+                raise
+            print(f'Database error, will retry: {exc}')
+            time.sleep(1)
+            continue
         if not loop:
             return event_count
         if event_count == 0:
-            time.sleep(1)
+            if listener:
+                listener.wait(timeout=WORKER_SLEEP_SECONDS)
+            else:
+                time.sleep(1)
+
+
+def run_concurrently(target: Callable[..., int], concurrency: int, metrics_port: int = None, **kwargs) -> int:
+    """
+    Run `concurrency` instances of target(**kwargs), each in its own process, and wait till all are done.
+
+    Each process has its own connection pool. Multiple workers can safely process the same queue, as
+    picking events from a queue uses `for update skip locked`, see PostgresQueues.get_events()
+    :param target: worker function, e.g. worker_main. Must be a module level function, and accept a
+        metrics_port argument.
+    :param concurrency: number of processes to start
+    :param metrics_port: if set, the processes serve their metrics on consecutive ports starting at this port
+    :return: sum of the return values of all instances
+    """
+    if concurrency == 1:
+        return target(metrics_port=metrics_port, **kwargs)
+    with ProcessPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(target, metrics_port=metrics_port + i if metrics_port else None, **kwargs)
+                   for i in range(concurrency)]
+        return sum(future.result() for future in futures)
+
+
+def add_worker_arguments(parser: argparse.ArgumentParser):
+    """ Add the command line arguments that are shared by all workers to the parser. """
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep processing events, instead of processing a single batch')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of worker processes to run in parallel')
+    parser.add_argument('--max-batch', type=int, default=WORKER_BATCH_SIZE,
+                        help='Maximum number of events a worker process handles in a single transaction')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port. With a concurrency of N, the worker '
+                             'processes use this port and the N-1 ports after it')
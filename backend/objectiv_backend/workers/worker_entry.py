@@ -1,28 +1,32 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import argparse
 import sys
 import time
 from typing import List, Tuple
 
 from objectiv_backend.common.config import WORKER_BATCH_SIZE, get_collector_config
+from objectiv_backend.common.metrics import EVENTS, STAGE_SECONDS
 from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
 from objectiv_backend.schema.validate_events import validate_event_adheres_to_schema, validate_event_time, EventError
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
 from objectiv_backend.workers.pg_storage import insert_events_into_nok_data
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.util import worker_main, run_concurrently, add_worker_arguments
 from objectiv_backend.common.types import EventDataList
 
 
-def main_entry(connection) -> int:
+def main_entry(connection, max_items: int = WORKER_BATCH_SIZE) -> int:
     """
     Pick events from the entry queue and insert them into the finalize queue.
+    :param connection: database connection
+    :param max_items: maximum number of events to pick from the queue
     :return number of processed events
     """
     with connection:
         pg_queues = PostgresQueues(connection=connection)
         events: EventDataList = pg_queues.get_events(queue=ProcessingStage.ENTRY,
-                                                     max_items=WORKER_BATCH_SIZE)
+                                                     max_items=max_items)
         print(f'event-ids: {sorted(event["id"] for event in events)}')
 
         ok_events, nok_events, event_errors = process_events_entry(events)
@@ -55,11 +59,16 @@ def process_events_entry(events: EventDataList, current_millis: int = 0) -> \
     if current_millis == 0:
         current_millis = round(time.time() * 1000)
 
+    # Time spent per stage, summed over all events, such that the metrics are only updated once per batch
+    validation_seconds = 0.0
+    hydration_seconds = 0.0
     for event in events:
-
+        start = time.perf_counter()
         error_info = \
             validate_event_adheres_to_schema(event_schema=event_schema, event=event) + \
             validate_event_time(event=event, current_millis=current_millis)
+        validated = time.perf_counter()
+        validation_seconds += validated - start
 
         if error_info:
             print(f"error, event_id: {event['id']}, errors: {[ei.info for ei in error_info]}")
@@ -68,9 +77,23 @@ def process_events_entry(events: EventDataList, current_millis: int = 0) -> \
         else:
             event = hydrate_types_into_event(event_schema=event_schema, event=event)
             ok_events.append(event)
+            hydration_seconds += time.perf_counter() - validated
+    if events:
+        STAGE_SECONDS.observe(validation_seconds, labels=('validation',))
+        STAGE_SECONDS.observe(hydration_seconds, labels=('hydration',))
+    if nok_events:
+        EVENTS.inc(len(nok_events), labels=('nok',))
     return ok_events, nok_events, event_errors
 
 
+def main():
+    parser = argparse.ArgumentParser(prog='worker_entry')
+    add_worker_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+    return run_concurrently(worker_main, concurrency=args.concurrency, metrics_port=args.metrics_port,
+                            function=main_entry, loop=args.loop, max_batch=args.max_batch,
+                            queue=ProcessingStage.ENTRY)
+
+
 if __name__ == '__main__':
-    _loop = sys.argv[1:2] == ['--loop']
-    worker_main(function=main_entry, loop=_loop)
+    main()
@@ -1,28 +1,45 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import argparse
 import sys
 
-from objectiv_backend.common.config import WORKER_BATCH_SIZE
+from objectiv_backend.common.config import WORKER_BATCH_SIZE, get_config_postgres
 from objectiv_backend.common.types import EventDataList
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
-from objectiv_backend.workers.pg_storage import insert_events_into_data
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.pg_storage import insert_events_into_data, ensure_data_partitions, try_update_sessions
+from objectiv_backend.workers.util import worker_main, run_concurrently, add_worker_arguments
 
 
-def main_finalize(connection) -> int:
+def main_finalize(connection, max_items: int = WORKER_BATCH_SIZE) -> int:
     """
-    Pick events from the finalize queue, and write them to the data table.
+    Pick events from the finalize queue, write them to the data table, and update their sessions.
+    :param connection: database connection
+    :param max_items: maximum number of events to pick from the queue
     :return number of processed events
     """
+    pg_config = get_config_postgres()
+    partition_data = pg_config is not None and pg_config.partition_data
+    if partition_data:
+        ensure_data_partitions(connection)
     with connection:
         pg_queues = PostgresQueues(connection=connection)
-        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=WORKER_BATCH_SIZE)
+        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=max_items)
         print(f'event-ids: {sorted(event["id"] for event in events)}')
-        insert_events_into_data(connection, events)
+        inserted_events = insert_events_into_data(connection, events, partitioned=partition_data,
+                                                  typed_data=pg_config is not None and pg_config.typed_data)
+        try_update_sessions(connection, inserted_events)
     return len(events)
 
 
+def main():
+    parser = argparse.ArgumentParser(prog='worker_finalize')
+    add_worker_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+    return run_concurrently(worker_main, concurrency=args.concurrency, metrics_port=args.metrics_port,
+                            function=main_finalize, loop=args.loop, max_batch=args.max_batch,
+                            queue=ProcessingStage.FINALIZE)
+
+
 if __name__ == '__main__':
-    _loop = sys.argv[1:2] == ['--loop']
-    worker_main(function=main_finalize, loop=_loop)
+    main()
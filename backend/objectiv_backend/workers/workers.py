@@ -5,22 +5,43 @@ import argparse
 import sys
 import time
 
-from objectiv_backend.common.config import WORKER_SLEEP_SECONDS
-from objectiv_backend.workers.util import worker_main
+import psycopg2
+
+from objectiv_backend.common.config import WORKER_SLEEP_SECONDS, WORKER_BATCH_SIZE
+from objectiv_backend.workers.pg_queues import ProcessingStage
+from objectiv_backend.workers.util import worker_main, worker_run, run_concurrently, add_worker_arguments, \
+    AdaptiveBatchSize, get_queue_listener, start_worker_metrics_server
 from objectiv_backend.workers.worker_entry import main_entry
 from objectiv_backend.workers.worker_finalize import main_finalize
 
 
-def call_all(loop: bool):
+def call_all(loop: bool, max_batch: int = WORKER_BATCH_SIZE, metrics_port: int = None) -> int:
+    """
+    Run the entry worker and then the finalize worker, once or in a loop.
+    :param metrics_port: if set, serve the metrics of this process on this port
+    :return number of processed events, if loop is False
+    """
+    if metrics_port:
+        start_worker_metrics_server(metrics_port)
+    entry_batch_size = AdaptiveBatchSize(max_size=max_batch)
+    finalize_batch_size = AdaptiveBatchSize(max_size=max_batch)
+    listener = get_queue_listener(queues=[ProcessingStage.ENTRY, ProcessingStage.FINALIZE]) if loop else None
     while True:
-        event_count = worker_main(function=main_entry, loop=False)
-        event_count += worker_main(function=main_finalize, loop=False)
+        try:
+            event_count = worker_run(function=main_entry, batch_size=entry_batch_size)
+            event_count += worker_run(function=main_finalize, batch_size=finalize_batch_size)
+        except psycopg2.OperationalError as exc:
+            if not loop:
+                raise
+            print(f'Database error, will retry: {exc}')
+            time.sleep(1)
+            continue
         if not loop:
-            break
-        if event_count == 0:
+            return event_count
+        if event_count == 0 and listener:
             # sleeping a short random time is nice for catching concurrency problems
             # time.sleep(0.2 * random.random())
-            time.sleep(WORKER_SLEEP_SECONDS)
+            listener.wait(timeout=WORKER_SLEEP_SECONDS)
 
 
 def main():
@@ -29,14 +50,19 @@ def main():
                         choices=['all', 'entry', 'finalize'],
                         default='all',
                         type=str)
-    parser.add_argument('--loop', action='store_true')
+    add_worker_arguments(parser)
     args = parser.parse_args(sys.argv[1:])
     if args.type == 'all':
-        return call_all(args.loop)
+        return run_concurrently(call_all, concurrency=args.concurrency, metrics_port=args.metrics_port,
+                                loop=args.loop, max_batch=args.max_batch)
     if args.type == 'entry':
-        return worker_main(function=main_entry, loop=args.loop)
+        return run_concurrently(worker_main, concurrency=args.concurrency, metrics_port=args.metrics_port,
+                                function=main_entry, loop=args.loop, max_batch=args.max_batch,
+                                queue=ProcessingStage.ENTRY)
     if args.type == 'finalize':
-        return worker_main(function=main_finalize, loop=args.loop)
+        return run_concurrently(worker_main, concurrency=args.concurrency, metrics_port=args.metrics_port,
+                                function=main_finalize, loop=args.loop, max_batch=args.max_batch,
+                                queue=ProcessingStage.FINALIZE)
 
 
 if __name__ == '__main__':
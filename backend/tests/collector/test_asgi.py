@@ -0,0 +1,195 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import asyncio
+import gzip
+import json
+import threading
+import time
+from typing import Any, Dict, List
+
+import psycopg2
+import pytest
+
+from objectiv_backend.app import create_app
+from objectiv_backend.asgi import CollectorApp
+from objectiv_backend.end_points import collector
+from tests.schema.test_schema import CLICK_EVENT_JSON
+
+
+def _get_event_list_json() -> bytes:
+    event_list = json.loads(CLICK_EVENT_JSON)
+    event_list['transport_time'] = round(time.time() * 1000)
+    event_list['events'][0]['time'] = event_list['transport_time'] - 1000
+    return json.dumps(event_list).encode('utf-8')
+
+
+async def _request(app: CollectorApp, method: str, path: str, chunks: List[bytes],
+                   headers: Dict[str, str] = None) -> Dict[str, Any]:
+    """ Send a request to the ASGI app, with the body in the given chunks, and return the response. """
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        'client': ('127.0.0.1', 12345),
+        'server': ('localhost', 5000),
+    }
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    assert [m['type'] for m in sent] == ['http.response.start', 'http.response.body']
+    return {
+        'status': sent[0]['status'],
+        'headers': {k.decode(): v.decode() for k, v in sent[0]['headers']},
+        'json': json.loads(sent[1]['body']) if sent[0]['status'] != 500 else None
+    }
+
+
+@pytest.fixture
+def writer_calls(monkeypatch) -> List[str]:
+    """ Replace the sinks by two writers, that can only finish if they run concurrently. """
+    calls: List[str] = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def get_sync_writers(ok_events, nok_events, event_errors=None):
+        def writer(name):
+            barrier.wait()
+            calls.append(name)
+        return [lambda: writer('postgres'), lambda: writer('snowplow')]
+
+    monkeypatch.setattr(collector, 'get_sync_writers', get_sync_writers)
+    return calls
+
+
+def test_collect(writer_calls):
+    app = CollectorApp(create_app())
+    data = _get_event_list_json()
+    response = asyncio.run(_request(app, 'POST', '/', [data[:100], data[100:]]))
+    assert response['status'] == 200
+    assert response['json']['event_count'] == 1
+    assert response['json']['error_count'] == 0
+    assert 'obj_user_id=' in response['headers']['set-cookie']
+    assert sorted(writer_calls) == ['postgres', 'snowplow']
+
+
+def test_collect_invalid_data(writer_calls):
+    app = CollectorApp(create_app())
+    response = asyncio.run(_request(app, 'POST', '/', [b'{"events": "not a list"}']))
+    assert response['json']['event_count'] == -1
+    assert response['json']['error_count'] == 1
+    assert writer_calls == []
+
+    data = b'{"events": [' + b' ' * collector.DATA_MAX_SIZE_BYTES + b']}'
+    response = asyncio.run(_request(app, 'POST', '/', [data[:1000], data[1000:]]))
+    assert response['json']['error_count'] == 1
+    assert writer_calls == []
+
+
+def test_collect_backpressure(monkeypatch):
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def writer():
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(max_active, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+
+    monkeypatch.setattr(collector, 'get_sync_writers', lambda **kwargs: [writer])
+    app = CollectorApp(create_app(), max_concurrent_writes=2, writer_threads=8)
+
+    async def requests():
+        return await asyncio.gather(*(_request(app, 'POST', '/', [_get_event_list_json()]) for _ in range(6)))
+
+    responses = asyncio.run(requests())
+    assert [r['json']['event_count'] for r in responses] == [1] * 6
+    assert max_active == 2
+
+
+def test_other_endpoints(monkeypatch):
+    written = []
+    monkeypatch.setattr(collector, 'write_sync_events',
+                        lambda ok_events, nok_events, event_errors=None: written.append(len(ok_events)))
+    app = CollectorApp(create_app())
+
+    response = asyncio.run(_request(app, 'GET', '/schema', [b'']))
+    assert response['status'] == 200
+    assert 'PressEvent' in response['json']['events']
+
+    # The body of requests that are passed on to the Flask app is streamed
+    event = json.loads(_get_event_list_json())['events'][0]
+    data = gzip.compress(b'\n'.join(json.dumps(event).encode('utf-8') for _ in range(3)))
+    response = asyncio.run(_request(app, 'POST', '/bulk', [data[:10], data[10:20], data[20:]],
+                                    headers={'Content-Encoding': 'gzip'}))
+    assert response['json']['event_count'] == 3
+    assert written == [3]
+
+
+def test_collect_sink_errors(monkeypatch):
+    postgres_error = None
+
+    # writers are named like the functions of the collector, the sink is derived from the name
+    def _write_sync_events_to_postgres():
+        if postgres_error:
+            raise postgres_error
+
+    def _write_events_to_files():
+        raise OSError('disk full')
+
+    monkeypatch.setattr(collector, 'get_sync_writers',
+                        lambda **kwargs: [_write_sync_events_to_postgres, _write_events_to_files])
+    app = CollectorApp(create_app())
+
+    # A best-effort sink that fails doesn't fail the request
+    response = asyncio.run(_request(app, 'POST', '/', [_get_event_list_json()]))
+    assert response['status'] == 200
+    assert response['json']['event_count'] == 1
+
+    # If the events cannot be written to Postgres, then the tracker must retry them
+    postgres_error = Exception('database is down')
+    response = asyncio.run(_request(app, 'POST', '/', [_get_event_list_json()]))
+    assert response['status'] == 500
+
+
+def test_collect_postgres_down(monkeypatch):
+    class FailingPool:
+        def connection(self):
+            raise psycopg2.OperationalError('could not connect to server')
+
+    # the real sync writers, with a connection pool that cannot connect
+    monkeypatch.setattr(collector, 'get_connection_pool', lambda pg_config: FailingPool())
+    flask_app = create_app()
+    response = asyncio.run(_request(CollectorApp(flask_app), 'POST', '/', [_get_event_list_json()]))
+    assert response['status'] == 500
+
+    # the Flask app doesn't fail the request, as before
+    response = flask_app.test_client().post('/', data=_get_event_list_json())
+    assert response.status_code == 200
+
+
+def test_collect_prepares_events_in_executor(monkeypatch, writer_calls):
+    threads = []
+    add_enriched_contexts = collector.add_enriched_contexts
+    monkeypatch.setattr(collector, 'add_enriched_contexts',
+                        lambda events: threads.append(threading.current_thread().name) or
+                        add_enriched_contexts(events))
+    app = CollectorApp(create_app())
+    response = asyncio.run(_request(app, 'POST', '/', [_get_event_list_json()]))
+    assert response['json']['event_count'] == 1
+    # not on the thread that runs the event loop
+    assert len(threads) == 1 and threads[0].startswith('collector-writer')
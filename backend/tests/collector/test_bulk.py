@@ -0,0 +1,138 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import gzip
+import json
+import time
+import tracemalloc
+import uuid
+import zlib
+from typing import List
+
+import pytest
+
+from objectiv_backend.app import create_app
+from objectiv_backend.end_points import collector
+from tests.schema.test_schema import CLICK_EVENT_JSON
+
+
+@pytest.fixture
+def written_chunks(monkeypatch) -> List[int]:
+    """ Replace the sync outputs, and return the list to which the number of events per write is appended. """
+    chunks: List[int] = []
+
+    def write_sync_events(ok_events, nok_events, event_errors=None):
+        chunks.append(len(ok_events) + len(nok_events))
+
+    monkeypatch.setattr(collector, 'write_sync_events', write_sync_events)
+    return chunks
+
+
+def _make_ndjson(event_count: int) -> bytes:
+    event = json.loads(CLICK_EVENT_JSON)['events'][0]
+    event['time'] = round(time.time() * 1000) - 1000
+    lines = []
+    for _ in range(event_count):
+        event['id'] = str(uuid.uuid4())
+        lines.append(json.dumps(event))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def _post_bulk(data: bytes, content_encoding: str = None):
+    headers = {'Content-Encoding': content_encoding} if content_encoding else {}
+    response = create_app().test_client().post('/bulk', data=data, headers=headers)
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+def test_collect_bulk_gzip(monkeypatch, written_chunks):
+    monkeypatch.setattr(collector, 'BULK_CHUNK_EVENT_COUNT', 400)
+    result = _post_bulk(gzip.compress(_make_ndjson(2_000)), content_encoding='gzip')
+    assert result['status'] == '200'
+    assert result['event_count'] == 2_000
+    assert result['error_count'] == 0
+    assert written_chunks == [400] * 5
+
+
+def test_collect_bulk_encodings(written_chunks):
+    data = _make_ndjson(10)
+    assert _post_bulk(zlib.compress(data), content_encoding='deflate')['event_count'] == 10
+    # empty lines are ignored
+    assert _post_bulk(data + b'\n\n')['event_count'] == 10
+    assert written_chunks == [10, 10]
+
+
+def test_collect_bulk_gzip_members(written_chunks):
+    # A gzip body can consist of multiple members, e.g. gzip files that were concatenated
+    data = _make_ndjson(3)
+    lines = data.split(b'\n')
+    body = gzip.compress(lines[0] + b'\n' + lines[1] + b'\n') + gzip.compress(lines[2])
+    assert _post_bulk(body, content_encoding='gzip')['event_count'] == 3
+    assert written_chunks == [3]
+
+    # data after the end of a gzip member must be another member
+    result = _post_bulk(gzip.compress(data) + b'garbage', content_encoding='gzip')
+    assert result['event_count'] == 0
+    assert result['error_count'] == 1
+    # deflate data has a single stream
+    result = _post_bulk(zlib.compress(data) + zlib.compress(data), content_encoding='deflate')
+    assert result['event_count'] == 0
+    assert result['error_count'] == 1
+
+
+def test_collect_bulk_invalid_data(monkeypatch, written_chunks):
+    monkeypatch.setattr(collector, 'BULK_CHUNK_EVENT_COUNT', 10)
+    data = _make_ndjson(25) + b'\n{"not": "an event"}\n' + _make_ndjson(5)
+    result = _post_bulk(gzip.compress(data), content_encoding='gzip')
+    # The first two chunks are stored, the chunk with the invalid event is not
+    assert result['event_count'] == 20
+    assert result['error_count'] == 1
+    assert written_chunks == [10, 10]
+
+    result = _post_bulk(_make_ndjson(5) + b'\n{not json')
+    assert result['event_count'] == 0
+    assert result['error_count'] == 1
+
+    result = _post_bulk(gzip.compress(_make_ndjson(5))[:-10], content_encoding='gzip')
+    assert result['event_count'] == 0
+    assert result['error_count'] == 1
+
+    result = _post_bulk(_make_ndjson(5), content_encoding='br')
+    assert result['event_count'] == 0
+    assert result['error_count'] == 1
+
+
+def test_collect_bulk_line_size_limit(written_chunks):
+    # A single line is limited to the size of a regular request, also if it's highly compressible
+    data = b'{"padding": "' + b' ' * collector.DATA_MAX_SIZE_BYTES + b'"}'
+    result = _post_bulk(gzip.compress(data), content_encoding='gzip')
+    assert result['error_count'] == 1
+    assert written_chunks == []
+
+
+def _get_bulk_peak_memory(event_count: int) -> int:
+    """ Post event_count events to the bulk endpoint, and return the peak memory usage while doing so. """
+    data = gzip.compress(_make_ndjson(event_count))
+    client = create_app().test_client()
+    tracemalloc.start()
+    try:
+        response = client.post('/bulk', data=data, headers={'Content-Encoding': 'gzip'})
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert json.loads(response.data)['event_count'] == event_count
+    return peak
+
+
+def test_collect_bulk_bounded_memory(monkeypatch, written_chunks):
+    monkeypatch.setattr(collector, 'BULK_CHUNK_EVENT_COUNT', 200)
+    # warm up caches, e.g. of the schema validators
+    _get_bulk_peak_memory(200)
+    small_peak = _get_bulk_peak_memory(1_000)
+    large_peak = _get_bulk_peak_memory(8_000)
+    uncompressed_size = len(_make_ndjson(8_000))
+    assert written_chunks == [200] * (1 + 5 + 40)
+    # Only a single chunk is in memory at any time, so the peak memory usage doesn't grow with the number of
+    # events. Parsing all events at once would take many times the size of the uncompressed body.
+    assert large_peak < small_peak * 1.5
+    assert large_peak < uncompressed_size / 2
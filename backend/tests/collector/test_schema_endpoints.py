@@ -0,0 +1,74 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import gzip
+import json
+
+import pytest
+
+from objectiv_backend.app import create_app
+from objectiv_backend.common import config
+from objectiv_backend.common.config import get_collector_config, get_config_event_schema
+from objectiv_backend.end_points import schema
+from objectiv_backend.schema.generate_json_schema import generate_json_schema
+
+
+@pytest.mark.parametrize('path', ['/schema', '/jsonschema'])
+def test_schema_endpoint_cached(path):
+    client = create_app().test_client()
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.content_type == 'application/json'
+    assert response.headers['Cache-Control'] == f'public, max-age={config.SCHEMA_CACHE_MAX_AGE}'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    etag = response.headers['ETag']
+    assert etag.startswith('"') and not etag.startswith('W/')
+    body = response.data
+
+    # Same body and ETag on the next request
+    response = client.get(path)
+    assert response.data == body
+    assert response.headers['ETag'] == etag
+
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    response = client.get(path, headers={'If-None-Match': '"other", ' + etag})
+    assert response.status_code == 304
+    response = client.get(path, headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+    # gzip-compressed body, with its own ETag
+    response = client.get(path, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] != etag
+    assert gzip.decompress(response.data) == body
+    response = client.get(path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    response = client.get(path, headers={'Accept-Encoding': 'gzip;q=0', 'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_schema_endpoint_content():
+    client = create_app().test_client()
+    event_schema = get_collector_config().event_schema
+    assert client.get('/schema').json == json.loads(str(event_schema))
+    assert client.get('/jsonschema').json == generate_json_schema(event_schema)
+
+
+def test_schema_endpoint_config_change(monkeypatch):
+    client = create_app().test_client()
+    etag = client.get('/schema').headers['ETag']
+
+    # The responses are recomputed if the event schema changes
+    event_schema = get_config_event_schema()
+    event_schema.version['base_schema'] = 'changed'
+    monkeypatch.setattr(config, '_CACHED_COLLECTOR_CONFIG',
+                        get_collector_config()._replace(event_schema=event_schema))
+    response = client.get('/schema', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['version']['base_schema'] == 'changed'
+    assert response.headers['ETag'] != etag
+    assert schema.init_schema_responses()['schema'].identity.body == response.data
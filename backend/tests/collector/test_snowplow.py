@@ -1,9 +1,21 @@
 import json
+import uuid
+from concurrent.futures import Future
+
+import boto3
 import jsonschema
 import base64
+import pytest
+from botocore.stub import ANY, Stubber
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from objectiv_backend.snowplow import snowplow_helper
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload
 from objectiv_backend.snowplow.snowplow_helper import make_snowplow_custom_context, \
-    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, snowplow_schema_violation_json
+    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, payload_to_thrift, \
+    prepare_events_for_snowplow_pipeline, snowplow_schema_violation_json, write_data_to_aws_pipeline, \
+    write_data_to_gcp_pubsub
 from tests.schema.test_schema import CLICK_EVENT_JSON, make_event_from_dict
 from objectiv_backend.common.config import SnowplowConfig
 from objectiv_backend.schema.validate_events import EventError, ErrorInfo
@@ -31,6 +43,26 @@ event_list = json.loads(CLICK_EVENT_JSON)
 event = make_event_from_dict(event_list['events'][0])
 
 
+def _make_events(count):
+    return [{**event, 'id': str(uuid.uuid4())} for _ in range(count)]
+
+
+@pytest.fixture
+def aws_stubs(monkeypatch):
+    """ Put stubbed kinesis and sqs clients in the client cache, and return their Stubbers. """
+    monkeypatch.setattr(snowplow_helper, 'RETRY_DELAY_SECONDS', 0)
+    stubbers = {}
+    for service_name in ('kinesis', 'sqs'):
+        client = boto3.client(service_name, region_name='eu-west-1',
+                              aws_access_key_id='test', aws_secret_access_key='test')
+        monkeypatch.setitem(snowplow_helper._clients, service_name, client)
+        stubbers[service_name] = Stubber(client)
+    yield stubbers
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
 def test_objectiv_event_to_snowplow():
 
     sp_event = objectiv_event_to_snowplow(event=event, config=config)
@@ -99,3 +131,158 @@ def test_snowplow_failed_event():
         instance = violation['data']
 
         jsonschema.validate(instance=instance, schema=schema,)
+
+
+def test_payload_to_thrift():
+    # Must give the same bytes as the generated thrift code
+    def write_with_thrift(payload: CollectorPayload) -> bytes:
+        transport = TTransport.TMemoryBuffer()
+        payload.write(TBinaryProtocol.TBinaryProtocol(trans=transport))
+        return transport.getvalue()
+
+    payload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    assert payload_to_thrift(payload) == write_with_thrift(payload)
+
+    payload = CollectorPayload(schema='schema', timestamp=-1, body='{"ü": "€"}', headers=['a: b', 'c: é'])
+    assert payload_to_thrift(payload) == write_with_thrift(payload)
+
+
+def test_prepare_events_for_snowplow_pipeline():
+    events = _make_events(3)
+    good = prepare_events_for_snowplow_pipeline(events=events, good=True, config=config)
+    assert len(good) == 3
+    decoded = []
+    for data in good:
+        payload = CollectorPayload()
+        payload.read(TBinaryProtocol.TBinaryProtocol(trans=TTransport.TMemoryBuffer(data)))
+        decoded.append(payload)
+    # all events of a batch get the same timestamp
+    timestamp = decoded[0].timestamp
+    payloads = [objectiv_event_to_snowplow_payload(event=event, config=config, timestamp=timestamp)
+                for event in events]
+    assert decoded == payloads
+
+    event_errors = [EventError(event_id=events[1]['id'], error_info=[ErrorInfo(data=[], info='test')])]
+    bad = prepare_events_for_snowplow_pipeline(events=events, good=False, config=config, event_errors=event_errors)
+    violations = [json.loads(data) for data in bad]
+    assert [len(violation['data']['failure']['messages'][0]['error']['dataReports'])
+            for violation in violations] == [0, 1, 0]
+    # same as generating the violation from the payload
+    expected = snowplow_schema_violation_json(payload=payloads[1], config=config, event_error=event_errors[0])
+    assert violations[1]['data']['payload']['raw']['parameters'] == expected['data']['payload']['raw']['parameters']
+    assert violations[1]['data']['payload']['enrich'] == expected['data']['payload']['enrich']
+
+
+def test_write_data_to_kinesis(aws_stubs):
+    aws_config = config._replace(aws_message_topic_raw='raw-stream', aws_message_raw_type='kinesis')
+    events = _make_events(1200)
+    stubber = aws_stubs['kinesis']
+    ok = {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'}
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Rate exceeded'}
+    # Three batches, of which the last has two throttled records, that are retried.
+    for count in 500, 500:
+        stubber.add_response('put_records', {'Records': [ok] * count},
+                             {'StreamName': 'raw-stream', 'Records': ANY})
+    stubber.add_response('put_records', {'FailedRecordCount': 2, 'Records': [ok] * 197 + [throttled] * 2 + [ok]},
+                         {'StreamName': 'raw-stream', 'Records': ANY})
+    stubber.add_response('put_records', {'Records': [ok] * 2}, {'StreamName': 'raw-stream', 'Records': ANY})
+    calls = []
+    stubber.client.meta.events.register(
+        'provide-client-params.kinesis.PutRecords', lambda params, **kwargs: calls.append(params['Records']))
+
+    with stubber:
+        write_data_to_aws_pipeline(events=events, config=aws_config, good=True)
+
+    assert [len(records) for records in calls] == [500, 500, 200, 2]
+    assert [record['PartitionKey'] for record in calls[3]] == [e['id'] for e in events[1197:1199]]
+
+
+def test_write_data_to_kinesis_throttled(aws_stubs):
+    aws_config = config._replace(aws_message_topic_bad='bad-stream')
+    stubber = aws_stubs['kinesis']
+    # The whole call is throttled every time: we give up after MAX_RETRIES retries
+    for _ in range(snowplow_helper.MAX_RETRIES + 1):
+        stubber.add_client_error('put_records', service_error_code='ProvisionedThroughputExceededException')
+
+    with stubber:
+        write_data_to_aws_pipeline(events=_make_events(3), config=aws_config, good=False)
+
+
+def test_write_data_to_sqs(aws_stubs):
+    queue_url = 'https://sqs.eu-west-1.amazonaws.com/123456789012/raw'
+    aws_config = config._replace(aws_message_topic_raw=queue_url, aws_message_raw_type='sqs')
+    events = _make_events(25)
+    stubber = aws_stubs['sqs']
+    stubber.add_response('send_message_batch', {
+        'Successful': [],
+        'Failed': [
+            {'Id': '3', 'SenderFault': False, 'Code': 'InternalError'},
+            {'Id': '4', 'SenderFault': True, 'Code': 'InvalidMessageContents'},
+        ]
+    }, {'QueueUrl': queue_url, 'Entries': ANY})
+    for _ in range(3):
+        stubber.add_response('send_message_batch', {'Successful': [], 'Failed': []},
+                             {'QueueUrl': queue_url, 'Entries': ANY})
+    calls = []
+    stubber.client.meta.events.register(
+        'provide-client-params.sqs.SendMessageBatch', lambda params, **kwargs: calls.append(params['Entries']))
+
+    with stubber:
+        write_data_to_aws_pipeline(events=events, config=aws_config, good=True)
+
+    assert [len(entries) for entries in calls] == [10, 1, 10, 5]
+    assert calls[1][0]['MessageAttributes']['kinesisKey']['StringValue'] == events[3]['id']
+    assert calls[1][0]['Id'] == '0'
+
+
+class FakeFuture(Future):
+    def __init__(self, publisher, exception=None):
+        super().__init__()
+        self.publisher = publisher
+        if exception:
+            self.set_exception(exception)
+        else:
+            self.set_result('message-id')
+
+    def result(self, timeout=None):
+        self.publisher.pending -= 1
+        return super().result(timeout)
+
+
+class FakePublisher:
+    """ Stub of a PubSub PublisherClient, that keeps track of the number of futures that are not waited on. """
+    def __init__(self):
+        self.published = []
+        self.pending = 0
+        self.max_pending = 0
+
+    def publish(self, topic, data):
+        self.published.append((topic, data))
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        exception = Exception('topic not found') if len(self.published) == 2 else None
+        return FakeFuture(self, exception)
+
+
+def test_write_data_to_gcp_pubsub(monkeypatch):
+    gcp_config = config._replace(gcp_project='project', gcp_pubsub_topic_raw='raw')
+    publisher = FakePublisher()
+    monkeypatch.setitem(snowplow_helper._clients, 'pubsub', publisher)
+    monkeypatch.setattr(snowplow_helper, 'PUBSUB_MAX_IN_FLIGHT', 10)
+
+    write_data_to_gcp_pubsub(events=_make_events(25), config=gcp_config, good=True)
+
+    assert len(publisher.published) == 25
+    assert {topic for topic, _ in publisher.published} == {'projects/project/topics/raw'}
+    assert publisher.max_pending == 10
+    assert publisher.pending == 0
+
+
+def test_clients_per_process(monkeypatch):
+    monkeypatch.setattr(snowplow_helper, '_clients', {})
+    monkeypatch.setattr(snowplow_helper.boto3, 'client', lambda service_name: object())
+    client = snowplow_helper._get_aws_client('sqs')
+    assert snowplow_helper._get_aws_client('sqs') is client
+    # a forked process creates its own client
+    monkeypatch.setattr(snowplow_helper, '_clients_pid', -1)
+    assert snowplow_helper._get_aws_client('sqs') is not client
@@ -0,0 +1,121 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import threading
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from objectiv_backend.common import db
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.db import ConnectionPool
+
+
+class FakeConnection:
+    """ Minimal stand-in for a psycopg2 connection """
+    def __init__(self):
+        self.closed = 0
+        self.transaction_status = TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+PG_CONFIG = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                           password='', pool_min_size=1, pool_max_size=2)
+
+
+def _get_pool(monkeypatch) -> ConnectionPool:
+    monkeypatch.setattr(db, 'get_db_connection', lambda pg_config: FakeConnection())
+    return ConnectionPool(PG_CONFIG)
+
+
+def test_pool_reuses_connections(monkeypatch):
+    pool = _get_pool(monkeypatch)
+    with pool.connection() as connection1:
+        pass
+    with pool.connection() as connection2:
+        pass
+    assert connection1 is connection2
+    stats = pool.get_stats()
+    assert stats.checkouts == 2
+    assert stats.connects == 1
+    assert stats.size == 1
+    assert stats.in_use == 0
+
+
+def test_pool_rolls_back_open_transaction(monkeypatch):
+    pool = _get_pool(monkeypatch)
+    with pool.connection() as connection:
+        connection.transaction_status = TRANSACTION_STATUS_INTRANS
+    assert connection.rollbacks == 1
+    with pool.connection() as connection2:
+        assert connection2 is connection
+
+
+def test_pool_replaces_lost_connection(monkeypatch):
+    pool = _get_pool(monkeypatch)
+    with pool.connection() as connection:
+        # psycopg2 sets `closed` to 2 if the connection to the server is lost
+        connection.closed = 2
+    with pool.connection() as connection2:
+        assert connection2 is not connection
+    stats = pool.get_stats()
+    assert stats.connects == 2
+    assert stats.discards == 1
+    assert stats.size == 1
+
+
+def test_pool_max_size_blocks(monkeypatch):
+    pool = _get_pool(monkeypatch)
+    connection1 = pool.checkout()
+    connection2 = pool.checkout()
+    assert pool.get_stats().in_use == 2
+
+    checked_out = []
+    thread = threading.Thread(target=lambda: checked_out.append(pool.checkout()))
+    thread.start()
+    thread.join(timeout=0.1)
+    # the pool is exhausted, so the thread is still waiting
+    assert checked_out == []
+
+    pool.checkin(connection1)
+    thread.join(timeout=5)
+    assert checked_out == [connection1]
+    pool.checkin(connection2)
+    pool.checkin(connection1)
+    stats = pool.get_stats()
+    assert stats.checkouts == 3
+    assert stats.size == 2
+    assert stats.wait_seconds > 0
+
+
+class FakeCopyCursor:
+    """ Minimal stand-in for a psycopg2 cursor, that remembers what was copied """
+    def __init__(self):
+        self.statement = None
+        self.data = None
+
+    def copy_expert(self, sql, file):
+        self.statement = sql
+        self.data = file.read()
+
+
+def test_copy_rows():
+    cursor = FakeCopyCursor()
+    rows = [
+        ('a', 1, None),
+        ('tab\there', 'new\nline', '{"quote": "\\"back\\\\slash\\""}'),
+    ]
+    db.copy_rows(cursor, 'test_table', ('x', 'y', 'z'), rows)
+    assert cursor.statement == 'copy test_table(x, y, z) from stdin'
+    assert cursor.data == \
+        'a\t1\t\\N\n' \
+        'tab\\there\tnew\\nline\t{"quote": "\\\\"back\\\\\\\\slash\\\\""}\n'
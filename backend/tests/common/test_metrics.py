@@ -0,0 +1,93 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import urllib.request
+
+import pytest
+
+from objectiv_backend.app import create_app
+from objectiv_backend.common.metrics import Counter, Gauge, Histogram, REGISTRY, generate_metrics, \
+    start_metrics_server, METRICS_CONTENT_TYPE
+
+
+@pytest.fixture
+def registry():
+    """ Remove the metrics that are created by a test from the registry afterwards. """
+    length = len(REGISTRY)
+    yield REGISTRY
+    del REGISTRY[length:]
+
+
+def test_counter(registry):
+    counter = Counter('test_events_total', 'Number of events.', ['result'])
+    counter.inc(labels=('ok',))
+    counter.inc(5, labels=('ok',))
+    counter.inc(2, labels=('nok',))
+    assert counter.get(('ok',)) == 6
+    assert counter.render() == '\n'.join([
+        '# HELP test_events_total Number of events.',
+        '# TYPE test_events_total counter',
+        'test_events_total{result="nok"} 2',
+        'test_events_total{result="ok"} 6',
+    ])
+    with pytest.raises(ValueError):
+        counter.inc(labels=('ok', 'extra'))
+
+
+def test_gauge(registry):
+    gauge = Gauge('test_depth', 'Depth with "quotes".', ['queue'])
+    gauge.set(10, labels=('a"b',))
+    gauge.set(3, labels=('a"b',))
+    assert gauge.render().split('\n')[-1] == 'test_depth{queue="a\\"b"} 3'
+
+
+def test_histogram(registry):
+    histogram = Histogram('test_size', 'Size.', buckets=(10, 100))
+    for value in (5, 10, 50, 1000):
+        histogram.observe(value)
+    assert histogram.get_count() == 4
+    assert histogram.render().split('\n')[2:] == [
+        'test_size_bucket{le="10"} 2',
+        'test_size_bucket{le="100"} 3',
+        'test_size_bucket{le="+Inf"} 4',
+        'test_size_sum 1065',
+        'test_size_count 4',
+    ]
+
+    timer = Histogram('test_seconds', 'Time.', ['stage'])
+    with timer.time(labels=('parse',)):
+        pass
+    assert timer.get_count(('parse',)) == 1
+    assert timer.get_count(('other',)) == 0
+
+
+def test_generate_metrics(registry):
+    Counter('test_generate_total', 'Test.').inc()
+    text = generate_metrics()
+    assert text.endswith('\ntest_generate_total 1\n')
+    assert '# TYPE objectiv_stage_seconds histogram' in text
+
+
+def test_metrics_endpoint(monkeypatch):
+    assert create_app().test_client().get('/metrics').status_code == 404
+
+    monkeypatch.setattr('objectiv_backend.app.COLLECTOR_METRICS_ENDPOINT', True)
+    client = create_app().test_client()
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type == METRICS_CONTENT_TYPE
+    assert b'# TYPE objectiv_events_total counter' in response.data
+
+
+def test_metrics_server(registry):
+    scrapes = []
+    server = start_metrics_server(0, on_scrape=lambda: scrapes.append(1), host='127.0.0.1')
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url, timeout=10) as response:
+            assert response.headers['Content-Type'] == METRICS_CONTENT_TYPE
+            assert b'# TYPE objectiv_queue_depth gauge' in response.read()
+        assert scrapes == [1]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,103 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+from objectiv_backend.common.rolling_file import RollingFileWriter
+from objectiv_backend.common.serialization import serialize_events
+
+
+def _get_events(count: int, start: int = 0):
+    events = [{'_type': 'PressEvent', 'id': f'event-{i}', 'time': 1_650_000_000_000 + i}
+              for i in range(start, start + count)]
+    return events, serialize_events(events)
+
+
+def _list_files(directory: str):
+    return sorted(os.listdir(directory))
+
+
+def test_rolling_file_rotate_on_size(tmp_path):
+    directory = str(tmp_path / 'OK')
+    writer = RollingFileWriter(directory=directory, compression='gzip', max_bytes=1, fsync='always')
+    for i in range(3):
+        writer.write(*_get_events(10, start=i * 10))
+    # every write fills a segment
+    filenames = _list_files(directory)
+    assert len(filenames) == 3
+    assert all(filename.endswith('.ndjson.gz') for filename in filenames)
+    lines = []
+    for filename in filenames:
+        with gzip.open(os.path.join(directory, filename), 'rt') as file:
+            lines.extend(file.read().splitlines())
+    assert sorted(json.loads(line)['id'] for line in lines) == sorted(f'event-{i}' for i in range(30))
+
+
+def test_rolling_file_in_progress(tmp_path):
+    directory = str(tmp_path)
+    writer = RollingFileWriter(directory=directory, compression='none', max_seconds=60)
+    writer.write(*_get_events(5))
+    writer.write(*_get_events(5, start=5))
+    # The segment isn't complete yet, so it's only there as a hidden file
+    filenames = _list_files(directory)
+    assert len(filenames) == 1
+    assert filenames[0].startswith('.') and filenames[0].endswith('.ndjson.inprogress')
+
+    # Not old enough yet
+    writer.rotate_if_due()
+    assert _list_files(directory) == filenames
+
+    writer.max_seconds = 0
+    time.sleep(0.01)
+    writer.rotate_if_due()
+    filenames = _list_files(directory)
+    assert len(filenames) == 1
+    assert filenames[0].endswith('.ndjson') and not filenames[0].startswith('.')
+    with open(os.path.join(directory, filenames[0])) as file:
+        assert [json.loads(line)['id'] for line in file] == [f'event-{i}' for i in range(10)]
+
+    # Nothing to complete
+    writer.rotate()
+    assert _list_files(directory) == filenames
+
+
+def test_rolling_file_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    writer = RollingFileWriter(directory=str(tmp_path), compression='zstd')
+    writer.write(*_get_events(5))
+    writer.rotate()
+    filenames = _list_files(str(tmp_path))
+    assert len(filenames) == 1 and filenames[0].endswith('.ndjson.zst')
+    with open(os.path.join(str(tmp_path), filenames[0]), 'rb') as file:
+        data = zstandard.ZstdDecompressor().stream_reader(file).read()
+    assert len(data.splitlines()) == 5
+
+
+def test_rolling_file_parquet(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet', exc_type=ImportError)
+    writer = RollingFileWriter(directory=str(tmp_path), file_format='parquet', compression='zstd')
+    writer.write(*_get_events(5))
+    writer.write(*_get_events(5, start=5))
+    writer.rotate()
+    filenames = _list_files(str(tmp_path))
+    assert len(filenames) == 1 and filenames[0].endswith('.parquet')
+    table = parquet.read_table(os.path.join(str(tmp_path), filenames[0]))
+    assert table.column_names == ['event_id', 'moment', 'value']
+    rows = table.to_pylist()
+    assert [row['event_id'] for row in rows] == [f'event-{i}' for i in range(10)]
+    assert json.loads(rows[3]['value'])['id'] == 'event-3'
+    assert int(rows[0]['moment'].timestamp() * 1000) == 1_650_000_000_000
+
+
+def test_rolling_file_invalid_settings(tmp_path):
+    with pytest.raises(ValueError):
+        RollingFileWriter(directory=str(tmp_path), file_format='csv')
+    with pytest.raises(ValueError):
+        RollingFileWriter(directory=str(tmp_path), compression='bz2')
+    with pytest.raises(ValueError):
+        RollingFileWriter(directory=str(tmp_path), fsync='sometimes')
@@ -0,0 +1,167 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import gzip
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+
+from objectiv_backend.common import s3_writer
+from objectiv_backend.common.metrics import SINK_ERRORS
+from objectiv_backend.common.s3_writer import BufferedS3Writer
+from objectiv_backend.common.serialization import serialize_events
+
+MOMENT = datetime(2022, 4, 15, 13, 30)
+
+
+class FakeS3Client:
+    """ Local stand-in for the S3 client, that keeps the completed objects in memory. """
+
+    def __init__(self, fail_upload_part: bool = False):
+        self.objects: Dict[str, bytes] = {}
+        self.uploads: Dict[str, List[bytes]] = {}
+        self.aborted: List[str] = []
+        self.completed_part_counts: List[int] = []
+        self.fail_upload_part = fail_upload_part
+        self.upload_threads = set()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        upload_id = f'upload-{len(self.uploads)}'
+        self.uploads[upload_id] = []
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> Dict[str, Any]:
+        self.upload_threads.add(threading.current_thread().name)
+        if self.fail_upload_part:
+            raise ConnectionError('connection lost')
+        assert PartNumber == len(self.uploads[UploadId]) + 1
+        self.uploads[UploadId].append(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: Dict[str, Any]):
+        parts = self.uploads.pop(UploadId)
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == list(range(1, len(parts) + 1))
+        self.objects[Key] = b''.join(parts)
+        self.completed_part_counts.append(len(parts))
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self.aborted.append(UploadId)
+        del self.uploads[UploadId]
+
+    def get_event_ids(self, key: str) -> List[str]:
+        lines = gzip.decompress(self.objects[key]).decode('utf-8').splitlines()
+        return [line.split('"id":"')[1].split('"')[0] for line in lines]
+
+
+def _get_events(count: int, start: int = 0):
+    events = [{'_type': 'PressEvent', 'id': f'event-{i}', 'time': 1_650_000_000_000 + i}
+              for i in range(start, start + count)]
+    return events, serialize_events(events)
+
+
+def test_s3_writer_single_object():
+    client = FakeS3Client()
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1_000_000,
+                              max_seconds=60)
+    for i in range(5):
+        writer.write(*_get_events(10, start=i * 10), prefix='OK', moment=MOMENT)
+    # Nothing is uploaded until the object is complete
+    assert client.objects == {}
+    writer.complete_due()
+    assert client.objects == {}
+
+    writer.complete_all()
+    assert len(client.objects) == 1
+    key = list(client.objects.keys())[0]
+    assert key.startswith('objectiv/2022/04/15/13/OK/') and key.endswith('.ndjson.gz')
+    assert client.get_event_ids(key) == [f'event-{i}' for i in range(50)]
+    assert client.uploads == {}
+
+
+def test_s3_writer_partitions():
+    client = FakeS3Client()
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1_000_000,
+                              max_seconds=0)
+    writer.write(*_get_events(2), prefix='OK', moment=MOMENT)
+    writer.write(*_get_events(2, start=2), prefix='NOK', moment=MOMENT)
+    writer.write(*_get_events(2, start=4), prefix='OK', moment=datetime(2022, 4, 15, 14, 1))
+    writer.complete_due()
+    assert sorted(key.rsplit('/', 1)[0] for key in client.objects.keys()) == \
+           ['objectiv/2022/04/15/13/NOK', 'objectiv/2022/04/15/13/OK', 'objectiv/2022/04/15/14/OK']
+
+
+def test_s3_writer_multipart(monkeypatch):
+    # Upload a part as soon as the compressor gives any output
+    monkeypatch.setattr(s3_writer, 'S3_PART_SIZE_BYTES', 1)
+    client = FakeS3Client()
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1_000_000,
+                              max_seconds=60)
+    for i in range(5):
+        writer.write(*_get_events(10, start=i * 10), prefix='RAW', moment=MOMENT)
+    writer.complete_all()
+    assert client.completed_part_counts[0] >= 2
+    # The parts are uploaded by the background thread, not by the thread that writes the events
+    assert client.upload_threads == {'s3-upload'}
+    assert client.uploads == {}
+    assert client.get_event_ids(list(client.objects.keys())[0]) == [f'event-{i}' for i in range(50)]
+
+
+def test_s3_writer_max_bytes():
+    client = FakeS3Client()
+    # Each write makes the object big enough to be completed
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1, max_seconds=60)
+    for i in range(5):
+        writer.write(*_get_events(10, start=i * 10), prefix='RAW', moment=MOMENT)
+    writer.complete_all()
+    assert len(client.objects) == 5
+    event_ids = [event_id for key in client.objects.keys() for event_id in client.get_event_ids(key)]
+    assert sorted(event_ids) == sorted(f'event-{i}' for i in range(50))
+
+
+def test_s3_writer_upload_error(monkeypatch):
+    monkeypatch.setattr(s3_writer, 'S3_PART_SIZE_BYTES', 1)
+    client = FakeS3Client(fail_upload_part=True)
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1_000_000,
+                              max_seconds=60)
+    errors = SINK_ERRORS.get(('s3',))
+    writer.write(*_get_events(10), prefix='OK', moment=MOMENT)
+    writer.complete_all()
+    assert SINK_ERRORS.get(('s3',)) == errors + 1
+    assert client.aborted == ['upload-0']
+
+    # The writer continues with a new object
+    client.fail_upload_part = False
+    writer.write(*_get_events(10, start=10), prefix='OK', moment=MOMENT)
+    writer.complete_all()
+    assert len(client.objects) == 1
+    assert client.get_event_ids(list(client.objects.keys())[0]) == [f'event-{i}' for i in range(10, 20)]
+
+
+def test_s3_writer_boto3_requests(monkeypatch):
+    """ Check the requests against the S3 api definition of botocore. """
+    monkeypatch.setattr(s3_writer, 'S3_PART_SIZE_BYTES', 1)
+    client = boto3.client('s3', region_name='eu-west-1', aws_access_key_id='key', aws_secret_access_key='secret')
+    writer = BufferedS3Writer(client=client, bucket='bucket', key_prefix='objectiv', max_bytes=1_000_000,
+                              max_seconds=60)
+    with Stubber(client) as stubber:
+        stubber.add_response('create_multipart_upload', {'UploadId': 'upload-1'},
+                             {'Bucket': 'bucket', 'Key': ANY, 'ContentType': 'application/x-ndjson',
+                              'ContentEncoding': 'gzip'})
+        for part_number in (1, 2):
+            stubber.add_response('upload_part', {'ETag': f'etag-{part_number}'},
+                                 {'Bucket': 'bucket', 'Key': ANY, 'UploadId': 'upload-1',
+                                  'PartNumber': part_number, 'Body': ANY})
+        stubber.add_response('complete_multipart_upload', {},
+                             {'Bucket': 'bucket', 'Key': ANY, 'UploadId': 'upload-1',
+                              'MultipartUpload': {'Parts': [{'ETag': 'etag-1', 'PartNumber': 1},
+                                                            {'ETag': 'etag-2', 'PartNumber': 2}]}})
+        writer.write(*_get_events(10), prefix='OK', moment=MOMENT)
+        writer.complete_all()
+        stubber.assert_no_pending_responses()
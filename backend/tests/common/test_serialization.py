@@ -0,0 +1,55 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import json
+
+import pytest
+
+from objectiv_backend.common import serialization
+from objectiv_backend.common.serialization import json_dumps, json_loads, serialize_events
+from objectiv_backend.end_points.extra_output import events_to_json
+from objectiv_backend.schema.schema import CookieIdContext
+
+EVENTS = [
+    {
+        '_type': 'ClickEvent',
+        'id': 'a',
+        'time': 1640995200000,
+        'global_contexts': [CookieIdContext(id='c', cookie_id='c')],
+        'location_stack': [{'_type': 'RootLocationContext', 'id': 'ünicode'}]
+    },
+    {'_type': 'ClickEvent', 'id': 'b', 'big_number': 2 ** 70, 'float': 0.1}
+]
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def serializer(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(serialization, '_orjson', None)
+    elif serialization._orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
+def test_json_dumps(serializer):
+    for event in EVENTS:
+        result = json_dumps(event)
+        assert json.loads(result) == event
+        assert ' ' not in result.replace('ünicode', '')
+
+
+def test_json_loads(serializer):
+    for event in EVENTS:
+        assert json_loads(json.dumps(event)) == event
+        assert json_loads(json.dumps(event).encode('utf-8')) == event
+    # not valid json according to the standard, but accepted by the standard library
+    assert json_loads('{"x": NaN}')['x'] != 0
+    with pytest.raises(ValueError):
+        json_loads('{"x": ')
+
+
+def test_events_to_json(serializer):
+    event_jsons = serialize_events(EVENTS)
+    assert json.loads(events_to_json(EVENTS)) == EVENTS
+    assert events_to_json(EVENTS, event_jsons=event_jsons) == events_to_json(EVENTS)
+    assert events_to_json([]) == '[]'
@@ -0,0 +1,103 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import threading
+import time
+from typing import List
+
+from objectiv_backend.common.write_buffer import WriteBuffer, get_write_buffer
+
+
+def _write_concurrently(write_buffer: WriteBuffer, batches: List[List[int]]) -> List[BaseException]:
+    """ Write each batch from its own thread, return the exceptions raised by write(). """
+    errors: List[BaseException] = []
+
+    def write(batch):
+        try:
+            write_buffer.write(batch)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=write, args=(batch,)) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return errors
+
+
+def test_write_buffer_coalesces_writes():
+    flushed: List[List[List[int]]] = []
+    write_buffer = WriteBuffer(flush=flushed.append, max_delay_seconds=0.2, max_size=1000, get_size=len)
+
+    batches = [[i, i] for i in range(100)]
+    errors = _write_concurrently(write_buffer, batches)
+
+    assert errors == []
+    # all writes returned, so all batches are flushed, each exactly once, in much fewer flushes
+    assert sorted(batch for flush in flushed for batch in flush) == batches
+    assert write_buffer.flushes == len(flushed)
+    assert len(flushed) < 10
+
+
+def test_write_buffer_max_size():
+    flushed: List[List[List[int]]] = []
+    # With a long delay, only reaching max_size triggers a flush
+    write_buffer = WriteBuffer(flush=flushed.append, max_delay_seconds=60, max_size=10, get_size=len)
+    start = time.monotonic()
+    errors = _write_concurrently(write_buffer, [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]])
+    assert errors == []
+    assert time.monotonic() - start < 10
+    assert sorted(sorted(flush) for flush in flushed) == [[[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]]
+
+
+def test_write_buffer_waits_for_flush():
+    flush_started = threading.Event()
+    finish_flush = threading.Event()
+
+    def flush(batches):
+        flush_started.set()
+        finish_flush.wait(timeout=10)
+
+    write_buffer = WriteBuffer(flush=flush, max_delay_seconds=0, max_size=1, get_size=len)
+    writer = threading.Thread(target=write_buffer.write, args=([1],))
+    writer.start()
+    assert flush_started.wait(timeout=10)
+    # write() doesn't return before the flush is done
+    writer.join(timeout=0.1)
+    assert writer.is_alive()
+    finish_flush.set()
+    writer.join(timeout=10)
+    assert not writer.is_alive()
+
+
+def test_write_buffer_flush_error():
+    calls = []
+
+    def flush(batches):
+        calls.append(batches)
+        if len(calls) == 1:
+            raise ValueError('flush failed')
+
+    write_buffer = WriteBuffer(flush=flush, max_delay_seconds=1, max_size=3, get_size=len)
+    errors = _write_concurrently(write_buffer, [[1], [2], [3]])
+    # All writers of the failed flush get the error
+    assert len(errors) == 3
+    assert all(isinstance(error, ValueError) for error in errors)
+
+    # The buffer keeps working after a failed flush
+    write_buffer.write([4])
+    assert calls[-1] == [[4]]
+
+
+def test_get_write_buffer():
+    created = []
+
+    def create():
+        write_buffer = WriteBuffer(flush=lambda batches: None, max_delay_seconds=0, max_size=1, get_size=len)
+        created.append(write_buffer)
+        return write_buffer
+
+    write_buffer = get_write_buffer('test_get_write_buffer', create)
+    assert get_write_buffer('test_get_write_buffer', create) is write_buffer
+    assert created == [write_buffer]
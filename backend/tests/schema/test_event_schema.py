@@ -170,6 +170,30 @@ def test_all_parent_context_types():
            {'BaseContext', 'OtherContext', 'ExtraContext'}
 
 
+def test_precompiled_types():
+    schema = _get_schema()
+    assert schema.get_sorted_parent_event_types('GrandChildEvent') == \
+           ('BaseEvent', 'Child2Event', 'ChildEvent', 'GrandChildEvent')
+    assert schema.get_sorted_parent_context_types('ExtraContext') == ('BaseContext', 'ExtraContext', 'OtherContext')
+    assert schema.get_sorted_parent_context_types('X') == ('X',)
+    assert schema.get_parent_context_types('X') == frozenset({'X'})
+    assert schema.get_required_contexts_for_event('GrandChildEvent') == frozenset({'BaseContext', 'OtherContext'})
+    with pytest.raises(ValueError):
+        schema.get_sorted_parent_event_types('NonExistingEvent')
+    with pytest.raises(ValueError):
+        schema.get_required_contexts_for_event('NonExistingEvent')
+
+    # The lookups return the precompiled objects, without copying
+    assert schema.get_sorted_parent_event_types('ChildEvent') is schema.get_sorted_parent_event_types('ChildEvent')
+    assert schema.get_parent_context_types('OtherContext') is schema.get_parent_context_types('OtherContext')
+    assert schema.get_required_contexts_for_context('AnotherContext') is \
+           schema.get_required_contexts_for_context('AnotherContext')
+    # While the set-returning functions give a copy, that callers can modify
+    parents = schema.get_all_parent_context_types('OtherContext')
+    parents.add('Y')
+    assert schema.get_all_parent_context_types('OtherContext') == {'BaseContext', 'OtherContext'}
+
+
 def test_all_child_context_types():
     schema = _get_schema()
     assert schema.get_all_child_context_types('X') == set()
@@ -231,6 +255,28 @@ def test_optional_property():
     assert other_context['required'] == ['id', 'other_property']
 
 
+def test_get_context_validator():
+    schema = _get_schema()
+    assert schema.get_context_validator('NotAContext') is None
+
+    validator = schema.get_context_validator('OtherContext')
+    assert validator.schema == schema.get_context_schema('OtherContext')
+    assert validator.is_valid({'id': 'test', 'other_property': 1, 'optional_property': None})
+    assert not validator.is_valid({'id': 'test', 'other_property': 'not a number'})
+    assert not validator.is_valid({'id': 'test'})
+    # the validator is compiled once, and reused
+    assert validator is schema.get_context_validator('OtherContext')
+
+
+def test_get_event_validator():
+    schema = _get_schema()
+    assert schema.get_event_validator('NotAnEvent') is None
+    for event_type in schema.list_event_types():
+        validator = schema.get_event_validator(event_type)
+        assert validator.schema == schema.get_event_schema(event_type)
+        assert validator is schema.get_event_validator(event_type)
+
+
 # ### Below are helper functions and test data
 def _get_schema() -> EventSchema:
 
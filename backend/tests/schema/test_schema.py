@@ -3,7 +3,9 @@ from typing import Dict, Any
 
 from objectiv_backend.schema.schema import make_event_from_dict, make_context, \
     ContentContext, HttpContext, MarketingContext
-from objectiv_backend.common.event_utils import add_global_context_to_event, get_context
+from objectiv_backend.common.event_utils import add_global_context_to_event, get_context, get_contexts, \
+    get_optional_context, ContextIndex
+from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
 from objectiv_backend.schema.validate_events import validate_structure_event_list, validate_event_adheres_to_schema
 from objectiv_backend.common.config import get_collector_config
 
@@ -82,6 +84,31 @@ def test_make_event_from_dict():
     assert(validate_event_adheres_to_schema(event_schema=event_schema, event=event) != [])
 
 
+def test_validate_structure_event_list():
+    event_list = json.loads(CLICK_EVENT_JSON)
+    assert validate_structure_event_list(event_list) == []
+    assert validate_structure_event_list(event_list, deep=False) == []
+
+    # an invalid event id is only detected by the deep check, the non-deep check leaves that to
+    # validate_event_adheres_to_schema()
+    event_list['events'][0]['id'] = 'not-a-uuid'
+    assert validate_structure_event_list(event_list) != []
+    assert validate_structure_event_list(event_list, deep=False) == []
+    event_schema = get_collector_config().event_schema
+    assert validate_event_adheres_to_schema(event_schema=event_schema, event=event_list['events'][0]) != []
+
+    # missing properties and contexts without a type are detected by both checks
+    for key in ('_type', 'time', 'global_contexts', 'location_stack'):
+        event_list = json.loads(CLICK_EVENT_JSON)
+        del event_list['events'][0][key]
+        assert validate_structure_event_list(event_list) != []
+        assert validate_structure_event_list(event_list, deep=False) != []
+    event_list = json.loads(CLICK_EVENT_JSON)
+    del event_list['events'][0]['global_contexts'][0]['_type']
+    assert validate_structure_event_list(event_list) != []
+    assert validate_structure_event_list(event_list, deep=False) != []
+
+
 def test_make_content_context():
     content_context = {
         'id': 'content_id',
@@ -122,6 +149,27 @@ def test_add_global_context():
     assert generated_context == context_vars
 
 
+def test_context_index():
+    event_schema = get_collector_config().event_schema
+    event = json.loads(CLICK_EVENT_JSON)['events'][0]
+    hydrate_types_into_event(event_schema=event_schema, event=event)
+    index = ContextIndex(event)
+
+    # Lookups by type and by parent type give the same results as scanning the contexts
+    for context_type in 'RootLocationContext', 'ApplicationContext', 'AbstractLocationContext', 'AbstractContext':
+        assert index.get_contexts(context_type) == get_contexts(event, context_type)
+        assert index.get_optional_context(context_type) is get_optional_context(event, context_type)
+    assert len(index.get_contexts('AbstractContext')) == 5
+    assert index.get_optional_context('HttpContext') is None
+    assert get_optional_context(event, 'HttpContext') is None
+
+    # Adding a context through add_global_context_to_event() updates the index
+    context = make_context(_type='HttpContext', id='http', referrer='', remote_address='', user_agent='')
+    add_global_context_to_event(event, context, index)
+    assert index.get_optional_context('HttpContext') is context
+    assert index.get_contexts('HttpContext') == get_contexts(event, 'HttpContext')
+
+
 def test_add_context_to_incorrect_scope():
     context_vars = {
         '_type': 'HttpContext',
@@ -0,0 +1,85 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import os
+import shutil
+
+import pytest
+
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
+from objectiv_backend.schema.schema_artifact import compile_event_schema_artifact, get_artifact_mismatch, \
+    load_event_schema_artifact, read_event_schema_artifact, write_event_schema_artifact
+
+SCHEMA_EXTENSIONS_DIRECTORY = 'tests/test_data/schemas1'
+
+
+@pytest.fixture
+def extensions_directory(tmp_path) -> str:
+    """ Copy of the test schema extensions, that can be modified. """
+    directory = str(tmp_path / 'extensions')
+    shutil.copytree(SCHEMA_EXTENSIONS_DIRECTORY, directory)
+    return directory
+
+
+def _assert_same_schema(loaded: EventSchema, compiled: EventSchema):
+    assert str(loaded) == str(compiled)
+    assert loaded.list_event_types() == compiled.list_event_types()
+    assert loaded.list_context_types() == compiled.list_context_types()
+    for event_type in compiled.list_event_types():
+        assert loaded.get_sorted_parent_event_types(event_type) == compiled.get_sorted_parent_event_types(event_type)
+        assert loaded.get_required_contexts_for_event(event_type) == \
+            compiled.get_required_contexts_for_event(event_type)
+        assert loaded.get_event_schema(event_type) == compiled.get_event_schema(event_type)
+        assert loaded.get_event_validator(event_type).schema == compiled.get_event_validator(event_type).schema
+    for context_type in compiled.list_context_types():
+        assert loaded.get_parent_context_types(context_type) == compiled.get_parent_context_types(context_type)
+        assert loaded.get_sorted_parent_context_types(context_type) == \
+            compiled.get_sorted_parent_context_types(context_type)
+        assert loaded.get_required_contexts_for_context(context_type) == \
+            compiled.get_required_contexts_for_context(context_type)
+        assert loaded.get_all_child_context_types(context_type) == compiled.get_all_child_context_types(context_type)
+        assert loaded.get_context_schema(context_type) == compiled.get_context_schema(context_type)
+
+
+@pytest.mark.parametrize('directory', [None, SCHEMA_EXTENSIONS_DIRECTORY])
+def test_load_event_schema_artifact(tmp_path, directory):
+    path = str(tmp_path / 'event_schema.json')
+    write_event_schema_artifact(path, compile_event_schema_artifact(directory))
+    assert os.listdir(tmp_path) == ['event_schema.json']
+
+    loaded = load_event_schema_artifact(path, directory)
+    assert loaded is not None
+    _assert_same_schema(loaded, get_event_schema(directory))
+
+    validator = loaded.get_context_validator('PathContext')
+    assert validator.is_valid({'_type': 'PathContext', 'id': 'http://example.com'})
+    assert not validator.is_valid({'_type': 'PathContext'})
+
+
+def test_load_event_schema_artifact_mismatch(tmp_path, extensions_directory, capsys):
+    path = str(tmp_path / 'event_schema.json')
+    write_event_schema_artifact(path, compile_event_schema_artifact(extensions_directory))
+    assert get_artifact_mismatch(read_event_schema_artifact(path), extensions_directory) is None
+
+    # changed extension file
+    with open(os.path.join(extensions_directory, 'extension2.json'), 'a') as file:
+        file.write('\n')
+    assert load_event_schema_artifact(path, extensions_directory) is None
+    assert "schema files changed since compilation: ['extension2.json']" in capsys.readouterr().err
+
+    # removed extension file, or compiled without extensions
+    os.remove(os.path.join(extensions_directory, 'extension2.json'))
+    assert 'current files are' in get_artifact_mismatch(read_event_schema_artifact(path), extensions_directory)
+    assert 'current files are' in get_artifact_mismatch(read_event_schema_artifact(path), None)
+
+    # other version of the package
+    artifact = compile_event_schema_artifact(extensions_directory)
+    artifact['backend_version'] = '0.0.0'
+    assert 'compiled by objectiv-backend 0.0.0' in get_artifact_mismatch(artifact, extensions_directory)
+
+    # missing or invalid artifact file
+    assert load_event_schema_artifact(str(tmp_path / 'missing.json'), None) is None
+    with open(path, 'w') as file:
+        file.write('{')
+    assert load_event_schema_artifact(path, None) is None
+    assert 'Cannot read schema artifact' in capsys.readouterr().err
@@ -0,0 +1,113 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import gzip
+import io
+import json
+from typing import Any, Dict, List
+
+import pytest
+
+from objectiv_backend.schema.stream_events import list_event_files, process_event_files
+
+
+def _make_event(index: int) -> Dict[str, Any]:
+    return {
+        '_type': 'PressEvent',
+        'id': f'00000000-0000-4000-8000-{index:012d}',
+        'time': 1630049334860 + index,
+        'location_stack': [
+            {'_type': 'RootLocationContext', 'id': 'home'},
+            {'_type': 'PressableContext', 'id': 'open-drawer'}
+        ],
+        'global_contexts': [
+            {'_type': 'ApplicationContext', 'id': 'rod-web-demo'},
+            {'_type': 'PathContext', 'id': 'http://localhost:3000/'}
+        ]
+    }
+
+
+def _write_ndjson(path, lines: List[str], compress: bool = False):
+    data = ''.join(f'{line}\n' for line in lines).encode('utf-8')
+    path.write_bytes(gzip.compress(data) if compress else data)
+
+
+@pytest.fixture
+def event_directory(tmp_path):
+    """ Directory with 25 valid events, and 3 errors in events.ndjson """
+    lines = [json.dumps(_make_event(i)) for i in range(20)]
+    lines[3] = '{"_type": "PressEvent",'
+    invalid_event = _make_event(20)
+    del invalid_event['location_stack'][1]
+    lines[7] = json.dumps(invalid_event)
+    lines[12] = json.dumps({**_make_event(21), '_type': 'UnknownEvent'})
+    _write_ndjson(tmp_path / 'events.ndjson', lines)
+
+    (tmp_path / 'more').mkdir()
+    _write_ndjson(tmp_path / 'more' / 'events.jsonl.gz', [json.dumps(_make_event(i)) for i in range(30, 35)],
+                  compress=True)
+    (tmp_path / 'more' / 'events.json').write_text(json.dumps([_make_event(i) for i in range(40, 43)]))
+    (tmp_path / 'more' / 'request.json').write_text(
+        json.dumps({'events': [_make_event(i) for i in range(50, 52)], 'transport_time': 1630049335313}))
+    # segments that are still being written are hidden
+    (tmp_path / '.events.ndjson').write_text('{')
+    return tmp_path
+
+
+def test_list_event_files(event_directory):
+    assert list_event_files([str(event_directory), str(event_directory / '.events.ndjson')]) == [
+        str(event_directory / 'events.ndjson'),
+        str(event_directory / 'more' / 'events.json'),
+        str(event_directory / 'more' / 'events.jsonl.gz'),
+        str(event_directory / 'more' / 'request.json'),
+        str(event_directory / '.events.ndjson'),
+    ]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+@pytest.mark.parametrize('hydrate', [False, True])
+def test_process_event_files(event_directory, processes, hydrate):
+    output = io.StringIO()
+    errors_output = io.StringIO()
+    progress_output = io.StringIO()
+    summary = process_event_files(paths=[str(event_directory)], hydrate=hydrate, processes=processes,
+                                  chunk_size=4, output=output, errors_output=errors_output,
+                                  progress_output=progress_output)
+
+    filename = str(event_directory / 'events.ndjson')
+    assert summary.file_count == 4
+    assert summary.event_count == 29
+    assert summary.error_count == 3
+    assert summary.files_with_errors == [filename]
+
+    errors = errors_output.getvalue().splitlines()
+    assert len(errors) == 3
+    assert errors[0].startswith(f'{filename}:4: invalid json')
+    assert errors[1].startswith(f'{filename}:8: event 00000000-0000-4000-8000-000000000020: ')
+    assert errors[2] == f'{filename}:13: event 00000000-0000-4000-8000-000000000021: Unknown event: UnknownEvent'
+    assert '29 events, 3 errors' in progress_output.getvalue()
+
+    if not hydrate:
+        assert output.getvalue() == ''
+        return
+    # The hydrated valid events, in the order of the files
+    events = [json.loads(line) for line in output.getvalue().splitlines()]
+    expected_indices = [i for i in range(20) if i not in (3, 7, 12)] + \
+        list(range(40, 43)) + list(range(30, 35)) + list(range(50, 52))
+    assert [event['id'] for event in events] == [_make_event(i)['id'] for i in expected_indices]
+    assert events[0]['_types'] == ['AbstractEvent', 'InteractiveEvent', 'PressEvent']
+    assert events[0]['location_stack'][1]['_types'] == \
+        ['AbstractContext', 'AbstractLocationContext', 'PressableContext']
+
+
+def test_process_event_files_invalid_json_file(tmp_path):
+    (tmp_path / 'events.json').write_text('{"events": 1}')
+    (tmp_path / 'other.json').write_text('[')
+    errors_output = io.StringIO()
+    summary = process_event_files(paths=[str(tmp_path)], hydrate=False, errors_output=errors_output,
+                                  progress_output=io.StringIO())
+    assert summary.event_count == 0
+    assert summary.error_count == 2
+    errors = errors_output.getvalue().splitlines()
+    assert errors[0] == f'{tmp_path / "events.json"}: not a list of events, nor an object with an events list'
+    assert errors[1].startswith(f'{tmp_path / "other.json"}: invalid json: ')
@@ -0,0 +1,63 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from objectiv_backend.tools.db_init.db_init import get_sql, _get_sql_section
+
+
+def test_get_sql():
+    sql = get_sql()
+    assert 'primary key(event_id)' in sql
+    assert 'partition by range (day)' not in sql
+    assert 'data_event_id' not in sql
+
+
+def test_get_sql_partitioned():
+    sql = get_sql(partition_data=True)
+    assert 'partition by range (day)' in sql
+    assert 'create table data_default partition of data default;' in sql
+    assert 'grant select, insert on data_event_id to obj_collector_role, obj_worker_role;' in sql
+    assert 'language plpgsql security definer' in sql
+    assert 'grant execute on function create_data_partitions(date, date) to obj_collector_role, obj_worker_role;' \
+        in sql
+    # only the sections are replaced, the rest stays as is
+    assert 'create table queue_entry' in sql
+    assert 'create table nok_data' in sql
+    assert 'create or replace view data_with_sessions' in sql
+    assert '-- section:' not in sql
+
+
+def test_get_sql_unlogged_queues():
+    sql = get_sql(unlogged_queues=True)
+    assert 'create unlogged table queue_entry' in sql
+    assert 'create unlogged table queue_finalize' in sql
+    assert 'create table data' in sql
+    assert 'create unlogged table queue_' not in get_sql()
+
+
+def test_get_sql_typed_data():
+    sql = get_sql(typed_data=True)
+    assert 'alter column value type jsonb' in sql
+    assert 'add column event_type text not null' in sql
+    assert 'using gin' not in sql
+    assert '-- section:' not in sql
+    assert 'using gin (value jsonb_path_ops)' in get_sql(typed_data=True, data_gin_index=True)
+    # the typed layout can be combined with partitioning
+    sql = get_sql(partition_data=True, typed_data=True, data_gin_index=True)
+    assert sql.index('partition by range (day)') < sql.index('alter column value type jsonb') < \
+        sql.index('using gin (value jsonb_path_ops)') < sql.index('create or replace view data_with_sessions')
+
+
+def test_get_sql_sessions():
+    section = _get_sql_section('create_tables.sql', 'sessions')
+    assert section is not None
+    assert 'create table sessions' in section
+    view_section = _get_sql_section('create_tables.sql', 'data_with_sessions')
+    assert view_section is not None
+    # events that are not in a session yet are still in the view
+    assert 'left join sessions as s' in view_section
+    # the sections are part of the full sql, after the roles that they grant privileges to
+    sql = get_sql(partition_data=True, typed_data=True)
+    assert section in sql and view_section in sql
+    assert sql.index('create role obj_reader_role') < sql.index('create table sessions') < \
+        sql.index('create or replace view data_with_sessions')
+    assert _get_sql_section('create_tables.sql', 'unknown') is None
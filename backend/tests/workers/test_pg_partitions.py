@@ -0,0 +1,80 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Tests against a Postgres database, configured like the collector (POSTGRES_HOSTNAME etc.). They are skipped
+if the database cannot be reached, or if db_init hasn't created the roles yet.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytest
+
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.tools.db_init.db_init import _get_sql_section
+from objectiv_backend.workers.pg_storage import create_data_partitions
+
+
+@pytest.fixture
+def pg_connection():
+    """ Connection with an open transaction, in a new schema. Everything is rolled back afterwards. """
+    pg_config = get_config_postgres()
+    try:
+        connection = get_db_connection(pg_config)
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f'Cannot connect to database: {exc}')
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("select to_regrole('obj_collector_role'), to_regrole('obj_worker_role')")
+            if None in cursor.fetchone():
+                pytest.skip('Roles of create_tables.sql do not exist')
+            schema = f'test_{uuid.uuid4().hex}'
+            cursor.execute(f'create schema {schema}; set local search_path to {schema}')
+            cursor.execute(f'grant usage on schema {schema} to obj_collector_role, obj_worker_role')
+        yield connection
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+@pytest.mark.parametrize('role', ['obj_collector_role', 'obj_worker_role'])
+def test_create_data_partitions_as_restricted_role(pg_connection, role):
+    today = datetime.utcnow().date()
+    tomorrow = today + timedelta(days=1)
+    with pg_connection.cursor() as cursor:
+        # the partitioned data table and its grants, as created by db_init
+        cursor.execute(_get_sql_section('create_tables_partitioned.sql', 'data'))
+        cursor.execute(_get_sql_section('create_tables_partitioned.sql', 'data_grants'))
+        cursor.execute('grant select, insert on data to obj_collector_role, obj_worker_role')
+        cursor.execute('''
+            insert into data(event_id, day, moment, cookie_id, value)
+            values (%s, %s, %s, %s, '{}')
+        ''', (str(uuid.uuid4()), tomorrow, datetime.utcnow() + timedelta(days=1), str(uuid.uuid4())))
+
+        cursor.execute(f'set local role {role}')
+        # the role cannot create tables itself
+        cursor.execute('savepoint create_table')
+        with pytest.raises(psycopg2.errors.InsufficientPrivilege):
+            cursor.execute('create table data_19700101 (like data including defaults)')
+        cursor.execute('rollback to savepoint create_table')
+
+        create_data_partitions(pg_connection, first_day=today, last_day=tomorrow)
+        cursor.execute('reset role')
+
+        cursor.execute('''
+            select c.relname, pg_get_userbyid(c.relowner) = current_user
+            from pg_inherits as i
+            inner join pg_class as c on c.oid = i.inhrelid
+            where i.inhparent = 'data'::regclass
+            order by 1
+        ''')
+        # the partitions are owned by the owner of the data table
+        assert cursor.fetchall() == [
+            (f'data_{today:%Y%m%d}', True), (f'data_{tomorrow:%Y%m%d}', True), ('data_default', True)
+        ]
+        # the event in the default partition was moved to the new partition
+        cursor.execute(f'select count(*) from data_{tomorrow:%Y%m%d}')
+        assert cursor.fetchone()[0] == 1
+        cursor.execute('select count(*) from data_default')
+        assert cursor.fetchone()[0] == 0
@@ -0,0 +1,46 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from objectiv_backend.workers.pg_queues import update_queue_tables
+
+
+class FakeCursor:
+    """ Minimal stand-in for a psycopg2 connection and cursor, returns the given table state per query """
+    def __init__(self, table_states):
+        self.table_states = list(table_states)
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchone(self):
+        return self.table_states.pop(0)
+
+
+def test_update_queue_tables_up_to_date():
+    # (is_unlogged, has_primary_key) for queue_entry and queue_finalize
+    connection = FakeCursor([(False, True), (False, True)])
+    assert update_queue_tables(connection, unlogged=False) == []
+    connection = FakeCursor([(True, True), (True, True)])
+    assert update_queue_tables(connection, unlogged=True) == []
+
+
+def test_update_queue_tables():
+    connection = FakeCursor([(False, False), (False, True)])
+    statements = update_queue_tables(connection, unlogged=True)
+    assert statements == [
+        'alter table queue_entry add primary key (insert_order)',
+        'alter table queue_entry set (autovacuum_vacuum_scale_factor = 0, autovacuum_vacuum_threshold = 10000)',
+        'alter table queue_entry set unlogged',
+        'alter table queue_finalize set unlogged',
+    ]
+    assert connection.statements[-len(statements):] == statements
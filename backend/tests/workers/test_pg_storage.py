@@ -0,0 +1,155 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from objectiv_backend.common.serialization import serialize_events
+from objectiv_backend.common.types import FailureReason
+from objectiv_backend.workers import pg_storage
+
+
+class FakeConnection:
+    """ Minimal stand-in for a psycopg2 connection """
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _make_event(event_id: str):
+    cookie_id = str(uuid.uuid4())
+    return {
+        '_type': 'ClickEvent',
+        'id': event_id,
+        'time': 1640995200000,
+        'global_contexts': [{'_type': 'CookieIdContext', 'id': cookie_id, 'cookie_id': cookie_id}],
+        'location_stack': []
+    }
+
+
+def test_insert_events_into_data_duplicates(monkeypatch):
+    new_event = _make_event(str(uuid.uuid4()))
+    existing_event = _make_event(str(uuid.uuid4()))
+    repeated_event = _make_event(str(uuid.uuid4()))
+    events = [new_event, existing_event, repeated_event, repeated_event]
+
+    nok_events = []
+    # existing_event is already in the database, and repeated_event is only inserted once
+    monkeypatch.setattr(pg_storage, '_insert_into_data', lambda cursor, values, columns: [
+        (uuid.UUID(new_event['id']), ), (uuid.UUID(repeated_event['id']), )
+    ])
+    monkeypatch.setattr(pg_storage, 'insert_events_into_nok_data',
+                        lambda connection, events, reason, event_jsons:
+                        nok_events.append((events, reason, event_jsons)))
+    inserted_events = pg_storage.insert_events_into_data(FakeConnection(), events)
+    assert inserted_events == [new_event, repeated_event]
+    # the serialized events are passed on, so they are not serialized again
+    assert nok_events == [(
+        [existing_event, repeated_event],
+        FailureReason.DUPLICATE,
+        serialize_events([existing_event, repeated_event])
+    )]
+
+
+def test_insert_events_into_data_uses_copy(monkeypatch):
+    events = [_make_event(str(uuid.uuid4())) for _ in range(3)]
+    calls = []
+    monkeypatch.setattr(pg_storage, '_insert_into_data', lambda cursor, values, columns: calls.append('insert'))
+    monkeypatch.setattr(pg_storage, '_copy_into_data',
+                        lambda cursor, values, columns, partitioned: calls.append(('copy', partitioned))
+                        or [(uuid.UUID(e['id']), ) for e in events])
+    monkeypatch.setattr(pg_storage, 'COPY_MIN_ROW_COUNT', 3)
+    pg_storage.insert_events_into_data(FakeConnection(), events)
+    assert calls == [('copy', False)]
+    # A partitioned data table is always written through the staging table
+    pg_storage.insert_events_into_data(FakeConnection(), events[:1], partitioned=True)
+    assert calls == [('copy', False), ('copy', True)]
+
+
+def test_insert_events_into_data_typed(monkeypatch):
+    event = _make_event(str(uuid.uuid4()))
+    calls = []
+    monkeypatch.setattr(pg_storage, '_insert_into_data',
+                        lambda cursor, values, columns: calls.append((columns, values))
+                        or [(uuid.UUID(event['id']), )])
+    pg_storage.insert_events_into_data(FakeConnection(), [event], typed_data=True)
+    [(columns, [row])] = calls
+    assert columns == ('event_id', 'day', 'moment', 'cookie_id', 'value', 'event_type')
+    assert row[5:] == ('ClickEvent', )
+
+
+def test_merge_sessions():
+    cookie_id = uuid.uuid4()
+    other_cookie_id = uuid.uuid4()
+    gap = timedelta(seconds=30)
+
+    def moment(seconds: int) -> datetime:
+        return datetime(2022, 1, 1) + timedelta(seconds=seconds)
+
+    def session(seconds: int, end_seconds: int = None, event_count: int = 1, cookie=cookie_id):
+        return (uuid.uuid4(), cookie, moment(seconds), moment(end_seconds or seconds), event_count)
+
+    first = session(0, 100, event_count=5)
+    second = session(150, 300, event_count=3)
+    other_cookie = session(140, cookie=other_cookie_id)
+    # the sessions of cookie_id are more than the gap apart, and sessions of different cookies are not merged
+    assert pg_storage._merge_sessions([second, first, other_cookie], gap) == \
+        sorted([first, second, other_cookie], key=lambda s: (s[1], s[2]))
+
+    # a late event that extends the first session
+    late = session(110)
+    merged = pg_storage._merge_sessions([first, second, late], gap)
+    assert merged == [(first[0], cookie_id, moment(0), moment(110), 6), second]
+
+    # a late event that merges both sessions
+    late = session(130)
+    assert pg_storage._merge_sessions([late, second, merged[0]], gap) == \
+        [(first[0], cookie_id, moment(0), moment(300), 10)]
+
+    # an event before the first session, becomes the first event of that session
+    early = session(-30)
+    assert pg_storage._merge_sessions([first, early], gap) == [(early[0], cookie_id, moment(-30), moment(100), 6)]
+
+
+def test_try_update_sessions(monkeypatch):
+    statements = []
+
+    class RecordingConnection(FakeConnection):
+        def execute(self, query):
+            statements.append(query)
+
+    events = [_make_event(str(uuid.uuid4()))]
+    monkeypatch.setattr(pg_storage, 'update_sessions', lambda connection, events, gap_seconds: None)
+    assert pg_storage.try_update_sessions(RecordingConnection(), events)
+    assert statements == ['savepoint update_sessions', 'release savepoint update_sessions']
+
+    # a failure is rolled back to the savepoint, so the rest of the transaction can still be committed
+    def update_sessions(connection, events, gap_seconds):
+        raise psycopg2.Error('relation "sessions" does not exist')
+    statements.clear()
+    monkeypatch.setattr(pg_storage, 'update_sessions', update_sessions)
+    assert not pg_storage.try_update_sessions(RecordingConnection(), events)
+    assert statements == ['savepoint update_sessions', 'rollback to savepoint update_sessions']
+
+
+def test_ensure_data_partitions_retries_after_failure(monkeypatch):
+    calls = []
+
+    def create_data_partitions(connection, first_day, last_day):
+        calls.append((first_day, last_day))
+        if len(calls) == 1:
+            raise psycopg2.OperationalError('lock timeout')
+
+    monkeypatch.setattr(pg_storage, 'create_data_partitions', create_data_partitions)
+    monkeypatch.setattr(pg_storage, '_data_partitions_ensured_on', None)
+    for _ in range(3):
+        pg_storage.ensure_data_partitions(FakeConnection())
+    # the first attempt failed, the second succeeded, and the third was skipped
+    assert len(calls) == 2
@@ -0,0 +1,55 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import pytest
+
+from objectiv_backend.common.config import WORKER_MIN_BATCH_SIZE
+from objectiv_backend.workers import util
+from objectiv_backend.workers.util import AdaptiveBatchSize
+
+
+def test_adaptive_batch_size():
+    batch_size = AdaptiveBatchSize(max_size=1000)
+    assert batch_size.size == 1000
+
+    # queue is almost empty: shrink to what was picked, but not below the minimum
+    batch_size.update(event_count=300)
+    assert batch_size.size == 300
+    batch_size.update(event_count=0)
+    assert batch_size.size == WORKER_MIN_BATCH_SIZE
+
+    # full batches: the queue is filling up, grow till the maximum
+    sizes = []
+    for _ in range(10):
+        batch_size.update(event_count=batch_size.size)
+        sizes.append(batch_size.size)
+    assert sizes[:3] == [WORKER_MIN_BATCH_SIZE * 2, WORKER_MIN_BATCH_SIZE * 4, WORKER_MIN_BATCH_SIZE * 8]
+    assert sizes[-1] == 1000
+
+
+def test_adaptive_batch_size_small_max():
+    batch_size = AdaptiveBatchSize(max_size=1)
+    batch_size.update(event_count=0)
+    assert batch_size.size == 1
+    batch_size.update(event_count=1)
+    assert batch_size.size == 1
+
+    with pytest.raises(ValueError):
+        AdaptiveBatchSize(max_size=0)
+
+
+def test_worker_main_sleeps_without_queue(monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        raise KeyboardInterrupt()
+
+    def main_test(connection, max_items):
+        return 0
+
+    monkeypatch.setattr(util, 'worker_run', lambda function, batch_size: 0)
+    monkeypatch.setattr(util.time, 'sleep', sleep)
+    with pytest.raises(KeyboardInterrupt):
+        util.worker_main(main_test, loop=True)
+    assert sleeps == [1]
@@ -33,6 +33,12 @@ _DEFAULT_TAXONOMY_DTYPE_PER_FIELD = {
 
 _PG_TAXONOMY_COLUMN = TaxonomyColumnDefinition(name='value', dtype=bach.SeriesJson.dtype)
 
+# Fields of the taxonomy json that the collector can also store in a typed column of the Postgres data table
+# (see POSTGRES_TYPED_DATA in the backend). If the table has the column, it's read instead of the json field.
+_PG_TYPED_COLUMN_PER_FIELD = {
+    '_type': TaxonomyColumnDefinition(name='event_type', dtype=bach.SeriesString.dtype),
+}
+
 _BQ_TAXONOMY_COLUMN = TaxonomyColumnDefinition(
     name='contexts_io_objectiv_taxonomy_1_0_0',  # change only when version is updated
     dtype=[
@@ -74,7 +80,8 @@ class ExtractedContextsPipeline(BaseDataPipeline):
             For example, for BigQuery, the pipeline will generate moment and day series from `time` series
             extracted from the taxonomy.
         4. _convert_dtypes: Will convert all required context series to their correct dtype
-        5. _apply_date_filter: Applies start_date and end_date filter, if required.
+        5. _apply_date_filter: Applies start_date and end_date filter, if required. On Postgres this is
+            done before step 2, directly on the initial data, to allow for index usage and partition pruning.
 
     Final bach DataFrame will be later validated, it must include:
         - all context series defined in ObjectivSupportedColumns
@@ -107,6 +114,11 @@ class ExtractedContextsPipeline(BaseDataPipeline):
             engine=self._engine,
             table_name=self._table_name,
         )
+        self._typed_columns: Dict[str, TaxonomyColumnDefinition] = {}
+        if is_postgres(engine):
+            self._typed_columns = {
+                field: column for field, column in _PG_TYPED_COLUMN_PER_FIELD.items() if column.name in dtypes
+            }
         self._validate_data_dtypes(
             expected_dtypes=dict(self._get_base_dtypes()),
             current_dtypes=dtypes,
@@ -118,11 +130,18 @@ class ExtractedContextsPipeline(BaseDataPipeline):
         context series
         """
         context_df = self._get_initial_data()
+        if is_postgres(self._engine):
+            # On Postgres `day` is a column of the source table. Filtering before any processing puts the
+            # filter directly on the table scan, such that Postgres can use the index on `day` and skip
+            # partitions of a partitioned data table.
+            context_df = self._apply_date_filter(df=context_df, **kwargs)
+
         context_df = self._process_taxonomy_data(context_df)
         context_df = self._apply_extra_processing(context_df)
 
         context_df = self._convert_dtypes(df=context_df)
-        context_df = self._apply_date_filter(df=context_df, **kwargs)
+        if not is_postgres(self._engine):
+            context_df = self._apply_date_filter(df=context_df, **kwargs)
 
         context_columns = ObjectivSupportedColumns.get_extracted_context_columns()
         context_df = context_df[context_columns]
@@ -145,6 +164,7 @@ class ExtractedContextsPipeline(BaseDataPipeline):
         return {
             self._taxonomy_column.name: self._taxonomy_column.dtype,
             **self.required_context_columns_per_dialect[db_dialect],
+            **{column.name: column.dtype for column in self._typed_columns.values()},
         }
 
     def _get_initial_data(self) -> bach.DataFrame:
@@ -175,6 +195,14 @@ class ExtractedContextsPipeline(BaseDataPipeline):
             dtypes = self._taxonomy_column.dtype[0]
 
         for key, dtype in dtypes.items():
+            if key in self._typed_columns:
+                # The table has a typed column for this field, which is much cheaper to read than the json
+                typed_column_name = self._typed_columns[key].name
+                typed_col = df_cp[typed_column_name].astype(dtype).copy_override(name=key)
+                df_cp = df_cp.drop(columns=[typed_column_name])
+                df_cp[key] = typed_col
+                continue
+
             # parsing element to string and then to dtype will avoid
             # conflicts between casting compatibility
             if isinstance(taxonomy_series, bach.SeriesJson):
@@ -8,7 +8,7 @@ import bach
 import pandas as pd
 import pytest
 from sql_models.util import is_bigquery
-from tests.functional.bach.test_data_and_utils import assert_equals_data
+from tests.functional.bach.test_data_and_utils import assert_equals_data, run_query
 
 from modelhub import ExtractedContextsPipeline
 from tests_modelhub.data_and_utils.utils import create_engine_from_db_params, get_parsed_objectiv_data
@@ -85,6 +85,26 @@ def test_get_pipeline_result(db_params) -> None:
     pd.testing.assert_frame_equal(expected, result)
 
 
+@pytest.mark.skip_bigquery
+def test_get_pipeline_result_typed_columns(db_params) -> None:
+    engine = create_engine_from_db_params(db_params)
+    # table with the typed columns that the collector writes if POSTGRES_TYPED_DATA is set
+    run_query(engine, f"""
+        drop table if exists objectiv_data_typed;
+        create table objectiv_data_typed as
+        select *, value->>'_type' as event_type from {db_params.table_name};
+    """)
+    context_pipeline = ExtractedContextsPipeline(engine=engine, table_name='objectiv_data_typed')
+    assert context_pipeline._get_base_dtypes()['event_type'] == 'string'
+
+    df = context_pipeline._process_taxonomy_data(context_pipeline._get_initial_data())
+    assert """'_type'""" not in df.view_sql()
+
+    result = context_pipeline().sort_values(by='event_id').to_pandas()
+    expected = get_expected_context_pandas_df(engine)
+    pd.testing.assert_frame_equal(expected, result)
+
+
 def test_get_initial_data(db_params) -> None:
     context_pipeline = _get_extracted_contexts_pipeline(db_params)
     engine = context_pipeline._engine
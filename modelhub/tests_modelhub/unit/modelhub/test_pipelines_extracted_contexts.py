@@ -85,3 +85,25 @@ def test_convert_dtypes(db_params) -> None:
     assert result['day'].dtype == 'date'
     assert result['moment'].dtype == 'timestamp'
     assert result['user_id'].dtype == 'uuid'
+
+
+@pytest.mark.skip_bigquery
+def test_date_filter_before_processing(db_params, monkeypatch) -> None:
+    engine = create_engine_from_db_params(db_params)
+
+    pipeline = ExtractedContextsPipeline(engine, db_params.table_name)
+    processed_dfs = []
+    process_taxonomy_data = pipeline._process_taxonomy_data
+
+    def _process_taxonomy_data(df: DataFrame) -> DataFrame:
+        processed_dfs.append(df)
+        return process_taxonomy_data(df)
+
+    monkeypatch.setattr(pipeline, '_process_taxonomy_data', _process_taxonomy_data)
+    pipeline._get_pipeline_result(start_date='2021-12-01', end_date='2021-12-02')
+
+    # on Postgres the date filter is applied directly on the source table, to allow partition pruning
+    assert len(processed_dfs) == 1
+    sql = processed_dfs[0].view_sql()
+    assert """("day" >= '2021-12-01')""" in sql
+    assert """("day" <= '2021-12-02')""" in sql